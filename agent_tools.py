@@ -1,15 +1,17 @@
 import json
-from typing import Any, Dict
+import asyncio
+from typing import Any, Dict, List, Tuple
 from sqlalchemy.orm import Session
 from services_catalog import search_products, get_product
-from services_cart import load_cart, save_cart, cart_add, cart_remove, cart_str
+from carrito import Carrito, carrito_load_sesion, carrito_mutar, cart_add, cart_summary_lines
+from disponibilidad import Disponibilidad, reservar, liberar, soltar, mensaje_no_disponible
 
 TOOLS = [
   {"type":"function","function":{"name":"search_products","description":"Busca productos.",
     "parameters":{"type":"object","properties":{"query":{"type":"string"},"filters":{"type":"object","properties":{
       "category":{"type":"string"},"color":{"type":"string"},"size":{"type":"string"},
       "sleeve":{"type":"string","enum":["corta","larga"]},"use":{"type":"string"}}}},"required":["query"]}}},
-  {"type":"function","function":{"name":"get_product","description":"Detalles por sku/url.",
+  {"type":"function","function":{"name":"get_product","description":"Detalles por sku, id de Woo o url (con tallas en stock).",
     "parameters":{"type":"object","properties":{"product_ref":{"type":"string"}},"required":["product_ref"]}}},
   {"type":"function","function":{"name":"add_to_cart","description":"Agrega al carrito.",
     "parameters":{"type":"object","properties":{"sku":{"type":"string"},"name":{"type":"string"},"price":{"type":"number"},
@@ -26,20 +28,122 @@ SYSTEM_PROMPT = (
     "Si falta talla para un producto con tallas, pregunta cuál. Responde breve y profesional."
 )
 
+# Solo leen catálogo (sin BD ni carrito): pueden correr en paralelo
+READ_ONLY_TOOLS = {"search_products", "get_product"}
+
+def _cart_tool(cart: Carrito, name: str, args: Dict[str, Any]) -> Tuple[Carrito, Dict[str, Any], bool]:
+    """Aplica una herramienta del carrito sobre el carrito en memoria: (carrito, resultado, cambió)."""
+    if name == "add_to_cart":
+        cart = cart_add(cart, sku=args["sku"], nombre=args["name"], talla=args.get("size"), color=args.get("color"),
+                        cantidad=int(args.get("qty", 1)), precio_unitario=float(args["price"]))
+        return cart, {"ok": True, "summary": "\n".join(cart_summary_lines(cart))}, True
+    if name == "remove_from_cart":
+        size = args.get("size") or None
+        cart = [it for it in cart if not (it.sku == args["sku"] and it.talla == size)]
+        return cart, {"ok": True, "summary": "\n".join(cart_summary_lines(cart))}, True
+    if name == "show_cart":
+        return cart, {"summary": "\n".join(cart_summary_lines(cart))}, False
+    return cart, {"error": f"Unknown tool {name}"}, False
+
 def dispatch_tool(db: Session, session_id: str, name: str, args: Dict[str, Any]) -> Dict[str, Any]:
     if name == "search_products":
         return {"items": search_products(args["query"], args.get("filters") or {}, limite=6)}
     if name == "get_product":
         return {"item": get_product(args["product_ref"])}
-    if name == "add_to_cart":
-        cart = load_cart(db, session_id)
-        cart = cart_add(cart, {"sku": args["sku"], "name": args["name"], "price": float(args["price"]),
-                               "size": args.get("size"), "color": args.get("color"), "qty": int(args.get("qty",1))})
-        save_cart(db, session_id, cart)
-        return {"ok": True, "summary": cart_str(cart)}
-    if name == "remove_from_cart":
-        cart = load_cart(db, session_id); cart = cart_remove(cart, args["sku"], args.get("size"))
-        save_cart(db, session_id, cart);   return {"ok": True, "summary": cart_str(cart)}
-    if name == "show_cart":
-        return {"summary": cart_str(load_cart(db, session_id))}
-    return {"error": f"Unknown tool {name}"}
+    return _dispatch_cart_tools(db, session_id, [(name, args)])[0]
+
+def _verificar_stock(db: Session, session_id: str, calls: List[Tuple[str, Dict[str, Any]]],
+                     apartadas: Dict[int, Disponibilidad]) -> Dict[int, Dict[str, Any]]:
+    """
+    Antes de tocar el carrito (y una sola vez, aunque el CAS reintente): add_to_cart valida
+    stock real y reserva (disponibilidad.py). Devuelve los rechazos por índice y deja en
+    `apartadas` las reservas hechas (para soltarlas si el carrito no se escribe).
+    """
+    rechazos: Dict[int, Dict[str, Any]] = {}
+    for i, (name, args) in enumerate(calls):
+        try:
+            if name == "add_to_cart":
+                qty = int(args.get("qty", 1) or 1)
+                disp = reservar(db, session_id, {"sku": args.get("sku")}, args.get("size"), qty)
+                if disp is not None and not disp.alcanza(qty):
+                    rechazos[i] = {"ok": False, "error": mensaje_no_disponible(disp, args.get("name"), qty),
+                                   "available_sizes": disp.tallas}
+                elif disp is not None:
+                    apartadas[i] = disp
+        except Exception:
+            continue
+    return rechazos
+
+def _dispatch_cart_tools(db: Session, session_id: str, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Varias herramientas del carrito de un mismo paso: una lectura y, si alguna cambia algo,
+    una escritura con CAS (ver version_pedido.py). Si otro request escribió entre medio, las
+    herramientas se reaplican sobre el carrito fresco y los resultados se recalculan.
+    """
+    out: List[Dict[str, Any]] = []
+    apartadas: Dict[int, Disponibilidad] = {}
+    sin_stock = _verificar_stock(db, session_id, calls, apartadas)
+
+    def _aplicar(cart: Carrito) -> Carrito:
+        out.clear()
+        for i, (name, args) in enumerate(calls):
+            if i in sin_stock:
+                out.append(sin_stock[i])
+                continue
+            try:
+                cart, result, _ = _cart_tool(cart, name, args)
+            except Exception as e:
+                result = {"error": f"{name} falló: {e!r}"}
+            out.append(result)
+        return cart
+
+    if all(name == "show_cart" or i in sin_stock for i, (name, _) in enumerate(calls)):
+        _aplicar(carrito_load_sesion(db, session_id))
+    else:
+        fallo: List[bool] = []
+        carrito_mutar(db, session_id, _aplicar, al_fallar=lambda: fallo.append(True))
+        for i, disp in apartadas.items():
+            # Lo que no quedó en el carrito (CAS agotado o la tool falló) no retiene stock
+            if fallo or (i < len(out) and out[i].get("error")):
+                soltar(db, session_id, disp)
+        if not fallo:
+            # La reserva de lo quitado se suelta solo cuando el carrito ya quedó escrito
+            for i, (name, args) in enumerate(calls):
+                if name == "remove_from_cart" and i < len(out) and out[i].get("ok"):
+                    liberar(db, session_id, {"sku": args.get("sku")}, args.get("size"))
+        if fallo:
+            out = [r if name == "show_cart" or i in sin_stock
+                   else {"ok": False, "error": "No se pudo guardar el carrito; intenta de nuevo."}
+                   for i, ((name, _), r) in enumerate(zip(calls, out))]
+    return out
+
+async def _run_tool(db: Session, session_id: str, name: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return await asyncio.to_thread(dispatch_tool, db, session_id, name, args)
+    except Exception as e:
+        return {"error": f"{name} falló: {e!r}"}
+
+async def dispatch_tools(db: Session, session_id: str, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Ejecuta las tool calls de un paso del modelo y devuelve los resultados en el mismo orden.
+    Las de solo lectura van en paralelo (el paso tarda lo que la más lenta); las del carrito,
+    en orden sobre una sola carga del carrito y escritas con CAS, mientras las de lectura
+    siguen corriendo. Sin locks: dos requests de la misma sesión no se pisan el carrito.
+    """
+    async def _carrito(idx: List[int]) -> List[Dict[str, Any]]:
+        if not idx:
+            return []
+        return await asyncio.to_thread(_dispatch_cart_tools, db, session_id, [calls[i] for i in idx])
+
+    lectura = [i for i, (name, _) in enumerate(calls) if name in READ_ONLY_TOOLS]
+    carrito = [i for i, (name, _) in enumerate(calls) if name not in READ_ONLY_TOOLS]
+    res_lectura, res_carrito = await asyncio.gather(
+        asyncio.gather(*(_run_tool(db, session_id, *calls[i]) for i in lectura)),
+        _carrito(carrito),
+    )
+    results: List[Dict[str, Any]] = [{}] * len(calls)
+    for i, r in zip(lectura, res_lectura):
+        results[i] = r
+    for i, r in zip(carrito, res_carrito):
+        results[i] = r
+    return results
@@ -6,13 +6,13 @@
 
 import os
 import re
+import asyncio
+import anyio
 import json
 import hmac
 import hashlib
-import random
-import string
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Literal
+from typing import Callable, Optional, List, Literal
 
 import httpx
 from dotenv import load_dotenv
@@ -23,7 +23,7 @@ from sqlalchemy.orm import Session
 from sqlalchemy import DateTime
 from openai import OpenAI
 
-from database import SessionLocal
+from database import request_session, session_scope, execute_write
 from models import Pedido
 from crud import (
     actualizar_pedido_por_sesion,
@@ -33,17 +33,28 @@ from crud import (
 from hubspot_utils import enviar_pedido_a_hubspot
 from utils_intencion import detectar_intencion_atencion
 from utils_mensaje_whatsapp import generar_mensaje_atencion_humana
-from woocommerce_gpt_utils import sugerir_productos, detectar_categoria, detectar_atributos
+from woocommerce_gpt_utils import sugerir_productos, productos_por_ids, detectar_categoria, detectar_atributos
+from historial_vistos import HistorialVistos
+from cursor_resultados import CursorResultados, PAGINA
+from ranking import presupuesto_de_texto
+from version_pedido import mutar_pedido, escribir_pedido
+from disponibilidad import reservar, liberar, soltar, mensaje_no_disponible
+from trazas import medir, span
+from registro import logger, correlacionar
+from exportador_woo import encolar as encolar_exportacion_woo
 
 # módulos locales nuevos
 from carrito import (
+    Carrito,
     fmt_cop,
     carrito_load,
-    carrito_save,
+    cargar_lineas,
+    cambios_carrito,
+    carrito_mutar,
+    carrito_load_sesion,
     cart_add,
     cart_update_qty,
     cart_remove,
-    cart_total,
     cart_summary_lines,
 )
 from filtros import (
@@ -54,6 +65,8 @@ from filtros import (
     _norm_txt, extract_qty
 )
 
+log = logger("api_core")
+
 # -------------------------------------------------------------------
 # Router y runtime
 # -------------------------------------------------------------------
@@ -132,6 +145,7 @@ def _normalize_to_msisdn(numero: str) -> str:
         digits = digits[2:]
     return f"+{digits}"
 
+@medir("whatsapp.envio")
 async def enviar_mensaje_whatsapp(numero: str, mensaje: str):
     url = f"https://graph.facebook.com/{WA_GRAPH_API_VER}/{WHATSAPP_PHONE_NUMBER}/messages"
     headers = {
@@ -149,14 +163,20 @@ async def enviar_mensaje_whatsapp(numero: str, mensaje: str):
         async with httpx.AsyncClient(timeout=20) as client_http:
             r = await client_http.post(url, headers=headers, json=payload)
         if r.status_code >= 400:
-            print("❌ Error envío WhatsApp:", r.status_code, r.text)
+            # Solo código y tipo de error de Graph: el mensaje puede repetir datos del cliente
+            try:
+                err = (r.json() or {}).get("error") or {}
+            except ValueError:
+                err = {}
+            log.error("whatsapp.envio_fallido", status=r.status_code, codigo=err.get("code"),
+                      subcodigo=err.get("error_subcode"), tipo=err.get("type"), to=to_msisdn)
             r.raise_for_status()
-        print(f"✅ Mensaje enviado a {to_msisdn}")
+        log.info("whatsapp.enviado", to=to_msisdn, caracteres=len(mensaje or ""))
+    except httpx.HTTPStatusError:
+        pass   # ya registrado arriba con el código de Graph
     except Exception as exc:
-        print("❌ Error envío WhatsApp (exception):", repr(exc))
-        print("📤 Endpoint:", url)
-        print("📨 Payload:", payload)
-        
+        log.error("whatsapp.envio_fallido", exc=exc, to=to_msisdn, caracteres=len(mensaje or ""))
+
 def _parse_alert_numbers() -> list[str]:
     base = (os.getenv("ALERTA_WHATSAPP", "") or "").strip()
     extra = (os.getenv("ALERTA_WHATSAPP_2", "") or "").strip()
@@ -182,13 +202,21 @@ def _parse_alert_numbers() -> list[str]:
 async def enviar_alerta_whatsapp(mensaje: str):
     numeros = _parse_alert_numbers()
     if not numeros:
-        print("⚠️  No hay números de alerta configurados.")
+        log.warning("alerta.sin_numeros")
         return
     for num in numeros:
         try:
             await enviar_mensaje_whatsapp(num, mensaje)
         except Exception as e:
-            print(f"❌ Error enviando alerta a {num}: {repr(e)}")
+            log.error("alerta.fallida", exc=e, to=num)
+
+def _en_loop(enviar, *args):
+    """Corre un envío async (WhatsApp) en el loop del servidor desde el hilo del turno."""
+    try:
+        return anyio.from_thread.run(enviar, *args)
+    except RuntimeError:
+        # fuera del threadpool de FastAPI (scripts de prueba): loop propio solo para el envío
+        return asyncio.run(enviar(*args))
 
 # -------------------------------------------------------------------
 # Modelos / dependencia DB
@@ -212,12 +240,10 @@ class PedidoEntrada(BaseModel):
     metodo_pago: Literal["transferencia", "payu", "pago_en_tienda"]
     notas: Optional[str] = ""
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    # async: así la sesión queda publicada en el contexto del handler
+    with request_session() as db:
         yield db
-    finally:
-        db.close()
 
 # -------------------------------------------------------------------
 # Helpers de estado/JSON/persistencia
@@ -247,9 +273,8 @@ def _get_last_msg_id(db: Session, session_id: str) -> Optional[str]:
 
 def set_user_filter(db: Session, session_id: str, filtro: dict):
     try:
-        db.execute(sa_text("UPDATE pedidos SET filtros = :f WHERE session_id = :sid"),
-                   {"f": json.dumps(filtro, ensure_ascii=False), "sid": session_id})
-        db.commit()
+        execute_write(db, sa_text("UPDATE pedidos SET filtros = :f WHERE session_id = :sid"),
+                      {"f": json.dumps(filtro, ensure_ascii=False), "sid": session_id})
     except Exception:
         db.rollback()
 
@@ -260,30 +285,100 @@ def get_user_filter(db: Session, session_id: str) -> Optional[dict]:
     except Exception:
         return None
 
-def _get_sugeridos_urls(db: Session, session_id: str) -> List[str]:
+def _vistos_load(db: Session, session_id: str) -> HistorialVistos:
     try:
-        row = db.execute(sa_text("SELECT sugeridos FROM pedidos WHERE session_id=:sid"), {"sid": session_id}).fetchone()
-        txt = row[0] if row and row[0] else ""
-        if txt.strip().startswith("["):
-            try:
-                arr = json.loads(txt)
-                return [u for u in arr if isinstance(u, str) and u.startswith("http")]
-            except Exception:
-                pass
-        return [u for u in txt.split() if u.startswith("http")]
+        row = db.execute(sa_text("SELECT vistos_json FROM pedidos WHERE session_id=:sid"), {"sid": session_id}).fetchone()
+        return HistorialVistos.from_json(row[0] if row else None)
     except Exception:
-        return []
+        return HistorialVistos()
+
+def _marcar_vistos(db: Session, session_id: str, productos: List[dict]):
+    """Agrega los IDs de 'productos' al historial (CAS: no pisa lo que marcó otro mensaje a la vez)."""
+    ids = [p.get("id") for p in productos if isinstance(p, dict)]
 
-def _append_sugeridos_urls(db: Session, session_id: str, nuevos: List[str]):
-    prev = _get_sugeridos_urls(db, session_id)
-    combined = list(dict.fromkeys(prev + nuevos))
-    actualizar_pedido_por_sesion(db, session_id, "sugeridos", " ".join(combined))
+    def _m(valores: dict) -> Optional[dict]:
+        vistos = HistorialVistos.from_json(valores["vistos_json"])
+        return {"vistos_json": vistos.to_json()} if vistos.agregar(ids) else None
+
+    try:
+        mutar_pedido(db, session_id, ("vistos_json",), _m)
+    except Exception:
+        db.rollback()
+
+def _cursor_load(db: Session, session_id: str) -> Optional[CursorResultados]:
+    try:
+        row = db.execute(sa_text("SELECT cursor_json FROM pedidos WHERE session_id=:sid"), {"sid": session_id}).fetchone()
+        return CursorResultados.from_json(row[0] if row else None)
+    except Exception:
+        return None
+
+def _cursor_save(db: Session, session_id: str, cursor: Optional[CursorResultados]):
+    try:
+        execute_write(db, sa_text("UPDATE pedidos SET cursor_json=:j WHERE session_id=:sid"),
+                      {"j": cursor.to_json() if cursor else None, "sid": session_id})
+    except Exception:
+        db.rollback()
+
+def _lineas_productos(productos: List[dict]) -> List[str]:
+    return [
+        f"{i}. {pr.get('nombre','Producto')} - {fmt_cop(pr.get('precio',0))} - {pr.get('url','')}"
+        for i, pr in enumerate(productos[:PAGINA], 1)
+    ]
+
+def _limpiar_tallas(productos: List[dict]) -> List[dict]:
+    for p in productos:
+        if isinstance(p, dict) and "tallas_disponibles" in p:
+            p["tallas_disponibles"] = _clean_tallas(p.get("tallas_disponibles"))
+    return productos
+
+def _buscar_paginado(db: Session, session_id: str, pedido, consulta: str, user_text: str,
+                     categoria: Optional[str]) -> List[dict]:
+    """Primera página de una búsqueda; deja el cursor de la sesión listo para "más opciones"."""
+    vistos = _vistos_load(db, session_id)
+    presupuesto = presupuesto_de_texto(user_text)
+    tallas = _tallas_preferidas(pedido, categoria)
+    res = sugerir_productos(consulta, limite=PAGINA, excluir_ids=vistos,
+                            presupuesto=presupuesto, tallas_preferidas=tallas)
+    productos = _limpiar_tallas(res.get("productos", []) if isinstance(res, dict) else [])
+    if not productos:
+        return []
+    _cursor_save(db, session_id, CursorResultados(
+        consulta, categoria=res.get("categoria_detectada"), filtros=res.get("atributos_detectados"),
+        presupuesto=res.get("presupuesto_detectado"), tallas=tallas,
+        ids=res.get("ids_ordenados"), offset=len(productos),
+    ))
+    _marcar_vistos(db, session_id, productos)
+    return productos
+
+def _siguiente_pagina(db: Session, session_id: str, cursor: CursorResultados) -> List[dict]:
+    """Página siguiente del cursor: IDs ya ordenados desde el catálogo local o, sin él, Woo en vivo."""
+    vistos = _vistos_load(db, session_id)
+    productos: List[dict] = []
+    while cursor.pendientes and not productos:
+        productos, usados = productos_por_ids(cursor.pendientes, PAGINA)
+        if not usados:
+            break
+        cursor.avanzar(usados)
+    if not productos and (cursor.pendientes or not cursor.ids):
+        # Espejo no listo o cursor sin resolver: se repite la búsqueda sin lo ya mostrado (queda en vistos),
+        # con la categoría y los filtros guardados en el cursor
+        res = sugerir_productos(cursor.consulta, limite=PAGINA, excluir_ids=vistos,
+                                presupuesto=cursor.presupuesto, tallas_preferidas=cursor.tallas,
+                                categoria=cursor.categoria, atributos=cursor.filtros)
+        productos = res.get("productos", []) if isinstance(res, dict) else []
+        if cursor.ids:
+            cursor.avanzar(len(productos))
+        elif productos:
+            cursor.cargar(res.get("ids_ordenados"), offset=len(productos))
+    productos = _limpiar_tallas(productos)
+    _cursor_save(db, session_id, cursor)
+    if productos:
+        _marcar_vistos(db, session_id, productos)
+    return productos
 
 def _set_sugeridos_list(db: Session, session_id: str, lista: List[dict]):
     try:
-        db.execute(sa_text("UPDATE pedidos SET sugeridos_json=:j WHERE session_id=:sid"),
-                   {"j": json.dumps(lista, ensure_ascii=False), "sid": session_id})
-        db.commit()
+        escribir_pedido(db, session_id, {"sugeridos_json": json.dumps(lista, ensure_ascii=False)})
     except Exception:
         db.rollback()
 
@@ -313,45 +408,129 @@ def _get_ultima_cat_filters(db: Session, session_id: str):
 def _ctx_load(pedido) -> dict:
     try:
         sid = pedido.session_id
-        db = SessionLocal()
-        try:
+        with session_scope(pedido) as db:
             row = db.execute(sa_text("SELECT ctx_json FROM pedidos WHERE session_id=:sid"), {"sid": sid}).fetchone()
-        finally:
-            db.close()
         raw = row[0] if row and row[0] else "{}"
         return _safe_json_load(raw, {})
     except Exception:
         return {}
 
-def _ctx_save(db: Session, session_id: str, ctx: dict):
+def _dict_json(raw) -> dict:
+    data = _safe_json_load(raw or "{}", {})
+    return data if isinstance(data, dict) else {}
+
+def _mutar_sesion(
+    db: Session,
+    session_id: str,
+    carrito: Optional[Callable[[Carrito], Carrito]] = None,
+    ctx: Optional[Callable[[dict], None]] = None,
+    prefs: Optional[Callable[[dict], None]] = None,
+    fijos: Optional[dict] = None,
+    al_fallar: Optional[Callable[[], None]] = None,
+) -> Optional[Carrito]:
+    """
+    Read-modify-write de los JSON de la sesión en un solo UPDATE con CAS
+    (ver version_pedido.py): si otro mensaje escribió entre medio, los cambios
+    se reaplican sobre lo fresco. `carrito` devuelve el carrito nuevo; `ctx` y
+    `prefs` modifican el dict en sitio; `fijos` se escriben tal cual.
+    Devuelve el carrito escrito si se pidió `carrito`; si la escritura no
+    entra (CAS agotado o error) llama `al_fallar` y devuelve el carrito guardado.
+    """
+    columnas = [c for c, f in (("carrito_json", carrito), ("ctx_json", ctx), ("preferencias_json", prefs)) if f]
+    escrito: List[Carrito] = []
+
+    def _m(valores: dict) -> dict:
+        cambios = dict(fijos or {})
+        if carrito:
+            nuevo = carrito(cargar_lineas(valores["carrito_json"] or "[]"))
+            escrito[:] = [nuevo]
+            cambios.update(cambios_carrito(nuevo))
+        if ctx:
+            d = _dict_json(valores["ctx_json"])
+            ctx(d)
+            cambios["ctx_json"] = json.dumps(d, ensure_ascii=False)
+        if prefs:
+            d = _dict_json(valores["preferencias_json"])
+            prefs(d)
+            cambios["preferencias_json"] = json.dumps(d, ensure_ascii=False)
+        return cambios
+
     try:
-        db.execute(sa_text("UPDATE pedidos SET ctx_json=:j WHERE session_id=:sid"),
-                   {"j": json.dumps(ctx, ensure_ascii=False), "sid": session_id})
-        db.commit()
+        if mutar_pedido(db, session_id, columnas, _m) is not None:
+            if escrito or not carrito:
+                return escrito[0] if escrito else None
     except Exception:
         db.rollback()
+    if al_fallar is not None:
+        al_fallar()
+    return carrito_load_sesion(db, session_id) if carrito else None
+
+def _ctx_mutar(db: Session, session_id: str, mutar: Callable[[dict], None]):
+    _mutar_sesion(db, session_id, ctx=mutar)
+
+def _ctx_set(db: Session, session_id: str, clave: str, valor):
+    """Fija (o con None, quita) una clave del ctx sin pisar las demás."""
+    def _m(ctx: dict):
+        if valor is None:
+            ctx.pop(clave, None)
+        else:
+            ctx[clave] = valor
+    _ctx_mutar(db, session_id, _m)
 
-def _remember_list(db: Session, session_id: str, cat: str, filtros: dict, productos: List[dict]):
-    try:
-        db.execute(
-            sa_text("UPDATE pedidos SET ultima_categoria=:c, ultimos_filtros=:f, sugeridos_json=:s WHERE session_id=:sid"),
-            {"c": cat or "", "f": json.dumps(filtros, ensure_ascii=False),
-             "s": json.dumps(productos, ensure_ascii=False), "sid": session_id}
+def _agregar_al_carrito(db: Session, session_id: str, prod: dict, talla=None, color=None,
+                        cantidad: int = 1, consumir: Optional[str] = None) -> dict:
+    """
+    Agrega `prod` (de la lista sugerida) si hay stock real (disponibilidad.py: espejo
+    fresco o una llamada a Woo, menos lo reservado por otros) y aparta las unidades.
+    Carrito y clave pendiente del ctx (`consumir`) salen en un solo UPDATE; si ese
+    UPDATE no entra, lo apartado se devuelve.
+    Devuelve la respuesta para el cliente.
+    """
+    cantidad = int(cantidad or 1)
+    disp = reservar(db, session_id, prod, talla, cantidad)
+    if disp is not None and not disp.alcanza(cantidad):
+        return {"response": mensaje_no_disponible(disp, prod.get("nombre", "Producto"), cantidad)}
+    tallas = _clean_tallas(prod.get("tallas_disponibles") or [])
+    if disp is None and tallas and talla and str(talla).upper() not in tallas:
+        # sin dato en vivo: se valida contra las tallas de la lista mostrada
+        return {"response": f"Para «{prod.get('nombre','Producto')}» tengo {', '.join(tallas)}. ¿Quieres elegir una de esas tallas?"}
+
+    def _add(carrito: Carrito) -> Carrito:
+        return cart_add(
+            carrito,
+            sku=prod.get("sku") or prod.get("url") or prod.get("nombre","Producto"),
+            nombre=prod.get("nombre","Producto"),
+            categoria=prod.get("categoria",""),
+            talla=talla,
+            color=color if color is not None else prod.get("color"),
+            cantidad=cantidad,
+            precio_unitario=float(prod.get("precio", 0.0) or 0.0),
         )
-        db.commit()
-    except Exception:
-        db.rollback()
+    fallo: List[bool] = []
 
-    pedido = obtener_pedido_por_sesion(db, session_id)
-    ctx = _ctx_load(pedido)
-    ctx["ultima_categoria"] = cat
-    ctx["ultimos_filtros"] = filtros
-    ctx["ultima_lista"] = productos
-    _ctx_save(db, session_id, ctx)
+    def _fallo():
+        fallo.append(True)
+        soltar(db, session_id, disp)
+
+    carrito = _mutar_sesion(db, session_id, carrito=_add,
+                            ctx=(lambda c: c.pop(consumir, None)) if consumir else None, al_fallar=_fallo)
+    if fallo:
+        return {"response": "No pude agregarlo al carrito en este momento. ¿Lo intentamos de nuevo?"}
+    return {"response": "Agregado al carrito ✅\n\n" + "\n".join(cart_summary_lines(carrito or []))}
+
+def _remember_list(db: Session, session_id: str, cat: str, filtros: dict, productos: List[dict]):
+    def _m(ctx: dict):
+        ctx["ultima_categoria"] = cat
+        ctx["ultimos_filtros"] = filtros
+        ctx["ultima_lista"] = productos
+
+    _mutar_sesion(db, session_id, ctx=_m, fijos={
+        "ultima_categoria": cat or "",
+        "ultimos_filtros": json.dumps(filtros, ensure_ascii=False),
+        "sugeridos_json": json.dumps(productos, ensure_ascii=False),
+    })
 
 def _remember_selection(db: Session, session_id: str, prod: dict, idx: int):
-    pedido = obtener_pedido_por_sesion(db, session_id)
-    ctx = _ctx_load(pedido)
     sel = {
         "idx": idx,
         "nombre": prod.get("nombre"),
@@ -361,29 +540,27 @@ def _remember_selection(db: Session, session_id: str, prod: dict, idx: int):
         "cantidad": None,
         "ts": datetime.now(timezone.utc).isoformat(),
     }
-    ctx.setdefault("selecciones", []).append(sel)
-    db2 = SessionLocal()
-    try:
-        _ctx_save(db2, session_id, ctx)
-    finally:
-        db2.close()
+    _ctx_mutar(db, session_id, lambda ctx: ctx.setdefault("selecciones", []).append(sel))
 
 def _update_last_selection_from_pedido(db: Session, session_id: str):
     pedido = obtener_pedido_por_sesion(db, session_id)
-    ctx = _ctx_load(pedido)
-    if not ctx.get("selecciones"):
-        return
-    last = ctx["selecciones"][-1]
-    if getattr(pedido, "talla", None):
-        last["talla"] = pedido.talla
-    if getattr(pedido, "cantidad", None):
-        last["cantidad"] = pedido.cantidad
-    _ctx_save(db, session_id, ctx)
+    talla, cantidad = getattr(pedido, "talla", None), getattr(pedido, "cantidad", None)
+
+    def _m(ctx: dict):
+        if not ctx.get("selecciones"):
+            return
+        last = ctx["selecciones"][-1]
+        if talla:
+            last["talla"] = talla
+        if cantidad:
+            last["cantidad"] = cantidad
+
+    _ctx_mutar(db, session_id, _m)
 
 # -------------------------------------------------------------------
 # Clasificador pago/confirmación (LLM)
 # -------------------------------------------------------------------
-async def detectar_intencion_pago_confirmacion(texto: str) -> dict:
+def detectar_intencion_pago_confirmacion(texto: str) -> dict:
     if client is None:
         return {"intent": "ninguno", "method": None, "confidence": 0.0}
     try:
@@ -398,16 +575,17 @@ async def detectar_intencion_pago_confirmacion(texto: str) -> dict:
             "Mapeo: transferencia/bancolombia/davivienda -> transferencia; payu/pse -> payu; "
             "efectivo/pago en tienda/contraentrega -> pago_en_tienda"
         )
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            temperature=0.6,
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": schema_msg},
-                {"role": "user", "content": texto.strip()},
-            ],
-            max_tokens=350,
-        )
+        with span("openai.chat", modelo="gpt-4o-mini"):
+            completion = client.chat.completions.create(
+                model="gpt-4o-mini",
+                temperature=0.6,
+                response_format={"type": "json_object"},
+                messages=[
+                    {"role": "system", "content": schema_msg},
+                    {"role": "user", "content": texto.strip()},
+                ],
+                max_tokens=350,
+            )
         raw = completion.choices[0].message.content.strip()
         data = json.loads(raw)
         intent = data.get("intent") if data.get("intent") in {"pago", "confirmar", "ninguno"} else "ninguno"
@@ -514,7 +692,7 @@ def _prompt_for_missing(pedido, faltan: list) -> str:
 # -------------------------------------------------------------------
 # Conversación de pago/confirmación (router híbrido)
 # -------------------------------------------------------------------
-async def procesar_mensaje_usuario(text: str, db, session_id, pedido):
+def procesar_mensaje_usuario(text: str, db, session_id, pedido):
     pago_match = re.compile(
         r'(pagar|pago|quiero pagar|voy a pagar|prefiero pagar|el pago|pagaremos|pagare).*(transferencia|bancolombia|davivienda|pse|payu|pago en tienda|efectivo|contraentrega)'
         r'|(transferencia|bancolombia|davivienda|pse|payu|pago en tienda|efectivo|contraentrega).*(pagar|pago|quiero|voy|prefiero|pagaremos|pagare)',
@@ -526,7 +704,7 @@ async def procesar_mensaje_usuario(text: str, db, session_id, pedido):
 
     intent_det = {"intent": "ninguno", "method": None, "confidence": 0.0}
     if not (pago_match or confirm_match):
-        intent_det = await detectar_intencion_pago_confirmacion(text)
+        intent_det = detectar_intencion_pago_confirmacion(text)
 
     def _infer_method_from_text(t: str) -> Optional[str]:
         t = t.lower()
@@ -560,9 +738,7 @@ async def procesar_mensaje_usuario(text: str, db, session_id, pedido):
             }
         else:
             # pago_en_tienda -> quedamos esperando confirmación corta
-            ctx = _ctx_load(pedido)
-            ctx["awaiting_confirmation"] = True
-            _ctx_save(db, session_id, ctx)
+            _ctx_set(db, session_id, "awaiting_confirmation", True)
             return {
                 "response": (
                     "Listo. Pagas directamente en la tienda al recoger tu pedido. "
@@ -573,22 +749,19 @@ async def procesar_mensaje_usuario(text: str, db, session_id, pedido):
     if confirm_match or (intent_det["intent"] == "confirmar" and intent_det["confidence"] >= 0.6):
         actualizar_pedido_por_sesion(db, session_id, "estado", "confirmado")
         pedido_actualizado = obtener_pedido_por_sesion(db, session_id)
-        if not getattr(pedido_actualizado, "numero_confirmacion", None):
-            numero = _gen_numero_confirmacion()
-            actualizar_pedido_por_sesion(db, session_id, "numero_confirmacion", numero)
-            pedido_actualizado = obtener_pedido_por_sesion(db, session_id)
 
         try:
-            print("🟢 Trigger HubSpot (confirmación por intención/regex). Session:", session_id)
+            log.info("hubspot.trigger", origen="intencion_regex")
             enviar_pedido_a_hubspot(pedido_actualizado)
         except Exception as e:
-            print("❌ HubSpot error (confirmación/regex):", repr(e))
+            log.error("hubspot.fallido", exc=e, origen="intencion_regex")
+        encolar_exportacion_woo(db, pedido_actualizado)
 
         try:
             mensaje_alerta = generar_mensaje_atencion_humana(pedido_actualizado)
-            await enviar_alerta_whatsapp(mensaje_alerta)                               
+            _en_loop(enviar_alerta_whatsapp, mensaje_alerta)                               
         except Exception as e:
-            print("❌ Error alerta interna:", repr(e))
+            log.error("alerta.fallida", exc=e, origen="intencion_regex")
 
         carrito = carrito_load(pedido_actualizado)
         lineas = cart_summary_lines(carrito)
@@ -610,7 +783,8 @@ async def procesar_mensaje_usuario(text: str, db, session_id, pedido):
 # -------------------------------------------------------------------
 # LLM general
 # -------------------------------------------------------------------
-async def procesar_conversacion_llm(pedido, texto_usuario: str):
+@medir("llm.conversacion")
+def procesar_conversacion_llm(pedido, texto_usuario: str):
     if client is None:
         carrito = carrito_load(pedido)
         lineas = cart_summary_lines(carrito)
@@ -637,7 +811,7 @@ async def procesar_conversacion_llm(pedido, texto_usuario: str):
 
     # Sugerencias de productos
     try:
-        sug = sugerir_productos(texto_usuario, limite=3)
+        sug = sugerir_productos(texto_usuario, limite=3, tallas_preferidas=_tallas_preferidas(pedido))
         if isinstance(sug, dict):
             productos = (sug.get("productos") or [])[:3]
             mensaje = sug.get("mensaje")
@@ -650,7 +824,11 @@ async def procesar_conversacion_llm(pedido, texto_usuario: str):
         except Exception:
             cat = None
         if cat:
-            sug2 = sugerir_productos(cat, limite=3)
+            sug2 = sugerir_productos(
+                cat, limite=3,
+                presupuesto=presupuesto_de_texto(texto_usuario),
+                tallas_preferidas=_tallas_preferidas(pedido, cat),
+            )
             if isinstance(sug2, dict):
                 productos = (sug2.get("productos") or [])[:3]
                 if not mensaje:
@@ -701,18 +879,19 @@ async def procesar_conversacion_llm(pedido, texto_usuario: str):
     )
 
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": base_prompt},
-                {"role": "system", "content": instruct_json},
-                {"role": "system", "content": ACTIONS_PROTOCOL},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0.4,
-            max_tokens=1000,
-            response_format={"type": "json_object"}
-        )
+        with span("openai.chat", modelo="gpt-4o"):
+            completion = client.chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": base_prompt},
+                    {"role": "system", "content": instruct_json},
+                    {"role": "system", "content": ACTIONS_PROTOCOL},
+                    {"role": "user", "content": user_prompt},
+                ],
+                temperature=0.4,
+                max_tokens=1000,
+                response_format={"type": "json_object"}
+            )
         raw = completion.choices[0].message.content.strip()
         data = json.loads(raw)
 
@@ -745,25 +924,74 @@ def _clean_tallas(arr):
 def _prefs_load(pedido) -> dict:
     try:
         sid = pedido.session_id
-        db = SessionLocal()
-        try:
+        with session_scope(pedido) as db:
             row = db.execute(sa_text("SELECT preferencias_json FROM pedidos WHERE session_id=:sid"),
                              {"sid": sid}).fetchone()
-        finally:
-            db.close()
         raw = row[0] if row and row[0] else "{}"
         data = _safe_json_load(raw, {})
         return data if isinstance(data, dict) else {}
     except Exception:
         return {}
 
-def _prefs_save(db: Session, session_id: str, prefs: dict):
-    try:
-        db.execute(sa_text("UPDATE pedidos SET preferencias_json=:j WHERE session_id=:sid"),
-                   {"j": json.dumps(prefs, ensure_ascii=False), "sid": session_id})
-        db.commit()
-    except Exception:
-        db.rollback()
+def _tallas_preferidas(pedido, categoria: Optional[str] = None) -> List[str]:
+    """Talla guardada para esa categoría o, si no hay, todas las que el cliente ya dijo."""
+    tallas = _prefs_load(pedido).get("tallas_preferidas") or {}
+    if not isinstance(tallas, dict):
+        return []
+    if categoria and tallas.get(categoria):
+        return [tallas[categoria]]
+    return [t for t in dict.fromkeys(tallas.values()) if t]
+
+def _acciones_carrito(carrito: Carrito, acciones: List[dict]) -> Carrito:
+    """Acciones de carrito del LLM sobre el carrito en memoria (sin efectos: puede reaplicarse)."""
+    for act in acciones:
+        try:
+            t = (act.get("tipo") or "").strip()
+            args = act.get("args") or {}
+            if t == "add_item":
+                carrito = cart_add(
+                    carrito,
+                    sku=args["sku"],
+                    nombre=args.get("nombre","Producto"),
+                    categoria=args.get("categoria",""),
+                    talla=args.get("talla"),
+                    color=args.get("color"),
+                    cantidad=int(args.get("cantidad", 1)),
+                    precio_unitario=float(args.get("precio_unitario", 0.0))
+                )
+            elif t == "update_qty":
+                carrito = cart_update_qty(
+                    carrito,
+                    sku=args["sku"],
+                    talla=args.get("talla"),
+                    color=args.get("color"),
+                    cantidad=int(args.get("cantidad", 1))
+                )
+            elif t == "remove_item":
+                carrito = cart_remove(
+                    carrito,
+                    sku=args["sku"],
+                    talla=args.get("talla"),
+                    color=args.get("color")
+                )
+        except Exception:
+            continue
+    return carrito
+
+def _acciones_prefs(prefs: dict, acciones: List[dict]):
+    for act in acciones:
+        if (act.get("tipo") or "").strip() != "remember_pref":
+            continue
+        args = act.get("args") or {}
+        cat = args.get("categoria")
+        talla = args.get("talla")
+        color_fav = args.get("color_favorito")
+        if not isinstance(prefs.get("tallas_preferidas"), dict):
+            prefs["tallas_preferidas"] = {}
+        if cat and talla:
+            prefs["tallas_preferidas"][cat] = talla
+        if color_fav:
+            prefs["color_favorito"] = color_fav
 
 # -------------------------------------------------------------------
 # Action Protocol (SHOW_CART / ADD_TO_CART / etc.)
@@ -796,13 +1024,12 @@ def _handle_action_protocol(payload: dict, db: Session, session_id: str, pedido)
         ref = payload.get("product_ref")
         prod = _resolve_product_ref(db, session_id, ref) if ref else None
         if prod:
-            ctx = _ctx_load(pedido)
-            ctx["pending_variant"] = {
+            pendiente = {
                 "ref": ref,
                 "sku": prod.get("sku") or prod.get("url") or prod.get("nombre"),
                 "qty": int(payload.get("qty") or 1),
             }
-            _ctx_save(db, session_id, ctx)
+            _ctx_set(db, session_id, "pending_variant", pendiente)
             tallas = _clean_tallas(prod.get("tallas_disponibles") or [])
             if tallas:
                 return {"response": f"Para «{prod.get('nombre','Producto')}», ¿qué talla prefieres? Opciones: {', '.join(tallas)}"}
@@ -813,16 +1040,15 @@ def _handle_action_protocol(payload: dict, db: Session, session_id: str, pedido)
         return {"response": payload.get("question") or "¿Podrías confirmar qué producto?"}
 
     if action == "REMOVE_FROM_CART":
-        carrito = carrito_load(pedido)
         sku = str(payload.get("product_id") or payload.get("sku") or "")
         talla = payload.get("size")
         color = payload.get("color")
-        carrito = cart_remove(carrito, sku, talla, color)
-        carrito_save(db, session_id, carrito)
-        try:
-            actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-        except Exception:
-            pass
+        fallo: List[bool] = []
+        carrito = carrito_mutar(db, session_id, lambda c: cart_remove(c, sku, talla, color),
+                                al_fallar=lambda: fallo.append(True))
+        if fallo:
+            return {"response": "No pude quitarlo del carrito en este momento. ¿Lo intentamos de nuevo?"}
+        liberar(db, session_id, {"sku": sku}, talla)
         return {"response": "\n".join(cart_summary_lines(carrito))}
 
     if action == "ADD_TO_CART":
@@ -838,26 +1064,13 @@ def _handle_action_protocol(payload: dict, db: Session, session_id: str, pedido)
         size = payload.get("size")
         if tallas and not size:
             return {"response": f"Para agregar «{prod.get('nombre','Producto')}» necesito la talla: {', '.join(tallas)}. ¿Cuál prefieres?"}
-        if tallas and size and str(size).upper() not in tallas:
-            return {"response": f"Para «{prod.get('nombre','Producto')}» tengo {', '.join(tallas)}. ¿Quieres elegir una de esas tallas?"}
 
-        carrito = carrito_load(pedido)
-        carrito = cart_add(
-            carrito,
-            sku=prod.get("sku") or prod.get("url") or prod.get("nombre","Producto"),
-            nombre=prod.get("nombre","Producto"),
-            categoria=prod.get("categoria",""),
+        return _agregar_al_carrito(
+            db, session_id, prod,
             talla=str(size).upper() if isinstance(size, str) else size,
             color=payload.get("color") or prod.get("color"),
             cantidad=int(payload.get("qty") or 1),
-            precio_unitario=float(prod.get("precio", 0.0)),
         )
-        carrito_save(db, session_id, carrito)
-        try:
-            actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-        except Exception:
-            pass
-        return {"response": "Agregado al carrito ✅\n\n" + "\n".join(cart_summary_lines(carrito))}
 
     return None
 
@@ -865,7 +1078,15 @@ def _handle_action_protocol(payload: dict, db: Session, session_id: str, pedido)
 # ENDPOINT principal de conversación
 # -------------------------------------------------------------------
 @router.post("/mensaje-whatsapp")
-async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session = Depends(get_db)):
+@medir("whatsapp.mensaje")
+def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session = Depends(get_db)):
+    """
+    Un turno de conversación. Todo el turno es síncrono (BD y escritor único,
+    OpenAI, Woo): FastAPI lo corre en su threadpool, así no frena el loop del
+    servidor y las escrituras de turnos concurrentes llegan juntas al escritor
+    (group commit). Los avisos por WhatsApp vuelven al loop con _en_loop.
+    """
+    correlacionar(session_id)
     ahora = datetime.now(timezone.utc)
     pedido = obtener_pedido_por_sesion(db, session_id)
 
@@ -940,28 +1161,8 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
         if pv_ctx:
             prod = _resolve_product_ref(db, session_id, pv_ctx.get("ref") or pv_ctx.get("sku"))
             if prod:
-                tallas = _clean_tallas(prod.get("tallas_disponibles") or [])
-                if tallas and filtros_detectados["talla"] not in tallas:
-                    return {"response": f"Para «{prod.get('nombre','Producto')}» tengo {', '.join(tallas)}. ¿Quieres elegir una de esas tallas?"}
-                carrito = carrito_load(pedido)
-                carrito = cart_add(
-                    carrito,
-                    sku=prod.get("sku") or prod.get("url") or prod.get("nombre","Producto"),
-                    nombre=prod.get("nombre","Producto"),
-                    categoria=prod.get("categoria",""),
-                    talla=filtros_detectados["talla"],
-                    color=prod.get("color"),
-                    cantidad=int(pv_ctx.get("qty") or 1),
-                    precio_unitario=float(prod.get("precio", 0.0)),
-                )
-                carrito_save(db, session_id, carrito)
-                try:
-                    actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-                except Exception:
-                    pass
-                ctx.pop("pending_variant", None)
-                _ctx_save(db, session_id, ctx)
-                return {"response": "Agregado al carrito ✅\n\n" + "\n".join(cart_summary_lines(carrito))}
+                return _agregar_al_carrito(db, session_id, prod, talla=filtros_detectados["talla"],
+                                           cantidad=int(pv_ctx.get("qty") or 1), consumir="pending_variant")
 
     # awaiting qty por contexto (producto sin tallas)
     ctx_qty = _ctx_load(pedido)
@@ -972,25 +1173,7 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
             ref = str(awaiting.get("ref") or "")
             prod = _resolve_product_ref(db, session_id, ref) or _resolve_product_ref(db, session_id, awaiting.get("sku") or "")
             if prod:
-                carrito = carrito_load(pedido)
-                carrito = cart_add(
-                    carrito,
-                    sku=prod.get("sku") or prod.get("url") or prod.get("nombre","Producto"),
-                    nombre=prod.get("nombre","Producto"),
-                    categoria=prod.get("categoria",""),
-                    talla=None,
-                    color=prod.get("color"),
-                    cantidad=int(qty),
-                    precio_unitario=float(prod.get("precio", 0.0) or 0.0),
-                )
-                carrito_save(db, session_id, carrito)
-                try:
-                    actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-                except Exception:
-                    pass
-                ctx_qty.pop("awaiting_qty", None)
-                _ctx_save(db, session_id, ctx_qty)
-                return {"response": "Agregado al carrito ✅\n\n" + "\n".join(cart_summary_lines(carrito))}
+                return _agregar_al_carrito(db, session_id, prod, cantidad=int(qty), consumir="awaiting_qty")
         return {"response": "¿Cuántas unidades deseas? (por ejemplo: 1, 2 o 3)"}
 
     # fast-path talla sola (última selección)
@@ -1003,26 +1186,7 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
             if last:
                 lista = _get_sugeridos_list(db, session_id)
                 prod = next((p for p in (lista or []) if p.get("url") == last.get("url") or p.get("nombre") == last.get("nombre")), None) or last
-                tallas = _clean_tallas(prod.get("tallas_disponibles"))
-                if tallas and talla_elegida not in tallas:
-                    return {"response": f"Para «{prod.get('nombre','Producto')}» tengo {', '.join(tallas)}. ¿Quieres elegir una de esas tallas?"}
-                carrito = carrito_load(pedido)
-                carrito = cart_add(
-                    carrito,
-                    sku=prod.get("sku") or prod.get("url") or prod.get("nombre","Producto"),
-                    nombre=prod.get("nombre","Producto"),
-                    categoria=prod.get("categoria",""),
-                    talla=talla_elegida,
-                    color=prod.get("color"),
-                    cantidad=1,
-                    precio_unitario=float(prod.get("precio", 0.0))
-                )
-                carrito_save(db, session_id, carrito)
-                try:
-                    actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-                except Exception:
-                    pass
-                return {"response": "Agregado al carrito ✅\n\n" + "\n".join(cart_summary_lines(carrito))}
+                return _agregar_al_carrito(db, session_id, prod, talla=talla_elegida)
 
     # confirmación corta por contexto
     ctx_tmp = _ctx_load(pedido)
@@ -1030,24 +1194,20 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
         if re.search(r'^(s[ií]|ok|dale|listo|de acuerdo|est(a|á)\s*bien|as(i|í)\s*est(a|á)\s*bien)\b', user_text, re.I):
             actualizar_pedido_por_sesion(db, session_id, "estado", "confirmado")
             pedido_actualizado = obtener_pedido_por_sesion(db, session_id)
-            if not getattr(pedido_actualizado, "numero_confirmacion", None):
-                numero = _gen_numero_confirmacion()
-                actualizar_pedido_por_sesion(db, session_id, "numero_confirmacion", numero)
-                pedido_actualizado = obtener_pedido_por_sesion(db, session_id)
             try:
-                ctx_tmp.pop("awaiting_confirmation", None)
-                _ctx_save(db, session_id, ctx_tmp)
+                _ctx_set(db, session_id, "awaiting_confirmation", None)
             except Exception:
                 pass
             try:
                 enviar_pedido_a_hubspot(pedido_actualizado)
             except Exception as e:
-                print("❌ HubSpot error (confirmación corta):", repr(e))
+                log.error("hubspot.fallido", exc=e, origen="confirmacion_corta")
+            encolar_exportacion_woo(db, pedido_actualizado)
             try:
                 mensaje_alerta = generar_mensaje_atencion_humana(pedido_actualizado)
-                await enviar_mensaje_whatsapp(ALERTA_WHATSAPP, mensaje_alerta)
+                _en_loop(enviar_mensaje_whatsapp, ALERTA_WHATSAPP, mensaje_alerta)
             except Exception as e:
-                print("❌ Error alerta interna (confirmación corta):", repr(e))
+                log.error("alerta.fallida", exc=e, origen="confirmacion_corta")
 
             carrito_ok = carrito_load(pedido_actualizado)
             resumen = "\n".join(cart_summary_lines(carrito_ok))
@@ -1065,7 +1225,7 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
             }
 
     # Manejo de pago/confirmación (router híbrido)
-    resp_pago = await procesar_mensaje_usuario(user_text, db, session_id, pedido)
+    resp_pago = procesar_mensaje_usuario(user_text, db, session_id, pedido)
     if resp_pago:
         return resp_pago
 
@@ -1078,9 +1238,9 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
     if detectar_intencion_atencion(user_text):
         try:
             mensaje_alerta = generar_mensaje_atencion_humana(pedido)
-            await enviar_mensaje_whatsapp(ALERTA_WHATSAPP, mensaje_alerta)
+            _en_loop(enviar_mensaje_whatsapp, ALERTA_WHATSAPP, mensaje_alerta)
         except Exception as e:
-            print("❌ Error alerta humana:", repr(e))
+            log.error("alerta.fallida", exc=e, origen="atencion_humana")
         return {"response": "Entendido, ya te pongo en contacto con uno de nuestros asesores. Te responderán personalmente en breve."}
 
     # Cancelación explícita
@@ -1187,19 +1347,10 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
             cat = None
         consulta = cat or cat_txt
 
-        urls_previas = _get_sugeridos_urls(db, session_id)
-        res = sugerir_productos(consulta, limite=12, excluir_urls=urls_previas)
-        productos = res.get("productos", []) if isinstance(res, dict) else []
+        productos = _buscar_paginado(db, session_id, pedido, consulta, user_text, cat)
         if productos:
-            for p in productos:
-                if isinstance(p, dict) and "tallas_disponibles" in p:
-                    p["tallas_disponibles"] = _clean_tallas(p.get("tallas_disponibles"))
             _remember_list(db, session_id, cat or "", detectar_atributos(cat_txt) or {}, productos)
-            _append_sugeridos_urls(db, session_id, [p["url"] for p in productos if p.get("url")])
-            lines = []
-            for i, pr in enumerate(productos[:3], 1):
-                lines.append(f"{i}. {pr.get('nombre','Producto')} - {fmt_cop(pr.get('precio',0))} - {pr.get('url','')}")
-            return {"response": "Aquí tienes algunas opciones:\n" + "\n".join(lines)}
+            return {"response": "Aquí tienes algunas opciones:\n" + "\n".join(_lineas_productos(productos))}
         cats = "\n- " + "\n- ".join(CATEGORIAS_RESUMEN)
         return {"response": f"No hay stock para «{cat_txt}» en este momento. ¿Te muestro algo de:\n{cats}"}
 
@@ -1212,37 +1363,21 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
         ultima_cat, _ult = _get_ultima_cat_filters(db, session_id)
         consulta = cat or ultima_cat
         if consulta:
-            urls_previas = _get_sugeridos_urls(db, session_id)
-            res = sugerir_productos(consulta, limite=12, excluir_urls=urls_previas)
-            productos = res.get("productos", []) if isinstance(res, dict) else []
+            productos = _buscar_paginado(db, session_id, pedido, consulta, user_text, consulta)
             if productos:
-                for p in productos:
-                    if isinstance(p, dict) and "tallas_disponibles" in p:
-                        p["tallas_disponibles"] = _clean_tallas(p.get("tallas_disponibles"))
                 _set_sugeridos_list(db, session_id, productos)
-                _append_sugeridos_urls(db, session_id, [p["url"] for p in productos if p.get("url")])
-                lines = []
-                for i, pr in enumerate(productos[:3], 1):
-                    lines.append(f"{i}. {pr.get('nombre','Producto')} - {fmt_cop(pr.get('precio',0))} - {pr.get('url','')}")
-                return {"response": "Aquí tienes algunas opciones:\n" + "\n".join(lines)}
+                return {"response": "Aquí tienes algunas opciones:\n" + "\n".join(_lineas_productos(productos))}
         cats = "\n- " + "\n- ".join(CATEGORIAS_RESUMEN)
         return {"response": f"¿Qué te muestro primero?\n{cats}"}
 
     # Más opciones (siguiente página)
     if MAS_OPCIONES_RE.search(user_text):
-        productos_previos = _get_sugeridos_list(db, session_id)
-        if productos_previos:
-            restantes = productos_previos[3:] if len(productos_previos) > 3 else []
+        cursor = _cursor_load(db, session_id)
+        if cursor:
+            restantes = _siguiente_pagina(db, session_id, cursor)
             if restantes:
-                for p in restantes:
-                    if isinstance(p, dict) and "tallas_disponibles" in p:
-                        p["tallas_disponibles"] = _clean_tallas(p.get("tallas_disponibles"))
                 _set_sugeridos_list(db, session_id, restantes)
-                _append_sugeridos_urls(db, session_id, [p["url"] for p in restantes if p.get("url")])
-                lines = []
-                for i, pr in enumerate(restantes[:3], 1):
-                    lines.append(f"{i}. {pr.get('nombre','Producto')} - {fmt_cop(pr.get('precio',0))} - {pr.get('url','')}")
-                return {"response": "Aquí tienes más opciones:\n" + "\n".join(lines)}
+                return {"response": "Aquí tienes más opciones:\n" + "\n".join(_lineas_productos(restantes))}
             return {"response": "Ya te mostré todas las opciones disponibles por ahora. ¿Quieres buscar algo diferente?"}
         return {"response": "Primero dime qué categoría te interesa (p. ej., camisas, jeans, pantalones) y te muestro opciones."}
 
@@ -1265,25 +1400,11 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
             if ADD_RE.search(user_text):
                 if tallas:
                     return {"response": f"Perfecto. Para agregar «{prod.get('nombre','Producto')}» dime la talla ({', '.join(tallas)})."}
-                carrito = carrito_load(pedido)
-                carrito = cart_add(
-                    carrito,
-                    sku=prod.get("sku") or prod.get("url") or prod.get("nombre","Producto"),
-                    nombre=prod.get("nombre","Producto"),
-                    categoria=prod.get("categoria",""),
-                    talla=None,
-                    color=prod.get("color"),
-                    cantidad=1,
-                    precio_unitario=float(prod.get("precio", 0.0))
-                )
-                carrito_save(db, session_id, carrito)
-                actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-                return {"response": "Agregado al carrito ✅\n\n" + "\n".join(cart_summary_lines(carrito))}
+                return _agregar_al_carrito(db, session_id, prod)
             if tallas:
                 return {"response": f"Listo, seleccionaste la opción {idx0+1}. Tallas disponibles: {', '.join(tallas)}. ¿Cuál prefieres?"}
-            ctx_set = _ctx_load(pedido)
-            ctx_set["awaiting_qty"] = {"ref": idx0 + 1, "sku": prod.get("sku") or prod.get("url") or prod.get("nombre")}
-            _ctx_save(db, session_id, ctx_set)
+            pendiente = {"ref": idx0 + 1, "sku": prod.get("sku") or prod.get("url") or prod.get("nombre")}
+            _ctx_set(db, session_id, "awaiting_qty", pendiente)
             return {"response": f"Listo, seleccionaste la opción {idx0+1}. ¿Cuántas unidades deseas?"}
         elif lista:
             return {"response": f"Por favor indícame un número entre 1 y {len(lista)} de la lista que te mostré."}
@@ -1310,34 +1431,17 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
                 if ADD_RE.search(user_text):
                     if tallas:
                         return {"response": f"Perfecto. Para agregar «{prod.get('nombre','Producto')}» necesito la talla: {', '.join(tallas)}. ¿Cuál prefieres?"}
-                    carrito = carrito_load(pedido)
-                    carrito = cart_add(
-                        carrito,
-                        sku=prod.get("sku") or prod.get("url") or prod.get("nombre","Producto"),
-                        nombre=prod.get("nombre","Producto"),
-                        categoria=prod.get("categoria",""),
-                        talla=None,
-                        color=prod.get("color"),
-                        cantidad=1,
-                        precio_unitario=float(prod.get("precio", 0.0))
-                    )
-                    carrito_save(db, session_id, carrito)
-                    try:
-                        actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-                    except Exception:
-                        pass
-                    return {"response": "Agregado al carrito ✅\n\n" + "\n".join(cart_summary_lines(carrito))}
+                    return _agregar_al_carrito(db, session_id, prod)
                 if tallas:
                     return {"response": f"Listo, seleccionaste la opción {idx+1}. Tallas disponibles: {', '.join(tallas)}. ¿Cuál prefieres?"}
-                ctx_set = _ctx_load(pedido)
-                ctx_set["awaiting_qty"] = {"ref": idx + 1, "sku": prod.get("sku") or prod.get("url") or prod.get("nombre")}
-                _ctx_save(db, session_id, ctx_set)
+                pendiente = {"ref": idx + 1, "sku": prod.get("sku") or prod.get("url") or prod.get("nombre")}
+                _ctx_set(db, session_id, "awaiting_qty", pendiente)
                 return {"response": f"Listo, seleccionaste la opción {idx+1}. ¿Cuántas unidades deseas?"}
             if lista:
                 return {"response": f"Por favor indícame un número entre 1 y {len(lista)} de la lista que te mostré."}
 
     # ======= LLM (flujo general) =======
-    resultado = await procesar_conversacion_llm(pedido, user_text)
+    resultado = procesar_conversacion_llm(pedido, user_text)
 
     handled = _handle_action_protocol(resultado, db, session_id, pedido)
     if handled:
@@ -1348,67 +1452,75 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
 
     # Normaliza y aplica acciones
     if "acciones" in resultado and isinstance(resultado["acciones"], list):
-        carrito = carrito_load(pedido)
-        prefs = _prefs_load(pedido)
-        for act in resultado["acciones"]:
+        acciones = [a for a in resultado["acciones"] if isinstance(a, dict)]
+        # add_item / update_qty: stock real y reserva (lo que se suma) antes de tocar el carrito;
+        # lo que no alcanza no se aplica. remove_item suelta su reserva solo si el carrito se escribe.
+        avisos = []
+        apartadas = []
+        en_carrito = carrito_load(pedido) if any((a.get("tipo") or "").strip() == "update_qty" for a in acciones) else []
+        for act in acciones:
+            t = (act.get("tipo") or "").strip()
+            args = act.get("args") or {}
             try:
-                t = (act.get("tipo") or "").strip()
-                args = act.get("args") or {}
-                if t == "add_item":
-                    carrito = cart_add(
-                        carrito,
-                        sku=args["sku"],
-                        nombre=args.get("nombre","Producto"),
-                        categoria=args.get("categoria",""),
-                        talla=args.get("talla"),
-                        color=args.get("color"),
-                        cantidad=int(args.get("cantidad", 1)),
-                        precio_unitario=float(args.get("precio_unitario", 0.0))
-                    )
-                elif t == "update_qty":
-                    carrito = cart_update_qty(
-                        carrito,
-                        sku=args["sku"],
-                        talla=args.get("talla"),
-                        color=args.get("color"),
-                        cantidad=int(args.get("cantidad", 1))
-                    )
-                elif t == "remove_item":
-                    carrito = cart_remove(
-                        carrito,
-                        sku=args["sku"],
-                        talla=args.get("talla"),
-                        color=args.get("color")
-                    )
-                elif t == "remember_pref":
-                    cat = args.get("categoria")
-                    talla = args.get("talla")
-                    color_fav = args.get("color_favorito")
-                    prefs.setdefault("tallas_preferidas", {})
-                    if cat and talla:
-                        prefs["tallas_preferidas"][cat] = talla
-                    if color_fav:
-                        prefs["color_favorito"] = color_fav
-                elif t == "cache_list":
-                    productos = args.get("productos") or []
-                    if isinstance(productos, list) and productos:
-                        for p in productos:
-                            if isinstance(p, dict) and "tallas_disponibles" in p:
-                                p["tallas_disponibles"] = _clean_tallas(p.get("tallas_disponibles"))
-                        try:
-                            _set_sugeridos_list(db, session_id, productos)
-                            _append_sugeridos_urls(db, session_id, [p.get("url") for p in productos if isinstance(p, dict) and p.get("url")])
-                        except Exception:
-                            pass
+                if t in ("add_item", "update_qty"):
+                    cantidad = int(args.get("cantidad", 1) or 1)
+                    extra = cantidad
+                    if t == "update_qty":
+                        actual = next((it.cantidad for it in en_carrito
+                                       if it.es(args["sku"], args.get("talla"), args.get("color"))), None)
+                        if actual is None or cantidad <= actual:
+                            continue   # línea inexistente o baja: no hace falta stock nuevo
+                        extra = cantidad - actual
+                    disp = reservar(db, session_id, args, args.get("talla"), extra)
+                    if disp is not None and not disp.alcanza(extra):
+                        act["tipo"] = f"{t}_sin_stock"
+                        avisos.append(mensaje_no_disponible(disp, args.get("nombre", "Producto"), extra))
+                    else:
+                        apartadas.append(disp)
             except Exception:
                 continue
+        if avisos:
+            resultado["respuesta"] = "\n".join(avisos)
+        tipos = {(a.get("tipo") or "").strip() for a in acciones}
+        for act in acciones:
+            if (act.get("tipo") or "").strip() != "cache_list":
+                continue
+            productos = (act.get("args") or {}).get("productos") or []
+            if isinstance(productos, list) and productos:
+                for p in productos:
+                    if isinstance(p, dict) and "tallas_disponibles" in p:
+                        p["tallas_disponibles"] = _clean_tallas(p.get("tallas_disponibles"))
+                try:
+                    _set_sugeridos_list(db, session_id, productos)
+                    _marcar_vistos(db, session_id, productos)
+                    # "más opciones" sigue esta búsqueda; sus IDs se resuelven al pedirla
+                    _cursor_save(db, session_id, CursorResultados(user_text))
+                except Exception:
+                    pass
 
-        carrito_save(db, session_id, carrito)
-        _prefs_save(db, session_id, prefs)
-        try:
-            actualizar_pedido_por_sesion(db, session_id, "subtotal", cart_total(carrito))
-        except Exception:
-            pass
+        # carrito y preferencias: un solo UPDATE con CAS, reaplicando las acciones si hubo otro escritor
+        if tipos & {"add_item", "update_qty", "remove_item", "remember_pref"}:
+            fallo: List[bool] = []
+
+            def _fallo():
+                fallo.append(True)
+                for d in apartadas:
+                    soltar(db, session_id, d)
+
+            _mutar_sesion(
+                db, session_id,
+                carrito=(lambda c: _acciones_carrito(c, acciones)) if tipos & {"add_item", "update_qty", "remove_item"} else None,
+                prefs=(lambda pr: _acciones_prefs(pr, acciones)) if "remember_pref" in tipos else None,
+                al_fallar=_fallo,
+            )
+            if not fallo:
+                for act in acciones:
+                    if (act.get("tipo") or "").strip() == "remove_item":
+                        args = act.get("args") or {}
+                        try:
+                            liberar(db, session_id, args, args.get("talla"))
+                        except Exception:
+                            continue
 
     # Guardar campos del LLM si llegaron
     campos_dict = resultado.get("campos", {}) or {}
@@ -1455,19 +1567,16 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
 
     if campos_dict.get("estado") == "confirmado":
         pedido_actualizado = obtener_pedido_por_sesion(db, session_id)
-        if not getattr(pedido_actualizado, "numero_confirmacion", None):
-            numero = _gen_numero_confirmacion()
-            actualizar_pedido_por_sesion(db, session_id, "numero_confirmacion", numero)
-            pedido_actualizado = obtener_pedido_por_sesion(db, session_id)
         try:
             enviar_pedido_a_hubspot(pedido_actualizado)
         except Exception as e:
-            print("❌ HubSpot error (estado confirmado):", repr(e))
+            log.error("hubspot.fallido", exc=e, origen="estado_confirmado")
+        encolar_exportacion_woo(db, pedido_actualizado)
         try:
             mensaje_alerta = generar_mensaje_atencion_humana(pedido_actualizado)
-            await enviar_mensaje_whatsapp(ALERTA_WHATSAPP, mensaje_alerta)
+            _en_loop(enviar_mensaje_whatsapp, ALERTA_WHATSAPP, mensaje_alerta)
         except Exception as e:
-            print("❌ Error alerta interna (estado confirmado):", repr(e))
+            log.error("alerta.fallida", exc=e, origen="estado_confirmado")
 
     # Verificador de faltantes (una cosa a la vez, sin repreguntar si ya hay carrito)
     pedido_refresco = obtener_pedido_por_sesion(db, session_id)
@@ -1483,11 +1592,6 @@ async def mensaje_whatsapp(user_input: UserMessage, session_id: str, db: Session
 # -------------------------------------------------------------------
 # Utilidades varias
 # -------------------------------------------------------------------
-def _gen_numero_confirmacion(prefix="CAS"):
-    ts = datetime.now(timezone.utc).strftime("%Y%m%d")
-    suf = "".join(random.choices(string.ascii_uppercase + string.digits, k=4))
-    return f"{prefix}-{ts}-{suf}"
-
 # --- util para asegurar tz-aware en UTC ---
 def _as_aware_utc(dt) -> datetime:
     if isinstance(dt, datetime):
@@ -0,0 +1,113 @@
+# arranque.py
+"""
+Calentamiento de la instancia (lifespan de main.py).
+
+La app empieza a aceptar tráfico de inmediato, pero /__ready responde 503
+hasta que el catálogo esté en memoria: snapshot completo desde disco o, en
+un cold start sin disco, las categorías principales (CATEGORIAS_RESUMEN) y
+sus variaciones traídas en paralelo. Recién ahí arranca el sync periódico.
+Si el calentamiento tarda o falla, ESTADO["degradado"] lo explica y
+"listo" sigue en False mientras se reintenta (WARMUP_INTENTOS, con backoff).
+Agotados los intentos la instancia queda lista pero degradada: lo que no
+está en memoria se atiende con Woo en vivo.
+"""
+import os
+import time
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import catalogo_local
+from catalogo_local import iniciar_sync_periodico as init_catalogo
+from taxonomia import iniciar as init_taxonomia
+
+WARMUP_TIMEOUT_S = float(os.getenv("WARMUP_TIMEOUT_S", "45"))
+WARMUP_MAX_PAGES = int(os.getenv("WARMUP_MAX_PAGES", "2"))   # páginas de 100 por categoría
+WARMUP_INTENTOS = max(1, int(os.getenv("WARMUP_INTENTOS", "5")))
+WARMUP_BACKOFF_S = float(os.getenv("WARMUP_BACKOFF_S", "5"))   # espera inicial entre intentos (se duplica, tope 60 s)
+
+ESTADO: Dict[str, Any] = {"listo": False, "degradado": None, "fase": "arrancando", "intentos": 0}
+
+
+def _categorias_top() -> List[int]:
+    """IDs de las categorías de CATEGORIAS_RESUMEN según la taxonomía vigente (semilla en frío)."""
+    from api_core import CATEGORIAS_RESUMEN
+    from woocommerce_gpt_utils import _taxonomia
+
+    tax = _taxonomia()
+    ids: List[int] = []
+    for texto in CATEGORIAS_RESUMEN:
+        clave, _ = tax.detectar(texto)
+        ids.extend(tax.ids(clave))
+    return list(dict.fromkeys(ids))
+
+
+def _precalentar_catalogo() -> Optional[Dict[str, Any]]:
+    """Un intento de carga del catálogo; None si el espejo está apagado (no hay nada que calentar)."""
+    if not (catalogo_local.CATALOG_MIRROR and catalogo_local._credenciales_ok()):
+        return None
+    ESTADO["fase"] = "catalogo"
+    res = catalogo_local.precalentar(_categorias_top(), max_pages=WARMUP_MAX_PAGES)
+    # Woo devuelve dicts de error en vez de lanzar: sin productos no es un arranque caliente
+    if res.get("error") or not res.get("productos"):
+        raise RuntimeError(f"catálogo vacío: {res.get('error') or res}")
+    return res
+
+
+def _iniciar_sync() -> Dict[str, Any]:
+    ESTADO["fase"] = "sync"
+    return {"sync_periodico": init_catalogo(), "taxonomia_propia": init_taxonomia()}
+
+
+async def _intento(trabajo: "asyncio.Future") -> Any:
+    # Pasado WARMUP_TIMEOUT_S se marca degradado, pero se sigue esperando al mismo hilo
+    try:
+        return await asyncio.wait_for(asyncio.shield(trabajo), WARMUP_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        ESTADO["degradado"] = f"timeout tras {WARMUP_TIMEOUT_S}s"
+        print(f"⚠️  Calentamiento lento ({WARMUP_TIMEOUT_S}s); sigo esperando con /__ready en 503")
+        return await trabajo
+
+
+async def calentar():
+    """
+    Calienta el catálogo en un hilo, con hasta WARMUP_INTENTOS intentos y
+    backoff exponencial. Un error o un catálogo vacío no marcan la instancia
+    lista. Agotados los intentos pasa a lista pero `degradado` (lo que no
+    está en memoria va a Woo en vivo) para no quedar en 503 para siempre.
+    """
+    t0 = time.perf_counter()
+    detalle: Dict[str, Any] = {}
+    espera = WARMUP_BACKOFF_S
+    ultimo_error = None
+    try:
+        for intento in range(1, WARMUP_INTENTOS + 1):
+            ESTADO["intentos"] = intento
+            try:
+                detalle["catalogo"] = await _intento(asyncio.ensure_future(asyncio.to_thread(_precalentar_catalogo)))
+                ultimo_error = None
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                ultimo_error = repr(e)
+                ESTADO["degradado"] = ultimo_error
+                ESTADO["fase"] = "reintentando"
+                print(f"⚠️  Calentamiento fallido (intento {intento}/{WARMUP_INTENTOS}):", ultimo_error)
+                if intento < WARMUP_INTENTOS:
+                    await asyncio.sleep(espera)
+                    espera = min(espera * 2, 60.0)
+        try:
+            detalle.update(await asyncio.to_thread(_iniciar_sync))
+        except Exception as e:
+            ultimo_error = ultimo_error or repr(e)
+            print("⚠️  No pude lanzar el sync periódico:", repr(e))
+        ESTADO["detalle"] = detalle
+        ESTADO["degradado"] = (f"sin catálogo tras {WARMUP_INTENTOS} intentos: {ultimo_error}"
+                               if ultimo_error else None)
+        ESTADO["listo"] = True
+        ESTADO["fase"] = "degradado" if ultimo_error else "listo"
+    finally:
+        ESTADO["duracion_s"] = round(time.perf_counter() - t0, 3)
+        cat = catalogo_local.get_catalogo()
+        ESTADO["productos"] = len(cat) if cat else 0
+        print(f"🔥 Calentamiento terminado: {ESTADO}")
@@ -1,5 +1,83 @@
 # carrito.py
-from typing import List, Optional
+"""
+Motor único de carrito para api_core (WhatsApp) y el agente (/agent/chat).
+
+• Cada línea es un LineaCarrito (__slots__) y el carrito, una lista de ellas.
+• Un solo formato en pedidos.carrito_json (claves de este módulo:
+  sku/nombre/categoria/talla/color/cantidad/precio_unitario). Al leer se
+  aceptan también las líneas viejas del agente (sku/name/size/qty/price).
+• carrito_save escribe carrito y subtotal en un solo UPDATE.
+• carrito_mutar hace load → cambio → save con compare-and-swap sobre
+  pedidos.version: si otro mensaje de la misma sesión escribió entre medio,
+  reaplica el cambio sobre el carrito fresco en vez de pisarlo.
+"""
+import json
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+from sqlalchemy.orm import Session
+from sqlalchemy import text as sa_text
+
+
+class LineaCarrito:
+    __slots__ = ("sku", "nombre", "categoria", "talla", "color", "cantidad", "precio_unitario")
+
+    def __init__(self, sku: str, nombre: str = "Producto", categoria: str = "", talla: Optional[str] = None,
+                 color: Optional[str] = None, cantidad: int = 1, precio_unitario: float = 0.0):
+        self.sku = str(sku)
+        self.nombre = nombre or "Producto"
+        self.categoria = categoria or ""
+        self.talla = talla or None
+        self.color = color or None
+        self.cantidad = max(1, int(cantidad or 1))
+        self.precio_unitario = float(precio_unitario or 0.0)
+
+    def es(self, sku: str, talla: Optional[str] = None, color: Optional[str] = None) -> bool:
+        return self.sku == sku and self.talla == (talla or None) and self.color == (color or None)
+
+    @property
+    def subtotal(self) -> float:
+        return self.precio_unitario * self.cantidad
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "LineaCarrito":
+        return cls(
+            sku=d.get("sku") or d.get("url") or d.get("nombre") or d.get("name") or "SKU",
+            nombre=d.get("nombre") or d.get("name"),
+            categoria=d.get("categoria"),
+            talla=d.get("talla") or d.get("size"),
+            color=d.get("color"),
+            cantidad=d.get("cantidad") or d.get("qty") or 1,
+            precio_unitario=d.get("precio_unitario") or d.get("price") or 0.0,
+        )
+
+
+Carrito = List[LineaCarrito]
+
+
+def cargar_lineas(raw: Union[str, Iterable, None]) -> Carrito:
+    """carrito_json (texto o lista ya parseada, en cualquiera de los dos formatos) → líneas."""
+    try:
+        data = json.loads(raw) if isinstance(raw, str) else (raw or [])
+    except Exception:
+        return []
+    if not isinstance(data, list):
+        return []
+    out: Carrito = []
+    for d in data:
+        try:
+            out.append(d if isinstance(d, LineaCarrito) else LineaCarrito.from_dict(d))
+        except Exception:
+            continue
+    return out
+
+
+def serializar(carrito: Carrito) -> str:
+    return json.dumps([it.to_dict() for it in carrito], ensure_ascii=False, separators=(",", ":"))
+
 
 def fmt_cop(v: float) -> str:
     try:
@@ -7,79 +85,97 @@ def fmt_cop(v: float) -> str:
     except Exception:
         return "$0"
 
-def cart_total(carrito: list) -> float:
-    return sum(float(i.get("precio_unitario", 0.0)) * int(i.get("cantidad", 1)) for i in carrito)
+def cart_total(carrito: Carrito) -> float:
+    return sum(it.subtotal for it in carrito)
 
-def cart_summary_lines(carrito: list) -> List[str]:
+def cart_summary_lines(carrito: Carrito) -> List[str]:
     if not carrito:
         return ["Tu carrito está vacío."]
     lines = []
     for i, it in enumerate(carrito, 1):
-        precio = fmt_cop(it.get('precio_unitario', 0))
-        qty = int(it.get("cantidad", 1))
-        tail = " ".join([x for x in [(it.get("color") or ""), (it.get("talla") or "")] if x]).strip()
+        tail = " ".join(x for x in (it.color, it.talla) if x)
         tail = f" {tail}" if tail else ""
-        lines.append(f"{i}. {it['nombre']} ({it['sku']}){tail} x{qty} – {precio} c/u")
+        lines.append(f"{i}. {it.nombre} ({it.sku}){tail} x{it.cantidad} – {fmt_cop(it.precio_unitario)} c/u")
     lines.append(f"\nTotal: {fmt_cop(cart_total(carrito))}")
     return lines
 
-def item_exists(carrito: list, sku: str, talla: str = None, color: str = None) -> bool:
-    return any(i for i in carrito if i["sku"] == sku and i.get("talla") == talla and i.get("color") == color)
+def item_exists(carrito: Carrito, sku: str, talla: str = None, color: str = None) -> bool:
+    return any(it.es(sku, talla, color) for it in carrito)
 
-def cart_add(carrito: list, sku: str, nombre: str, categoria: str,
+def cart_add(carrito: Carrito, sku: str, nombre: str, categoria: str = "",
              talla: str = None, color: str = None, cantidad: int = 1,
-             precio_unitario: float = 0.0):
-    for item in carrito:
-        if item["sku"] == sku and item.get("talla") == talla and item.get("color") == color:
-            item["cantidad"] = max(1, int(item.get("cantidad", 1))) + max(1, int(cantidad))
+             precio_unitario: float = 0.0) -> Carrito:
+    for it in carrito:
+        if it.es(sku, talla, color):
+            it.cantidad += max(1, int(cantidad or 1))
             return carrito
-    carrito.append({
-        "sku": sku, "nombre": nombre, "categoria": categoria,
-        "talla": talla, "color": color, "cantidad": max(1, int(cantidad)),
-        "precio_unitario": float(precio_unitario)
-    })
+    carrito.append(LineaCarrito(sku, nombre, categoria, talla, color, cantidad, precio_unitario))
     return carrito
 
-def cart_update_qty(carrito: list, sku: str, talla: str = None, color: str = None, cantidad: int = 1):
-    for item in carrito:
-        if item["sku"] == sku and item.get("talla") == talla and item.get("color") == color:
-            item["cantidad"] = max(1, int(cantidad))
+def cart_update_qty(carrito: Carrito, sku: str, talla: str = None, color: str = None, cantidad: int = 1) -> Carrito:
+    for it in carrito:
+        if it.es(sku, talla, color):
+            it.cantidad = max(1, int(cantidad or 1))
             return carrito
     return carrito
 
-def cart_remove(carrito: list, sku: str, talla: str = None, color: str = None):
-    return [i for i in carrito if not (i["sku"] == sku and i.get("talla") == talla and i.get("color") == color)]
+def cart_remove(carrito: Carrito, sku: str, talla: str = None, color: str = None) -> Carrito:
+    return [it for it in carrito if not it.es(sku, talla, color)]
 
-# Persistencia (las funciones siguientes dependen de tu tabla "pedidos")
-from sqlalchemy.orm import Session
-from sqlalchemy import text as sa_text
 
-def carrito_load(pedido) -> list:
+# Persistencia (tabla "pedidos")
+def carrito_load(pedido) -> Carrito:
     try:
+        from database import session_scope
         sid = pedido.session_id
-        db = Session.object_session(pedido) or None
-        if db is None:
-            # Fallback: abre una nueva sesión si lo prefieres
-            from database import SessionLocal
-            db = SessionLocal()
-            close_after = True
-        else:
-            close_after = False
-        row = db.execute(sa_text("SELECT carrito_json FROM pedidos WHERE session_id=:sid"), {"sid": sid}).fetchone()
-        if close_after:
-            db.close()
-        import json
-        raw = row[0] if row and row[0] else "[]"
-        data = json.loads(raw) if raw else []
-        return data if isinstance(data, list) else []
+        # Sesión del pedido o la del request; solo fuera de request abre una propia
+        with session_scope(pedido) as db:
+            row = db.execute(sa_text("SELECT carrito_json FROM pedidos WHERE session_id=:sid"), {"sid": sid}).fetchone()
+        return cargar_lineas(row[0] if row and row[0] else "[]")
     except Exception:
         return []
 
-def carrito_save(db: Session, session_id: str, carrito: list):
-    import json
+def carrito_load_sesion(db: Session, session_id: str) -> Carrito:
+    try:
+        row = db.execute(sa_text("SELECT carrito_json FROM pedidos WHERE session_id=:sid"), {"sid": session_id}).fetchone()
+        return cargar_lineas(row[0] if row and row[0] else "[]")
+    except Exception:
+        return []
+
+def cambios_carrito(carrito: Carrito) -> Dict[str, Any]:
+    """Columnas que escribe un carrito (para sumarlas a otra mutación de la misma fila)."""
+    return {"carrito_json": serializar(carrito), "subtotal": cart_total(carrito),
+            "last_activity": datetime.now(timezone.utc)}
+
+def carrito_save(db: Session, session_id: str, carrito: Carrito):
+    """Carrito, subtotal y last_activity en una sola sentencia (escritura ciega: reemplaza el carrito)."""
+    from version_pedido import escribir_pedido
+    try:
+        escribir_pedido(db, session_id, cambios_carrito(carrito))
+    except Exception:
+        db.rollback()
+
+def carrito_mutar(db: Session, session_id: str, mutar: Callable[[Carrito], Carrito],
+                  al_fallar: Optional[Callable[[], None]] = None) -> Carrito:
+    """
+    Aplica `mutar` al carrito guardado y lo escribe con CAS (ver version_pedido.py).
+    `mutar` puede correr más de una vez si hay otro escritor: no debe tener otros efectos.
+    Devuelve el carrito como quedó escrito; si no se pudo escribir, llama `al_fallar`
+    y devuelve el guardado.
+    """
+    from version_pedido import mutar_pedido
+    resultado: List[Carrito] = []
+
+    def _m(valores: Dict[str, Any]) -> Dict[str, Any]:
+        carrito = mutar(cargar_lineas(valores["carrito_json"] or "[]"))
+        resultado[:] = [carrito]
+        return cambios_carrito(carrito)
+
     try:
-        db.execute(sa_text("UPDATE pedidos SET carrito_json=:j WHERE session_id=:sid"),
-                   {"j": json.dumps(carrito, ensure_ascii=False), "sid": session_id})
-        db.commit()
+        if mutar_pedido(db, session_id, ("carrito_json",), _m) is not None and resultado:
+            return resultado[0]
     except Exception:
         db.rollback()
+    if al_fallar is not None:
+        al_fallar()
+    return carrito_load_sesion(db, session_id)
@@ -0,0 +1,910 @@
+# catalogo_local.py — v1.0
+"""
+Espejo local del catálogo WooCommerce.
+
+• Sync completo paginado (woocommerce_client.get_all_products con max_pages)
+  y luego incremental con modified_after; las variaciones se traen en paralelo
+  solo para los productos que cambiaron.
+• Persistencia en una SQLite propia (CATALOG_DB_PATH): al reiniciar, la
+  instancia arranca con el último catálogo sin esperar a Woo.
+• Snapshot inmutable en memoria (Catalogo) para las consultas del bot: sin
+  I/O por mensaje y con todo el catálogo, no solo la primera página.
+"""
+from __future__ import annotations
+import os
+import json
+import time
+import hashlib
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urlsplit
+
+from sqlalchemy import create_engine, event, delete, select
+from sqlalchemy.orm import Session, sessionmaker
+
+import woocommerce_client as wc
+from indice_busqueda import IndiceTexto
+from facetas import Facetas, calcular_facetas, color_canonico
+from ranking import stock_de
+from models import (
+    CatalogBase,
+    ProductoCatalogo,
+    VariacionCatalogo,
+    CategoriaCatalogo,
+    ProductoCategoria,
+    AtributoCatalogo,
+    MetaCatalogo,
+)
+
+# ======== Configuración ========
+IN_CLOUD_RUN = "K_SERVICE" in os.environ or "K_REVISION" in os.environ
+CATALOG_DB_PATH = os.getenv("CATALOG_DB_PATH", "/tmp/catalogo.db" if IN_CLOUD_RUN else "./catalogo.db")
+CATALOG_MIRROR = os.getenv("CATALOG_MIRROR", "1") == "1"
+CATALOG_SYNC_MINUTES = float(os.getenv("CATALOG_SYNC_MINUTES", "15"))
+CATALOG_FULL_SYNC_HOURS = float(os.getenv("CATALOG_FULL_SYNC_HOURS", "24"))
+CATALOG_MAX_PAGES = int(os.getenv("CATALOG_MAX_PAGES", "50"))   # 50 × 100 = 5.000 productos
+CATALOG_WORKERS = int(os.getenv("CATALOG_WORKERS", "8"))        # fetch concurrente de variaciones
+
+engine_catalogo = create_engine(
+    f"sqlite:///{CATALOG_DB_PATH}",
+    connect_args={"check_same_thread": False},
+    future=True,
+)
+
+@event.listens_for(engine_catalogo, "connect")
+def _set_sqlite_pragmas(dbapi_conn, connection_record):  # type: ignore
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL;")
+    cur.execute("PRAGMA synchronous=NORMAL;")
+    cur.execute("PRAGMA busy_timeout=30000;")
+    cur.close()
+
+SessionCatalogo = sessionmaker(bind=engine_catalogo, autoflush=False, expire_on_commit=False, future=True)
+
+_TALLA_ATTRS = {"talla", "tallas", "size", "pa_talla"}
+_COLOR_ATTRS = {"color", "colores", "pa_color"}
+
+
+def _precio(val) -> float:
+    try:
+        return float(val) if val not in (None, "") else 0.0
+    except Exception:
+        return 0.0
+
+
+def _en_stock(item: dict) -> bool:
+    return str(item.get("stock_status", "instock")) == "instock" and _precio(item.get("price")) > 0
+
+
+def _opcion_variacion(v: dict, nombres: set) -> Optional[str]:
+    for a in v.get("attributes") or []:
+        if str(a.get("name", "")).strip().lower() in nombres:
+            return a.get("option")
+    return None
+
+
+def talla_de_variacion(v: dict) -> Optional[str]:
+    """Talla de una variación: atributo Talla/Size o, si no hay, el primero (como hacía get_variaciones)."""
+    talla = _opcion_variacion(v, _TALLA_ATTRS)
+    if talla:
+        return talla
+    attrs = v.get("attributes") or []
+    return attrs[0].get("option") if attrs else None
+
+
+def color_de_variacion(v: dict) -> Optional[str]:
+    return _opcion_variacion(v, _COLOR_ATTRS)
+
+
+def campos_de_texto(p: dict) -> List[str]:
+    """Campos indexados de un producto; cada uno por separado para que las frases no crucen campos."""
+    campos = [p.get("name") or ""]
+    campos += [c.get("name") or "" for c in p.get("categories") or []]
+    campos += [t.get("name") or "" for t in p.get("tags") or []]
+    for a in p.get("attributes") or []:
+        campos.append(f"{a.get('name') or ''} {a.get('option') or ''}".strip())
+        campos += [str(o) for o in a.get("options") or []]
+    return [c for c in campos if c]
+
+
+def sku_sintetico(url: Optional[str], name: str) -> str:
+    """SKU estable que el agente usa para el carrito: hash del permalink (o del nombre)."""
+    base = (url or name or "SKU").encode("utf-8")
+    return "SKU-" + hashlib.sha1(base).hexdigest()[:10].upper()
+
+
+def clave_url(url: Optional[str]) -> str:
+    """Permalink comparable: sin esquema, www, query ni barra final."""
+    u = urlsplit((url or "").strip().lower())
+    host = u.netloc[4:] if u.netloc.startswith("www.") else u.netloc
+    return f"{host}{u.path.rstrip('/')}" if host else u.path.strip("/")
+
+
+def _claves_de_producto(p: dict, variaciones: Iterable[dict]) -> tuple:
+    """
+    (claves, permalink) con los que se puede pedir un producto: SKU de Woo, el
+    sintético y, por cada variación, su SKU y su ID (el agente a veces manda ese).
+    """
+    skus = {sku_sintetico(p.get("permalink"), p.get("name") or "Producto")}
+    if p.get("sku"):
+        skus.add(str(p["sku"]).strip().upper())
+    for v in variaciones:
+        if v.get("sku"):
+            skus.add(str(v["sku"]).strip().upper())
+        if v.get("id"):
+            skus.add(str(v["id"]))
+    return skus, clave_url(p.get("permalink"))
+
+
+def _credenciales_ok() -> bool:
+    return bool(wc.WC_CONSUMER_KEY and wc.WC_CONSUMER_SECRET and wc.WC_API_URL.strip("/"))
+
+
+# ======================================================================
+# Snapshot en memoria
+# ======================================================================
+class Catalogo:
+    """
+    Vista inmutable del catálogo. Se reemplaza entera tras cada sync, así los
+    lectores nunca necesitan locks.
+    """
+
+    __slots__ = (
+        "productos", "orden", "por_categoria", "variaciones", "variaciones_ts", "categorias", "version", "version_categorias",
+        "indice", "facetas", "pos", "bits_stock", "bits_sin_tallas", "bits_categoria", "bits_faceta", "parcial",
+        "col_precio", "col_ventas", "col_stock", "por_sku", "por_url",
+    )
+
+    def __init__(
+        self,
+        productos: Dict[int, dict],
+        orden: List[int],
+        por_categoria: Dict[int, List[int]],
+        variaciones: Dict[int, List[dict]],
+        variaciones_ts: Dict[int, float],
+        categorias: Dict[int, dict],
+        version: int,
+        parcial: Optional[frozenset] = None,
+    ):
+        self.productos = productos            # id -> producto Woo (dict)
+        self.orden = orden                    # ids en el orden de Woo (más nuevos primero)
+        self.por_categoria = por_categoria    # category_id -> ids (mismo orden)
+        self.variaciones = variaciones        # product_id -> variaciones Woo
+        self.variaciones_ts = variaciones_ts  # product_id -> epoch del último dato de stock (producto o variaciones)
+        self.categorias = categorias          # category_id -> {id, name, slug, parent, count}
+        self.version = version
+        # Solo cambia si cambian las categorías (no con cada parche de productos): clave de la taxonomía
+        self.version_categorias = hash(tuple(sorted(
+            (cid, c.get("name"), c.get("slug"), c.get("parent")) for cid, c in categorias.items()
+        )))
+        self.parcial = parcial                # None = catálogo completo; si no, categorías precalentadas
+        self.indice = IndiceTexto()           # texto completo: nombre, categorías, etiquetas, atributos
+        self.facetas: Dict[int, Facetas] = {}
+
+        # Bitsets (int de Python) sobre la posición de cada producto en 'orden':
+        # filtrar = unos cuantos AND y decodificar los bits en orden de catálogo.
+        self.pos: Dict[int, int] = {pid: i for i, pid in enumerate(orden)}
+        self.bits_stock = 0                   # producto en stock y con precio
+        self.bits_sin_tallas = 0              # sin variaciones: un filtro de talla no lo descarta
+        self.bits_faceta: Dict[tuple, int] = {}   # ("color", "azul") -> bits
+        # Columnas por posición para el ranking (ranking.py): precio, total_sales, unidades en stock
+        self.col_precio = array("d", bytes(8 * len(orden)))
+        self.col_ventas = array("d", bytes(8 * len(orden)))
+        self.col_stock = array("d", bytes(8 * len(orden)))
+        # Búsqueda directa para get_product: SKU (Woo o sintético) y permalink -> id
+        self.por_sku: Dict[str, int] = {}
+        self.por_url: Dict[str, int] = {}
+        for pid in orden:
+            self._indexar(pid)
+        self.bits_categoria: Dict[int, int] = {cid: self.bits_de_ids(ids) for cid, ids in por_categoria.items()}
+
+    # ---------- construcción / parches ----------
+    def _indexar(self, pid: int):
+        """Texto, facetas y bits (salvo categoría) de un producto ya presente en productos/pos."""
+        p = self.productos[pid]
+        i = self.pos[pid]
+        bit = 1 << i
+        self.indice.agregar(pid, campos_de_texto(p))
+        variaciones = self.variaciones.get(pid, ())
+        en_stock = [v for v in variaciones if _en_stock(v)]
+        f = self.facetas[pid] = calcular_facetas(p, [talla_de_variacion(v) for v in en_stock])
+        for col in (self.col_precio, self.col_ventas, self.col_stock):
+            if len(col) <= i:
+                col.extend([0.0] * (i + 1 - len(col)))
+        self.col_precio[i] = _precio(p.get("price"))
+        self.col_ventas[i] = float(p.get("total_sales") or 0)
+        self.col_stock[i] = stock_de(p, en_stock if variaciones else None)
+        skus, url = _claves_de_producto(p, variaciones)
+        for sku in skus:
+            self.por_sku[sku] = pid
+        if url:
+            self.por_url[url] = pid
+        if _en_stock(p):
+            self.bits_stock |= bit
+        if not variaciones:
+            self.bits_sin_tallas |= bit
+        for clave in f.items():
+            self.bits_faceta[clave] = self.bits_faceta.get(clave, 0) | bit
+
+    def _desindexar(self, pid: int):
+        bit = 1 << self.pos[pid]
+        self.indice.quitar(pid)
+        skus, url = _claves_de_producto(self.productos[pid], self.variaciones.get(pid, ()))
+        for sku in skus:
+            if self.por_sku.get(sku) == pid:
+                del self.por_sku[sku]
+        if self.por_url.get(url) == pid:
+            del self.por_url[url]
+        f = self.facetas.pop(pid, None)
+        for clave in (f.items() if f else ()):
+            self.bits_faceta[clave] &= ~bit
+        self.bits_stock &= ~bit
+        self.bits_sin_tallas &= ~bit
+        for cid, bits in self.bits_categoria.items():
+            if bits & bit:
+                self.bits_categoria[cid] = bits & ~bit
+                self.por_categoria[cid] = [i for i in self.por_categoria.get(cid, ()) if i != pid]
+
+    def parchear(
+        self,
+        productos: Dict[int, Optional[dict]],
+        variaciones: Dict[int, List[dict]],
+        version: int,
+    ) -> "Catalogo":
+        """
+        Nuevo snapshot con solo estos productos cambiados (None = borrado) y/o
+        sus variaciones reemplazadas; el resto se comparte con el actual.
+        Los productos nuevos van al final del orden hasta el próximo sync.
+        """
+        nuevo = Catalogo.__new__(Catalogo)
+        nuevo.productos = dict(self.productos)
+        nuevo.orden = list(self.orden)
+        nuevo.por_categoria = dict(self.por_categoria)
+        nuevo.variaciones = dict(self.variaciones)
+        nuevo.variaciones_ts = dict(self.variaciones_ts)
+        nuevo.categorias = self.categorias
+        nuevo.version = version
+        nuevo.version_categorias = self.version_categorias
+        nuevo.parcial = self.parcial
+        nuevo.indice = self.indice.copia()
+        nuevo.facetas = dict(self.facetas)
+        nuevo.pos = dict(self.pos)
+        nuevo.bits_stock = self.bits_stock
+        nuevo.bits_sin_tallas = self.bits_sin_tallas
+        nuevo.bits_faceta = dict(self.bits_faceta)
+        nuevo.bits_categoria = dict(self.bits_categoria)
+        nuevo.col_precio = array("d", self.col_precio)
+        nuevo.col_ventas = array("d", self.col_ventas)
+        nuevo.col_stock = array("d", self.col_stock)
+        nuevo.por_sku = dict(self.por_sku)
+        nuevo.por_url = dict(self.por_url)
+
+        ahora = time.time()
+        for pid in set(productos) | set(variaciones):
+            if pid in nuevo.pos and pid in nuevo.productos:
+                nuevo._desindexar(pid)
+            if pid in productos:
+                p = productos[pid]
+                if p is None:
+                    nuevo.productos.pop(pid, None)
+                    nuevo.variaciones.pop(pid, None)
+                    nuevo.variaciones_ts.pop(pid, None)
+                    continue
+                nuevo.productos[pid] = p
+                nuevo.variaciones_ts[pid] = ahora
+            if pid not in nuevo.productos:
+                continue   # variaciones de un producto que el espejo no conoce
+            if pid in variaciones:
+                nuevo.variaciones[pid] = variaciones[pid]
+                nuevo.variaciones_ts[pid] = ahora
+            if pid not in nuevo.pos:
+                nuevo.pos[pid] = len(nuevo.orden)
+                nuevo.orden.append(pid)
+            nuevo._indexar(pid)
+            bit = 1 << nuevo.pos[pid]
+            for cid in {int(c["id"]) for c in nuevo.productos[pid].get("categories") or [] if c.get("id")}:
+                nuevo.bits_categoria[cid] = nuevo.bits_categoria.get(cid, 0) | bit
+                nuevo.por_categoria[cid] = [*nuevo.por_categoria.get(cid, ()), pid]
+        return nuevo
+
+    def __len__(self) -> int:
+        return len(self.productos)
+
+    def cubre(self, category_ids: Iterable[int]) -> bool:
+        """False si el snapshot es parcial (arranque en frío) y le falta alguna de estas categorías."""
+        return self.parcial is None or all(cid in self.parcial for cid in category_ids)
+
+    # ---------- bitsets ----------
+    def bits_de_ids(self, ids: Iterable[int]) -> int:
+        pos, bits = self.pos, 0
+        for pid in ids:
+            i = pos.get(pid)
+            if i is not None:
+                bits |= 1 << i
+        return bits
+
+    def ids_de_bits(self, bits: int) -> Iterator[int]:
+        """IDs de los bits encendidos, del más nuevo al más viejo (orden de catálogo)."""
+        orden = self.orden
+        while bits:
+            bajo = bits & -bits
+            yield orden[bajo.bit_length() - 1]
+            bits ^= bajo
+
+    def bits_de_facetas(self, attrs: Dict[str, Optional[str]]) -> int:
+        """AND de las facetas pedidas (manga, subtipo, uso, color, talla); -1 (todo) si no hay ninguna."""
+        bits = -1
+        for faceta in ("manga", "subtipo", "uso"):
+            if attrs.get(faceta):
+                bits &= self.bits_faceta.get((faceta, str(attrs[faceta]).lower()), 0)
+        if attrs.get("color"):
+            bits &= self.bits_faceta.get(("color", color_canonico(attrs["color"])), 0)
+        if attrs.get("talla"):
+            # talla con variación en stock, o producto sin variaciones (no aplica)
+            bits &= self.bits_faceta.get(("talla", str(attrs["talla"]).upper()), 0) | self.bits_sin_tallas
+        return bits
+
+    # ---------- consultas ----------
+    def bits_de_categorias(self, category_ids: Iterable[int]) -> int:
+        bits = 0
+        for cid in category_ids:
+            bits |= self.bits_categoria.get(cid, 0)
+        return bits
+
+    def hay_stock(self, category_ids: Iterable[int]) -> bool:
+        return bool(self.bits_de_categorias(category_ids) & self.bits_stock)
+
+    def productos_en_stock(self, category_id: int) -> List[dict]:
+        prods = self.productos
+        return [prods[i] for i in self.ids_de_bits(self.bits_categoria.get(category_id, 0) & self.bits_stock)]
+
+    def variaciones_en_stock(self, product_id: int) -> Optional[List[dict]]:
+        if product_id not in self.productos:
+            return None
+        return [v for v in self.variaciones.get(product_id, ()) if _en_stock(v)]
+
+    def consultar(
+        self,
+        category_ids: Optional[Iterable[int]] = None,
+        ids: Optional[Iterable[int]] = None,
+        attrs: Optional[Dict[str, Optional[str]]] = None,
+        incluye: Iterable[str] = (),
+        excluye: Iterable[str] = (),
+    ) -> Iterator[dict]:
+        """
+        Productos en stock que cumplen todo lo pedido, en orden de catálogo:
+        categorías (cualquiera de ellas), universo de IDs (p. ej. de una búsqueda de texto), facetas
+        y palabras clave a incluir (alguna) / excluir (todas).
+        """
+        bits = self.bits_stock
+        if category_ids is not None:
+            bits &= self.bits_de_categorias(category_ids)
+        if ids is not None:
+            bits &= self.bits_de_ids(ids)
+        if attrs:
+            bits &= self.bits_de_facetas(attrs)
+        if incluye and bits:
+            bits &= self.bits_de_ids(self.indice.alguno(incluye))
+        if excluye and bits:
+            bits &= ~self.bits_de_ids(self.indice.alguno(excluye))
+        prods = self.productos
+        return (prods[pid] for pid in self.ids_de_bits(bits))
+
+    def resolver(self, ref: str) -> Optional[int]:
+        """ID del producto a partir de un ID de Woo (producto o variación), un SKU o un permalink."""
+        ref = (ref or "").strip()
+        if not ref:
+            return None
+        if ref.isdigit():
+            pid = int(ref)
+            return pid if pid in self.productos else self.por_sku.get(ref)
+        if "/" in ref:
+            return self.por_url.get(clave_url(ref))
+        return self.por_sku.get(ref.upper())
+
+    def buscar(self, consulta: str, flexible: bool = False, limite: Optional[int] = None) -> List[dict]:
+        """Productos en stock que casan con la consulta de texto, en el orden del catálogo (todas las categorías)."""
+        out = self.consultar(ids=self.indice.buscar(consulta, flexible=flexible))
+        return list(islice(out, limite) if limite else out)
+
+
+_CATALOGO: Optional[Catalogo] = None
+_version = 0
+_sync_lock = threading.Lock()
+_swap_lock = threading.Lock()   # serializa los reemplazos de _CATALOGO (sync completo vs. parches)
+_thread: Optional[threading.Thread] = None
+
+
+def get_catalogo() -> Optional[Catalogo]:
+    return _CATALOGO
+
+
+def catalogo_listo() -> bool:
+    return _CATALOGO is not None and len(_CATALOGO) > 0
+
+
+def productos_por_categoria(category_id: int) -> Optional[List[dict]]:
+    """Productos en stock de la categoría, o None si el espejo aún no está listo."""
+    cat = _CATALOGO
+    if cat is None or not len(cat):
+        return None
+    return cat.productos_en_stock(category_id)
+
+
+def variaciones_en_stock(product_id: int) -> Optional[List[dict]]:
+    """Variaciones en stock del producto, o None si el espejo no lo conoce."""
+    cat = _CATALOGO
+    if cat is None:
+        return None
+    return cat.variaciones_en_stock(product_id)
+
+
+# ======================================================================
+# Persistencia SQLite
+# ======================================================================
+def init_catalogo_db() -> None:
+    CatalogBase.metadata.create_all(bind=engine_catalogo)
+
+
+def _meta_get(s: Session, clave: str) -> Optional[str]:
+    row = s.get(MetaCatalogo, clave)
+    return row.valor if row else None
+
+
+def _meta_set(s: Session, clave: str, valor: str):
+    s.merge(MetaCatalogo(clave=clave, valor=valor))
+
+
+def _borrar_producto(s: Session, pid: int):
+    s.execute(delete(ProductoCatalogo).where(ProductoCatalogo.id == pid))
+    s.execute(delete(VariacionCatalogo).where(VariacionCatalogo.product_id == pid))
+    s.execute(delete(ProductoCategoria).where(ProductoCategoria.product_id == pid))
+    s.execute(delete(AtributoCatalogo).where(AtributoCatalogo.product_id == pid))
+
+
+def _guardar_variaciones(s: Session, pid: int, variaciones: List[dict], ahora: datetime):
+    s.execute(delete(VariacionCatalogo).where(VariacionCatalogo.product_id == pid))
+    for v in variaciones:
+        if not v.get("id"):
+            continue
+        s.add(VariacionCatalogo(
+            id=int(v["id"]),
+            product_id=pid,
+            sku=v.get("sku") or None,
+            talla=talla_de_variacion(v),
+            color=_opcion_variacion(v, _COLOR_ATTRS),
+            precio=_precio(v.get("price")),
+            stock_status=v.get("stock_status"),
+            stock_quantity=v.get("stock_quantity"),
+            modificado=v.get("date_modified_gmt"),
+            data=json.dumps(v, ensure_ascii=False),
+            sincronizado=ahora,
+        ))
+
+
+def _guardar_producto(s: Session, p: dict, ahora: datetime):
+    pid = int(p["id"])
+    if str(p.get("status", "publish")) != "publish":
+        _borrar_producto(s, pid)
+        return
+    s.merge(ProductoCatalogo(
+        id=pid,
+        nombre=p.get("name") or "",
+        slug=p.get("slug"),
+        permalink=p.get("permalink"),
+        sku=p.get("sku") or None,
+        tipo=p.get("type"),
+        precio=_precio(p.get("price")),
+        stock_status=p.get("stock_status"),
+        stock_quantity=p.get("stock_quantity"),
+        total_sales=int(p.get("total_sales") or 0),
+        creado=p.get("date_created_gmt"),
+        modificado=p.get("date_modified_gmt"),
+        data=json.dumps(p, ensure_ascii=False),
+        sincronizado=ahora,
+    ))
+    s.execute(delete(ProductoCategoria).where(ProductoCategoria.product_id == pid))
+    for c in {int(c["id"]) for c in p.get("categories") or [] if c.get("id")}:
+        s.add(ProductoCategoria(product_id=pid, category_id=c))
+    s.execute(delete(AtributoCatalogo).where(AtributoCatalogo.product_id == pid))
+    pares = {
+        (str(a.get("name") or "")[:128], str(opt)[:128])
+        for a in p.get("attributes") or []
+        for opt in a.get("options") or []
+    }
+    for nombre, opcion in pares:
+        s.add(AtributoCatalogo(product_id=pid, nombre=nombre, opcion=opcion))
+    if p.get("type") != "variable":
+        s.execute(delete(VariacionCatalogo).where(VariacionCatalogo.product_id == pid))
+
+
+def _guardar_categorias(s: Session, categorias: List[dict]):
+    s.execute(delete(CategoriaCatalogo))
+    for c in categorias:
+        if not c.get("id"):
+            continue
+        s.add(CategoriaCatalogo(
+            id=int(c["id"]),
+            nombre=c.get("name") or "",
+            slug=c.get("slug"),
+            parent=int(c.get("parent") or 0),
+            count=int(c.get("count") or 0),
+        ))
+
+
+def _cargar_desde_db() -> Catalogo:
+    global _version
+    with SessionCatalogo() as s:
+        filas = s.execute(
+            select(ProductoCatalogo.id, ProductoCatalogo.data, ProductoCatalogo.sincronizado)
+            .order_by(ProductoCatalogo.creado.desc(), ProductoCatalogo.id.desc())
+        ).all()
+        productos: Dict[int, dict] = {}
+        orden: List[int] = []
+        # Antigüedad del stock: la del producto (simples) o la de sus variaciones, la más nueva
+        variaciones_ts: Dict[int, float] = {}
+        for pid, data, sinc in filas:
+            try:
+                productos[pid] = json.loads(data)
+                orden.append(pid)
+            except Exception:
+                continue
+            if sinc is not None:
+                variaciones_ts[pid] = (sinc if sinc.tzinfo else sinc.replace(tzinfo=timezone.utc)).timestamp()
+        pos = {pid: i for i, pid in enumerate(orden)}
+
+        por_categoria: Dict[int, List[int]] = {}
+        for pid, cid in s.execute(select(ProductoCategoria.product_id, ProductoCategoria.category_id)):
+            if pid in pos:
+                por_categoria.setdefault(cid, []).append(pid)
+        for ids in por_categoria.values():
+            ids.sort(key=pos.__getitem__)
+
+        variaciones: Dict[int, List[dict]] = {}
+        for pid, data, sinc in s.execute(
+            select(VariacionCatalogo.product_id, VariacionCatalogo.data, VariacionCatalogo.sincronizado)
+            .order_by(VariacionCatalogo.product_id, VariacionCatalogo.id)
+        ):
+            try:
+                variaciones.setdefault(pid, []).append(json.loads(data))
+            except Exception:
+                continue
+            if sinc is not None:
+                ts = (sinc if sinc.tzinfo else sinc.replace(tzinfo=timezone.utc)).timestamp()
+                variaciones_ts[pid] = max(ts, variaciones_ts.get(pid, 0.0))
+
+        categorias = {
+            c.id: {"id": c.id, "name": c.nombre, "slug": c.slug, "parent": c.parent, "count": c.count}
+            for c in s.execute(select(CategoriaCatalogo)).scalars()
+        }
+
+        parcial = None
+        if not _meta_get(s, "ultima_sync_completa"):
+            parcial = frozenset(json.loads(_meta_get(s, "precalentadas") or "[]"))
+
+    _version += 1
+    return Catalogo(productos, orden, por_categoria, variaciones, variaciones_ts, categorias, _version, parcial)
+
+
+def recargar() -> Catalogo:
+    """Reconstruye el snapshot en memoria desde la SQLite local."""
+    global _CATALOGO
+    init_catalogo_db()
+    with _swap_lock:
+        _CATALOGO = _cargar_desde_db()
+    return _CATALOGO
+
+
+# ======================================================================
+# Cambios puntuales (webhooks de WooCommerce)
+# ======================================================================
+def aplicar_cambios(
+    productos: Optional[Dict[int, Optional[dict]]] = None,
+    variaciones: Optional[Dict[int, List[dict]]] = None,
+) -> Dict[str, Any]:
+    """
+    Persiste y publica cambios de unos pocos productos sin sync completo.
+    productos: id -> producto Woo (None = borrado); variaciones: id -> lista completa.
+    """
+    global _CATALOGO, _version
+    productos = dict(productos or {})
+    variaciones = dict(variaciones or {})
+    if not productos and not variaciones:
+        return {"productos": 0, "variaciones": 0}
+    ahora = datetime.now(timezone.utc)
+    init_catalogo_db()
+    with SessionCatalogo() as s:
+        for pid, p in productos.items():
+            if p is None:
+                _borrar_producto(s, pid)
+            else:
+                _guardar_producto(s, p, ahora)
+        for pid, vs in variaciones.items():
+            _guardar_variaciones(s, pid, vs, ahora)
+        s.commit()
+
+    # Mismo criterio que _guardar_producto: lo no publicado sale del espejo; lo no variable no tiene variaciones
+    for pid, p in list(productos.items()):
+        if p is not None and str(p.get("status", "publish")) != "publish":
+            productos[pid] = None
+        elif p is not None and p.get("type") != "variable":
+            variaciones.setdefault(pid, [])
+    with _swap_lock:
+        if _CATALOGO is not None:
+            _version += 1
+            _CATALOGO = _CATALOGO.parchear(productos, variaciones, _version)
+    return {"productos": len(productos), "variaciones": sum(len(v) for v in variaciones.values())}
+
+
+def aplicar_variacion(v: dict) -> Dict[str, Any]:
+    """Reemplaza (o agrega) una variación dentro de la lista de su producto padre."""
+    cat = _CATALOGO
+    pid = int(v.get("parent_id") or 0)
+    if not pid or cat is None or pid not in cat.productos:
+        return {"ignorado": "producto padre desconocido"}
+    vid = v.get("id")
+    lista = [x for x in cat.variaciones.get(pid, ()) if x.get("id") != vid]
+    lista.append(v)
+    lista.sort(key=lambda x: int(x.get("id") or 0))
+    return aplicar_cambios(variaciones={pid: lista})
+
+
+def quitar_variacion(vid: int, pid: Optional[int] = None) -> Dict[str, Any]:
+    """
+    product.deleted de una variación: la saca de la lista de su padre.
+    El padre sale del payload (parent_id) o, si no viene, del snapshot / la DB.
+    """
+    cat = _CATALOGO
+    if not pid and cat is not None:
+        pid = next((p for p, vs in cat.variaciones.items() if any(x.get("id") == vid for x in vs)), None)
+    if not pid:
+        init_catalogo_db()
+        with SessionCatalogo() as s:
+            pid = s.execute(select(VariacionCatalogo.product_id).where(VariacionCatalogo.id == vid)).scalar()
+    if not pid:
+        return {"ignorado": "variación desconocida"}
+    if cat is not None and pid in cat.variaciones:
+        lista = [x for x in cat.variaciones[pid] if x.get("id") != vid]
+        return aplicar_cambios(variaciones={pid: lista})
+    # Sin el padre en memoria basta con borrar la fila; el próximo snapshot ya no la trae
+    with SessionCatalogo() as s:
+        s.execute(delete(VariacionCatalogo).where(VariacionCatalogo.id == vid))
+        s.commit()
+    return {"productos": 0, "variaciones": 0}
+
+
+def refrescar_productos(pids: Iterable[int]) -> Dict[str, Any]:
+    """Relee de Woo solo estos productos (y sus variaciones) y los publica; p. ej. tras un pedido."""
+    productos: Dict[int, Optional[dict]] = {}
+    for pid in {int(x) for x in pids if x}:
+        p = wc.get_product_by_id(pid)
+        if isinstance(p, dict) and p.get("id"):
+            productos[pid] = p
+    variables = [pid for pid, p in productos.items() if p and p.get("type") == "variable"]
+    return aplicar_cambios(productos, _fetch_variaciones(variables))
+
+
+
+def refrescar_stock(pid: int, variable: bool = True) -> Optional[List[dict]]:
+    """
+    Una sola llamada a Woo para el stock de un producto: sus variaciones si es
+    variable, el producto si no. Si el espejo lo conoce, publica el cambio (y
+    renueva variaciones_ts). Devuelve lo leído (variaciones o [producto]) o None.
+    """
+    conocido = _CATALOGO is not None and pid in _CATALOGO.productos
+    if variable:
+        data = wc.get_variations(pid, per_page=100)
+        if not isinstance(data, list):
+            return None
+        data.sort(key=lambda x: int(x.get("id") or 0))
+        if conocido:
+            aplicar_cambios(variaciones={pid: data})
+        return data
+    p = wc.get_product_by_id(pid)
+    if not (isinstance(p, dict) and p.get("id")):
+        return None
+    if conocido:
+        aplicar_cambios(productos={pid: p})
+    return [p]
+
+# ======================================================================
+# Sync desde WooCommerce
+# ======================================================================
+def precalentar(category_ids: Iterable[int], max_pages: int = 2) -> Dict[str, Any]:
+    """
+    Carga de arranque. Con un sync completo previo en disco basta con leerlo;
+    si no (p. ej. /tmp vacío tras un cold start), trae en paralelo solo estas
+    categorías y sus variaciones y publica un snapshot parcial. El sync
+    periódico completa el resto; mientras tanto cubre() manda lo demás a Woo en vivo.
+    """
+    global _CATALOGO
+    t0 = time.perf_counter()
+    init_catalogo_db()
+    with SessionCatalogo() as s:
+        completo = bool(_meta_get(s, "ultima_sync_completa"))
+        previas = set(json.loads(_meta_get(s, "precalentadas") or "[]"))
+    if completo:
+        cat = recargar()
+        return {"origen": "disco", "productos": len(cat), "duracion_s": round(time.perf_counter() - t0, 3)}
+    if not _credenciales_ok():
+        return {"error": "WooCommerce credentials or base URL missing."}
+
+    ids = [int(c) for c in dict.fromkeys(category_ids) if c]
+    with ThreadPoolExecutor(max_workers=max(1, CATALOG_WORKERS)) as pool:
+        fut_cats = pool.submit(wc.get_categories)
+        por_cat = dict(zip(ids, pool.map(
+            lambda cid: wc.get_products_by_category(cid, per_page=100, max_pages=max_pages), ids
+        )))
+        categorias = fut_cats.result()
+    prods: Dict[int, dict] = {}
+    ok: List[int] = []
+    for cid, data in por_cat.items():
+        if isinstance(data, list):
+            ok.append(cid)
+            prods.update({int(p["id"]): p for p in data if p.get("id")})
+    variaciones = _fetch_variaciones([pid for pid, p in prods.items() if p.get("type") == "variable"])
+
+    # Woo incluye subcategorías al filtrar por categoría: también quedan cubiertas
+    cubiertas = set(ok)
+    hijos: Dict[int, List[int]] = {}
+    for c in categorias if isinstance(categorias, list) else []:
+        if c.get("id") and c.get("parent"):
+            hijos.setdefault(int(c["parent"]), []).append(int(c["id"]))
+    pila = list(ok)
+    while pila:
+        for h in hijos.get(pila.pop(), ()):
+            if h not in cubiertas:
+                cubiertas.add(h)
+                pila.append(h)
+
+    ahora = datetime.now(timezone.utc)
+    with SessionCatalogo() as s:
+        if isinstance(categorias, list) and categorias:
+            _guardar_categorias(s, categorias)
+        for p in prods.values():
+            _guardar_producto(s, p, ahora)
+        for pid, vs in variaciones.items():
+            _guardar_variaciones(s, pid, vs, ahora)
+        _meta_set(s, "precalentadas", json.dumps(sorted(previas | cubiertas)))
+        s.commit()
+    with _swap_lock:
+        _CATALOGO = _cargar_desde_db()
+    return {
+        "origen": "woocommerce",
+        "categorias": ok,
+        "productos": len(prods),
+        "variaciones": sum(len(v) for v in variaciones.values()),
+        "duracion_s": round(time.perf_counter() - t0, 3),
+    }
+
+
+def _iso_utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _fetch_variaciones(pids: Iterable[int]) -> Dict[int, List[dict]]:
+    """Trae variaciones en paralelo; los productos con error quedan fuera (se conservan las previas)."""
+    def _uno(pid: int):
+        data = wc.get_variations(pid, per_page=100, max_pages=5)
+        return pid, (None if isinstance(data, dict) else data)
+
+    out: Dict[int, List[dict]] = {}
+    pids = list(pids)
+    if not pids:
+        return out
+    with ThreadPoolExecutor(max_workers=max(1, CATALOG_WORKERS)) as pool:
+        for pid, data in pool.map(_uno, pids):
+            if data is not None:
+                out[pid] = data
+    return out
+
+
+def sincronizar(completa: Optional[bool] = None) -> Dict[str, Any]:
+    """
+    Sincroniza con WooCommerce. Por defecto es incremental (modified_after) y
+    pasa a completa si nunca hubo una o la última tiene más de
+    CATALOG_FULL_SYNC_HOURS (la completa además elimina lo que ya no existe).
+    """
+    global _CATALOGO
+    if not _credenciales_ok():
+        return {"error": "WooCommerce credentials or base URL missing."}
+    if not _sync_lock.acquire(blocking=False):
+        return {"skipped": "sync en curso"}
+    try:
+        t0 = time.perf_counter()
+        init_catalogo_db()
+        ahora = datetime.now(timezone.utc)
+        with SessionCatalogo() as s:
+            ultima = _meta_get(s, "ultima_sync")
+            ultima_completa = _meta_get(s, "ultima_sync_completa")
+        if completa is None:
+            vencida = (
+                not ultima_completa
+                or ahora - datetime.fromisoformat(ultima_completa) > timedelta(hours=CATALOG_FULL_SYNC_HOURS)
+            )
+            completa = vencida or not ultima
+        desde = None if completa else _iso_utc(datetime.fromisoformat(ultima) - timedelta(minutes=1))
+
+        categorias = wc.get_categories()
+        prods = wc.get_all_products(
+            per_page=100,
+            max_pages=CATALOG_MAX_PAGES,
+            modified_after=desde,
+            status="publish" if completa else "any",
+        )
+        if isinstance(prods, dict) and prods.get("error"):
+            return {"error": prods["error"]}
+
+        variables = [int(p["id"]) for p in prods if p.get("type") == "variable" and p.get("status", "publish") == "publish"]
+        variaciones = _fetch_variaciones(variables)
+
+        with SessionCatalogo() as s:
+            if isinstance(categorias, list) and categorias:
+                _guardar_categorias(s, categorias)
+            for p in prods:
+                if p.get("id"):
+                    _guardar_producto(s, p, ahora)
+            for pid, vs in variaciones.items():
+                _guardar_variaciones(s, pid, vs, ahora)
+            if completa:
+                vivos = {int(p["id"]) for p in prods if p.get("id")}
+                existentes = set(s.execute(select(ProductoCatalogo.id)).scalars())
+                for pid in existentes - vivos:
+                    _borrar_producto(s, pid)
+                _meta_set(s, "ultima_sync_completa", ahora.isoformat())
+            _meta_set(s, "ultima_sync", ahora.isoformat())
+            s.commit()
+
+        with _swap_lock:
+            _CATALOGO = _cargar_desde_db()
+        stats = {
+            "completa": completa,
+            "productos_recibidos": len(prods),
+            "variaciones_recibidas": sum(len(v) for v in variaciones.values()),
+            "productos_total": len(_CATALOGO),
+            "duracion_s": round(time.perf_counter() - t0, 3),
+        }
+        print(f"🗂️  Catálogo sincronizado: {stats}")
+        return stats
+    finally:
+        _sync_lock.release()
+
+
+def _loop_sync():
+    while True:
+        try:
+            sincronizar()
+        except Exception as e:
+            print("❌ Error sincronizando catálogo:", repr(e))
+        time.sleep(max(60.0, CATALOG_SYNC_MINUTES * 60))
+
+
+def iniciar_sync_periodico() -> bool:
+    """
+    Carga el último snapshot desde disco (listo de inmediato si existe) y lanza
+    el hilo de sync periódico. Devuelve False si el espejo está desactivado.
+    """
+    global _thread
+    if not CATALOG_MIRROR:
+        return False
+    if not _credenciales_ok():
+        print("⚠️  Espejo de catálogo desactivado: faltan credenciales de WooCommerce.")
+        return False
+    try:
+        recargar()
+    except Exception as e:
+        print("⚠️  No pude cargar el catálogo local:", repr(e))
+    if _thread is None or not _thread.is_alive():
+        _thread = threading.Thread(target=_loop_sync, name="catalogo-sync", daemon=True)
+        _thread.start()
+    return True
+
+
+# Sync manual: python catalogo_local.py [--completa]
+if __name__ == "__main__":
+    import sys
+    print(sincronizar(completa=True if "--completa" in sys.argv else None))
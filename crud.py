@@ -1,11 +1,11 @@
-# crud.py — v2.3
+# crud.py — v2.4
 from __future__ import annotations
 from typing import Optional, Dict, Any
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import insert, update
 from models import Pedido
+from database import execute_write, sqlite_writer
 from datetime import datetime, timezone
-import random
 
 # Campos que permitimos tocar desde la app
 ALLOWED_FIELDS = {
@@ -50,22 +50,33 @@ def _calc_subtotal(cantidad, precio_u) -> float:
     except Exception:
         return 0.0
 
-def _genera_numero_confirmacion() -> str:
-    fecha = datetime.utcnow().strftime("%Y%m%d")
-    aleatorio = f"{random.randint(100, 999)}"
-    return f"CAS-{fecha}-{aleatorio}"
-
-def _numero_confirmacion_unico(db: Session) -> str:
-    # Intenta hasta 5 veces evitar colisión (muy improbable)
-    for _ in range(5):
-        numero = _genera_numero_confirmacion()
-        exist = db.execute(
-            select(Pedido.id).where(Pedido.numero_confirmacion == numero)
-        ).first()
-        if not exist:
-            return numero
-    # Último recurso: añade sufijo largo
-    return f"{_genera_numero_confirmacion()}-{random.randint(1000, 9999)}"
+# --- Número de confirmación ---
+# Sale del id del pedido (la secuencia de la tabla), así que es único sin
+# consultar la BD ni reintentar. Para que no se lea como un contador, el id
+# pasa por una permutación de los 32^6 códigos de 6 caracteres (Crockford
+# base32: sin I, L, O ni U, no se confunden al dictarlos). Ids más grandes
+# salen sin permutar y con más caracteres, así tampoco chocan con los de 6.
+_CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_CODIGOS = 32 ** 6
+_MULT, _SUMA = 387_420_489, 104_729   # _MULT impar → biyección módulo 32^6
+
+def _base32(n: int, ancho: int) -> str:
+    out = ""
+    while n or len(out) < ancho:
+        n, r = divmod(n, 32)
+        out = _CROCKFORD[r] + out
+    return out
+
+def numero_confirmacion(pedido_id: int, fecha: Optional[datetime] = None) -> str:
+    """
+    CAS-YYYYMMDD-XXXXXX a partir del id del pedido (único por construcción).
+    crear_pedido lo asigna al crear la fila, así que la fecha es la de creación
+    del pedido (inicio de la conversación), no la de la confirmación.
+    """
+    fecha = (fecha or _now_utc()).strftime("%Y%m%d")
+    n = int(pedido_id)
+    codigo = _base32((n * _MULT + _SUMA) % _CODIGOS, 6) if n < _CODIGOS else _base32(n, 7)
+    return f"CAS-{fecha}-{codigo}"
 
 # ------------------ CRUD ------------------
 
@@ -75,7 +86,7 @@ def crear_pedido(db: Session, datos: Dict[str, Any]) -> Pedido:
     Rellena campos nuevos para no romper flujos posteriores.
     """
     ahora = _now_utc()
-    numero = datos.get("numero_confirmacion") or _numero_confirmacion_unico(db)
+    numero = datos.get("numero_confirmacion") or None
 
     cantidad = _safe_int(datos.get("cantidad", 0))
     precio_u = _safe_float(datos.get("precio_unitario", 0.0))
@@ -109,7 +120,19 @@ def crear_pedido(db: Session, datos: Dict[str, Any]) -> Pedido:
         saludo_enviado=_safe_int(datos.get("saludo_enviado", 0)),
         last_msg_id=_safe_str(datos.get("last_msg_id")),
     )
+    if sqlite_writer is not None:
+        # Escritor único: el alta también sale por el escritor (nada se confirma por fuera)
+        valores = {c.key: getattr(pedido, c.key) for c in Pedido.__table__.columns if getattr(pedido, c.key) is not None}
+        execute_write(db, insert(Pedido).values(**valores))
+        pedido = (db.query(Pedido).filter(Pedido.session_id == pedido.session_id)
+                  .order_by(Pedido.id.desc()).first())
+        if not numero:
+            _aplicar_cambios(db, pedido, {"numero_confirmacion": numero_confirmacion(pedido.id, ahora)})
+        return pedido
     db.add(pedido)
+    if not numero:
+        db.flush()  # asigna el id; número y fila salen en la misma transacción
+        pedido.numero_confirmacion = numero_confirmacion(pedido.id, ahora)
     db.commit()
     db.refresh(pedido)
     return pedido
@@ -117,6 +140,24 @@ def crear_pedido(db: Session, datos: Dict[str, Any]) -> Pedido:
 def obtener_pedido_por_sesion(db: Session, session_id: str) -> Optional[Pedido]:
     return db.query(Pedido).filter(Pedido.session_id == session_id).first()
 
+def _normaliza_valor(campo: str, valor):
+    if campo == "cantidad":
+        return _safe_int(valor)
+    if campo in ("precio_unitario", "subtotal"):
+        return _safe_float(valor)
+    if campo in ("datos_personales_advertidos", "saludo_enviado"):
+        return 1 if str(valor) in ("1", "true", "True") or valor is True else 0
+    return _safe_str(valor)
+
+def _aplicar_cambios(db: Session, pedido: Pedido, cambios: Dict[str, Any]) -> Pedido:
+    """
+    Un solo UPDATE por id y recarga del objeto. Va por execute_write para que,
+    en modo escritor único SQLite, salga agrupado con el resto de escrituras.
+    """
+    execute_write(db, update(Pedido).where(Pedido.id == pedido.id).values(**cambios))
+    db.refresh(pedido)
+    return pedido
+
 def actualizar_pedido_por_sesion(db: Session, session_id: str, campo: str, valor) -> Optional[Pedido]:
     """
     Actualiza un único campo permitido. Recalcula subtotal si corresponde.
@@ -130,30 +171,21 @@ def actualizar_pedido_por_sesion(db: Session, session_id: str, campo: str, valor
         # ignorar silenciosamente para no romper el flujo
         return pedido
 
-    # Normalizaciones por tipo
-    if campo == "cantidad":
-        valor = _safe_int(valor)
-    elif campo in ("precio_unitario", "subtotal"):
-        valor = _safe_float(valor)
-    elif campo in ("datos_personales_advertidos", "saludo_enviado"):
-        valor = 1 if str(valor) in ("1", "true", "True") or valor is True else 0
-    else:
-        valor = _safe_str(valor)
-
-    setattr(pedido, campo, valor)
+    valor = _normaliza_valor(campo, valor)
+    cambios: Dict[str, Any] = {campo: valor}
 
     # Recalcula subtotal si cambia cantidad o precio_unitario (y no nos pasaron subtotal explícito)
     if campo in ("cantidad", "precio_unitario"):
         if not _safe_float(getattr(pedido, "subtotal", 0), None):
-            pedido.subtotal = _calc_subtotal(pedido.cantidad, pedido.precio_unitario)
+            cantidad = valor if campo == "cantidad" else pedido.cantidad
+            precio_u = valor if campo == "precio_unitario" else pedido.precio_unitario
+            cambios["subtotal"] = _calc_subtotal(cantidad, precio_u)
 
     # Auto-bump de last_activity, exceptuando cuando el propio campo es last_activity
     if campo != "last_activity":
-        pedido.last_activity = _now_utc()
+        cambios["last_activity"] = _now_utc()
 
-    db.commit()
-    db.refresh(pedido)
-    return pedido
+    return _aplicar_cambios(db, pedido, cambios)
 
 def actualizar_pedido_por_sesion_many(db: Session, session_id: str, updates: Dict[str, Any]) -> Optional[Pedido]:
     """
@@ -163,28 +195,20 @@ def actualizar_pedido_por_sesion_many(db: Session, session_id: str, updates: Dic
     if not pedido:
         return None
 
-    touched = False
-    for campo, valor in (updates or {}).items():
-        if campo not in ALLOWED_FIELDS:
-            continue
-        touched = True
-        if campo == "cantidad":
-            valor = _safe_int(valor)
-        elif campo in ("precio_unitario", "subtotal"):
-            valor = _safe_float(valor)
-        elif campo in ("datos_personales_advertidos", "saludo_enviado"):
-            valor = 1 if str(valor) in ("1", "true", "True") or valor is True else 0
-        else:
-            valor = _safe_str(valor)
-        setattr(pedido, campo, valor)
-
-    if touched:
-        # Recalcula subtotal si falta o es cero y tenemos base suficiente
-        if (not pedido.subtotal or pedido.subtotal <= 0) and (pedido.cantidad and pedido.precio_unitario):
-            pedido.subtotal = _calc_subtotal(pedido.cantidad, pedido.precio_unitario)
-
-        pedido.last_activity = _now_utc()
-        db.commit()
-        db.refresh(pedido)
+    cambios: Dict[str, Any] = {
+        campo: _normaliza_valor(campo, valor)
+        for campo, valor in (updates or {}).items()
+        if campo in ALLOWED_FIELDS
+    }
+    if not cambios:
+        return pedido
+
+    # Recalcula subtotal si falta o es cero y tenemos base suficiente
+    subtotal = cambios.get("subtotal", pedido.subtotal)
+    cantidad = cambios.get("cantidad", pedido.cantidad)
+    precio_u = cambios.get("precio_unitario", pedido.precio_unitario)
+    if (not subtotal or subtotal <= 0) and (cantidad and precio_u):
+        cambios["subtotal"] = _calc_subtotal(cantidad, precio_u)
 
-    return pedido
+    cambios["last_activity"] = _now_utc()
+    return _aplicar_cambios(db, pedido, cambios)
@@ -0,0 +1,68 @@
+# cursor_resultados.py
+"""
+Cursor de resultados por sesión para "más opciones".
+
+Al mostrar una búsqueda se guarda (columna `cursor_json`) la consulta, sus
+criterios de orden y la lista completa de IDs ya ordenada por ranking.py, más
+el offset de lo mostrado. La página siguiente se arma desde el snapshot local
+con solo esos IDs (O(página)), sin volver a consultar ni a ordenar; así se
+puede llegar al fondo de categorías grandes. Si el espejo no está listo (o el
+cursor viene de una lista del LLM, sin IDs), se repite la consulta excluyendo
+lo ya mostrado.
+"""
+from __future__ import annotations
+import os
+import json
+from typing import Any, Dict, List, Optional
+
+CURSOR_MAX_IDS = int(os.getenv("CURSOR_MAX_IDS", "500"))
+PAGINA = 3
+
+
+class CursorResultados:
+    __slots__ = ("consulta", "categoria", "filtros", "presupuesto", "tallas", "ids", "offset")
+
+    def __init__(
+        self,
+        consulta: str,
+        categoria: Optional[str] = None,
+        filtros: Optional[Dict[str, Any]] = None,
+        presupuesto=None,
+        tallas: Optional[List[str]] = None,
+        ids: Optional[List[int]] = None,
+        offset: int = 0,
+    ):
+        self.consulta = consulta or ""
+        self.categoria = categoria
+        self.filtros = filtros or {}
+        self.presupuesto = list(presupuesto) if presupuesto else None
+        self.tallas = list(tallas or [])
+        self.cargar(ids, offset)
+
+    def cargar(self, ids: Optional[List[int]], offset: int = 0):
+        """IDs ya ordenados de la búsqueda (vacío = aún sin resolver) y cuántos se mostraron."""
+        self.ids = [int(i) for i in (ids or [])[:CURSOR_MAX_IDS]]
+        self.offset = max(0, int(offset or 0))
+
+    @property
+    def pendientes(self) -> List[int]:
+        return self.ids[self.offset:]
+
+    def avanzar(self, n: int):
+        self.offset += max(0, n)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {k: getattr(self, k) for k in self.__slots__},
+            ensure_ascii=False, separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, raw: Optional[str]) -> Optional["CursorResultados"]:
+        try:
+            data = json.loads(raw) if raw else None
+            if not isinstance(data, dict) or not data.get("consulta"):
+                return None
+            return cls(**{k: data.get(k) for k in cls.__slots__})
+        except Exception:
+            return None
@@ -0,0 +1,118 @@
+# detector_categorias.py
+"""
+Detección de categoría a partir del texto del cliente.
+
+Las opciones (categorías + sinónimos) se normalizan una sola vez al construir
+el detector; cada texto ya resuelto queda en un memo LRU, así las varias
+llamadas por mensaje (mensaje_whatsapp, LLM, search_products, fotos…) sobre el
+mismo texto cuestan un lookup. Benchmark: python detector_categorias.py
+"""
+from __future__ import annotations
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from rapidfuzz import process, fuzz
+
+from facetas import normalizar
+
+UMBRAL_FUZZY = 80
+MEMO_MAX = 4096
+
+_TOKEN_RE = re.compile(r"[a-záéíóúñü]+")
+
+Resultado = Tuple[Optional[str], float]
+
+
+def clave_texto(texto: str) -> str:
+    """Tokens normalizados unidos por espacio: la forma con la que se compara (y se memoiza)."""
+    return " ".join(normalizar(t) for t in _TOKEN_RE.findall((texto or "").lower()))
+
+
+class DetectorCategorias:
+    """Coincidencia exacta por token y, si no hay, fuzzy (token_sort_ratio) contra opciones precalculadas."""
+
+    def __init__(
+        self,
+        categorias: Iterable[str],
+        sinonimos: Dict[str, str],
+        umbral: int = UMBRAL_FUZZY,
+        memo_max: int = MEMO_MAX,
+    ):
+        self.umbral = umbral
+        # token exacto → categoría canónica (los sinónimos ganan, como antes)
+        self._exactos: Dict[str, str] = {}
+        for c in categorias:
+            self._exactos.setdefault(normalizar(c), c)
+        for s, c in sinonimos.items():
+            self._exactos[normalizar(s)] = c
+        # opciones fuzzy ya normalizadas y su categoría, en listas paralelas
+        self._opciones: List[str] = []
+        self._destino: List[str] = []
+        for c in categorias:
+            self._opciones.append(normalizar(c))
+            self._destino.append(c)
+        for s, c in sinonimos.items():
+            self._opciones.append(normalizar(s))
+            self._destino.append(c)
+        self._memo = lru_cache(maxsize=memo_max)(self._resolver)
+        # memo delante de la normalización: el mismo mensaje repetido no vuelve a normalizarse
+        self._por_texto = lru_cache(maxsize=memo_max)(lambda texto: self._memo(clave_texto(texto)))
+
+    def _resolver(self, clave: str) -> Resultado:
+        if not clave:
+            return None, 0.0
+        for t in clave.split():
+            c = self._exactos.get(t)
+            if c:
+                return c, 1.0
+        hit = process.extractOne(
+            clave, self._opciones, scorer=fuzz.token_sort_ratio,
+            processor=None, score_cutoff=self.umbral,
+        )
+        if hit:
+            _, score, idx = hit
+            return self._destino[idx], score / 100.0
+        return None, 0.0
+
+    def detectar(self, texto: str) -> Resultado:
+        return self._por_texto(texto or "")
+
+    def detectar_lote(self, textos: Iterable[str]) -> List[Resultado]:
+        """Resuelve varios textos; los repetidos (misma clave normalizada) se calculan una vez."""
+        claves = [clave_texto(t) for t in textos]
+        unicos = {k: self._memo(k) for k in dict.fromkeys(claves)}
+        return [unicos[k] for k in claves]
+
+    def memo_info(self) -> Dict[str, int]:
+        i = self._memo.cache_info()
+        return {"hits": i.hits, "misses": i.misses, "size": i.currsize, "max": i.maxsize or 0}
+
+
+# Benchmark: python detector_categorias.py [N]
+if __name__ == "__main__":
+    import sys
+    import time
+    from woocommerce_gpt_utils import CATEGORY_IDS, SYNONYMS
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    muestras = [
+        "hola, quiero ver camisas manga larga", "tienen jeans azules talla 32", "busco unos zapatos",
+        "algo para oficina", "me muestras guayaberas blancas", "pantalon beige", "quiero una lozion",
+        "buenas tardes", "suéter gris", "blaser negro para evento",
+    ]
+
+    d = DetectorCategorias(CATEGORY_IDS, SYNONYMS)
+    t0 = time.perf_counter()
+    for i in range(n):
+        d._resolver(clave_texto(muestras[i % len(muestras)]))
+    frio = (time.perf_counter() - t0) / n * 1e6
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        d.detectar(muestras[i % len(muestras)])
+    memo = (time.perf_counter() - t0) / n * 1e6
+
+    for m, r in zip(muestras, d.detectar_lote(muestras)):
+        print(f"{m!r:45} → {r}")
+    print(f"sin memo: {frio:.1f} µs/llamada · con memo: {memo:.1f} µs/llamada · {d.memo_info()}")
@@ -0,0 +1,265 @@
+# disponibilidad.py
+"""
+Disponibilidad real al agregar al carrito.
+
+• El stock de la talla pedida sale del espejo local (catalogo_local). Si lo
+  que tiene el espejo de ese producto es más viejo que
+  DISPONIBILIDAD_MAX_EDAD_S (o el espejo no lo conoce), se refresca con UNA
+  llamada a Woo, solo para ese producto, antes de responder.
+• Reservas blandas (tabla reservas_stock): al agregar se apartan las
+  unidades por RESERVA_TTL_MIN minutos. Para otro cliente lo disponible es
+  el stock menos las reservas vigentes de las demás sesiones. Vencen solas;
+  quitar del carrito las libera antes.
+• La reserva es una sola escritura condicional (pasa por el writer SQLite):
+  el UPDATE/INSERT solo aplica si stock − reservas vigentes ≥ cantidad, así
+  dos clientes no se llevan la misma última unidad. Si después el carrito
+  no se pudo escribir, soltar() devuelve lo apartado.
+• Todo es bloqueante (DB y, si el espejo está viejo, una llamada a Woo):
+  se llama desde un hilo de trabajo, como el resto del turno.
+• Sin gestión de inventario en Woo (stock_quantity vacío) no hay tope: basta
+  con que esté en stock.
+"""
+from __future__ import annotations
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text as sa_text
+from sqlalchemy.orm import Session
+
+import catalogo_local
+from database import execute_write
+from registro import logger
+
+log = logger("disponibilidad")
+
+DISPONIBILIDAD_MAX_EDAD_S = float(os.getenv("DISPONIBILIDAD_MAX_EDAD_S", "600"))
+RESERVA_TTL_MIN = float(os.getenv("RESERVA_TTL_MIN", "30"))
+
+DISPONIBILIDAD_METRICS: Dict[str, int] = {"consultas": 0, "refrescos_woo": 0, "rechazos": 0, "reservas": 0,
+                                           "carreras": 0, "soltadas": 0}
+
+# Unidades libres = stock leído de Woo − todas las reservas vigentes (incluida la de esta sesión)
+_HAY_LUGAR = ("(:stock - COALESCE((SELECT SUM(r.cantidad) FROM reservas_stock r WHERE r.product_id=:pid "
+              "AND r.talla=:t AND r.expira > :ahora), 0)) >= :q")
+
+
+class Disponibilidad:
+    __slots__ = ("product_id", "talla", "stock", "reservado", "tallas", "apartado")
+
+    def __init__(self, product_id: Optional[int], talla: Optional[str] = None, stock: Optional[float] = None,
+                 reservado: int = 0, tallas: Optional[List[str]] = None):
+        self.product_id = product_id
+        self.talla = talla
+        self.stock = stock              # None = en stock sin gestión de inventario (sin tope)
+        self.reservado = reservado      # reservas vigentes de otras sesiones
+        self.tallas = tallas or []      # tallas con unidades libres (para sugerir otra)
+        self.apartado = 0               # unidades que reservó esta llamada (para soltar())
+
+    @property
+    def disponible(self) -> Optional[float]:
+        return None if self.stock is None else max(0.0, self.stock - self.reservado)
+
+    def alcanza(self, cantidad: int = 1) -> bool:
+        return self.disponible is None or self.disponible >= max(1, int(cantidad or 1))
+
+
+def _ahora() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _talla(t: Optional[str]) -> str:
+    return str(t or "").strip().upper()
+
+
+def product_id_de(prod: dict) -> Optional[int]:
+    """ID Woo de un producto de la lista sugerida o del agente (id, sku o url)."""
+    pid = prod.get("id") or prod.get("product_id")
+    if pid and str(pid).isdigit():
+        return int(pid)
+    cat = catalogo_local.get_catalogo()
+    if cat is None:
+        return None
+    for ref in (prod.get("sku"), prod.get("url")):
+        if ref:
+            pid = cat.resolver(str(ref))
+            if pid:
+                return pid
+    return None
+
+
+def _unidades(item: dict) -> Optional[float]:
+    """0 si está agotado; None si está en stock sin cantidad gestionada."""
+    if str(item.get("stock_status", "instock")) != "instock":
+        return 0.0
+    q = item.get("stock_quantity")
+    return float(max(0, q)) if isinstance(q, (int, float)) and item.get("manage_stock") is not False else None
+
+
+def _items_de_stock(pid: int, variable_hint: bool) -> Optional[Tuple[List[dict], bool]]:
+    """(variaciones o [producto], es_variable) con antigüedad ≤ DISPONIBILIDAD_MAX_EDAD_S."""
+    cat = catalogo_local.get_catalogo()
+    conocido = cat is not None and pid in cat.productos
+    variable = cat.productos[pid].get("type") == "variable" if conocido else variable_hint
+    espejo = (list(cat.variaciones.get(pid, ())) if variable else [cat.productos[pid]]) if conocido else None
+    if conocido and time.time() - cat.variaciones_ts.get(pid, 0.0) <= DISPONIBILIDAD_MAX_EDAD_S:
+        return espejo, variable
+    DISPONIBILIDAD_METRICS["refrescos_woo"] += 1
+    frescos = catalogo_local.refrescar_stock(pid, variable=variable)
+    if frescos is not None:
+        return frescos, variable
+    # Woo no respondió: mejor el espejo algo viejo que bloquear la venta
+    return (espejo, variable) if espejo is not None else None
+
+
+def _reservado_por_otros(db: Session, session_id: str, pid: int) -> Dict[str, int]:
+    try:
+        filas = db.execute(
+            sa_text("SELECT talla, SUM(cantidad) FROM reservas_stock "
+                    "WHERE product_id=:pid AND expira > :ahora AND session_id <> :sid GROUP BY talla"),
+            {"pid": pid, "ahora": _ahora(), "sid": session_id},
+        ).fetchall()
+        return {str(t or ""): int(n or 0) for t, n in filas}
+    except Exception:
+        return {}
+
+
+def _reservado_total(db: Session, pid: int, talla: str) -> int:
+    try:
+        n = db.execute(
+            sa_text("SELECT SUM(cantidad) FROM reservas_stock WHERE product_id=:pid AND talla=:t AND expira > :ahora"),
+            {"pid": pid, "t": talla, "ahora": _ahora()},
+        ).scalar()
+        return int(n or 0)
+    except Exception:
+        return 0
+
+
+def consultar(db: Session, session_id: str, prod: dict, talla: Optional[str] = None) -> Optional[Disponibilidad]:
+    """
+    Disponibilidad de `prod` en `talla` para esta sesión. None si no se puede
+    saber (producto sin ID resoluble o Woo sin respuesta): el llamador sigue
+    como antes, con las tallas en caché.
+    """
+    DISPONIBILIDAD_METRICS["consultas"] += 1
+    pid = product_id_de(prod)
+    if not pid:
+        return None
+    leidos = _items_de_stock(pid, variable_hint=bool(prod.get("tallas_disponibles") or talla))
+    if leidos is None:
+        return None
+    items, variable = leidos
+    reservas = _reservado_por_otros(db, session_id, pid)
+    if not variable:
+        return Disponibilidad(pid, None, _unidades(items[0]) if items else 0.0, reservas.get("", 0))
+
+    por_talla: Dict[str, Optional[float]] = {}
+    for v in items:
+        t = _talla(catalogo_local.talla_de_variacion(v))
+        u = _unidades(v)
+        if t in por_talla:
+            por_talla[t] = None if por_talla[t] is None or u is None else por_talla[t] + u
+        else:
+            por_talla[t] = u
+    libres = [t for t, u in por_talla.items() if t and (u is None or u - reservas.get(t, 0) > 0)]
+    t = _talla(talla)
+    if t not in por_talla:
+        return Disponibilidad(pid, t or None, 0.0, 0, libres)
+    return Disponibilidad(pid, t, por_talla[t], reservas.get(t, 0), libres)
+
+
+def reservar(db: Session, session_id: str, prod: dict, talla: Optional[str] = None,
+             cantidad: int = 1) -> Optional[Disponibilidad]:
+    """
+    Verifica y, si alcanza, aparta `cantidad` unidades por RESERVA_TTL_MIN
+    (suma a la reserva vigente de la sesión y renueva su vencimiento).
+    Devuelve la disponibilidad consultada; si no alcanza no reserva nada.
+    """
+    disp = consultar(db, session_id, prod, talla)
+    if disp is None:
+        return None
+    if not disp.alcanza(cantidad):
+        DISPONIBILIDAD_METRICS["rechazos"] += 1
+        return disp
+    if disp.stock is None:
+        return disp   # sin tope de inventario: no hace falta apartar
+    ahora = _ahora()
+    q = max(1, int(cantidad or 1))
+    params = {"sid": session_id, "pid": disp.product_id, "t": disp.talla or "", "q": q, "stock": disp.stock,
+              "ahora": ahora, "exp": ahora + timedelta(minutes=RESERVA_TTL_MIN)}
+    try:
+        n = execute_write(
+            db,
+            sa_text("UPDATE reservas_stock SET cantidad = CASE WHEN expira > :ahora THEN cantidad + :q ELSE :q END, "
+                    f"expira=:exp WHERE session_id=:sid AND product_id=:pid AND talla=:t AND {_HAY_LUGAR}"),
+            params,
+        )
+        if not n:
+            n = execute_write(
+                db,
+                sa_text("INSERT INTO reservas_stock (session_id, product_id, talla, cantidad, expira) "
+                        f"SELECT :sid, :pid, :t, :q, :exp WHERE {_HAY_LUGAR} AND NOT EXISTS ("
+                        "SELECT 1 FROM reservas_stock WHERE session_id=:sid AND product_id=:pid AND talla=:t)"),
+                params,
+            )
+            execute_write(db, sa_text("DELETE FROM reservas_stock WHERE expira <= :ahora"), {"ahora": ahora})
+        if not n:
+            # Otro cliente apartó entre la consulta y la escritura: lo libre ya no alcanza
+            DISPONIBILIDAD_METRICS["carreras"] += 1
+            DISPONIBILIDAD_METRICS["rechazos"] += 1
+            disp.reservado = _reservado_total(db, disp.product_id, disp.talla or "")
+            return disp
+        disp.apartado = q
+        DISPONIBILIDAD_METRICS["reservas"] += 1
+    except Exception as e:
+        db.rollback()
+        log.error("reserva.fallida", exc=e, producto=disp.product_id, talla=disp.talla)
+    return disp
+
+
+def soltar(db: Session, session_id: str, disp: Optional[Disponibilidad]):
+    """Devuelve lo que apartó reservar() (el carrito no se llegó a escribir)."""
+    if disp is None or not disp.apartado:
+        return
+    try:
+        params = {"sid": session_id, "pid": disp.product_id, "t": disp.talla or "", "q": disp.apartado}
+        execute_write(db, sa_text("UPDATE reservas_stock SET cantidad = cantidad - :q "
+                                  "WHERE session_id=:sid AND product_id=:pid AND talla=:t"), params)
+        execute_write(db, sa_text("DELETE FROM reservas_stock WHERE session_id=:sid AND product_id=:pid "
+                                  "AND talla=:t AND cantidad <= 0"), params)
+        disp.apartado = 0
+        DISPONIBILIDAD_METRICS["soltadas"] += 1
+    except Exception:
+        db.rollback()
+
+
+def liberar(db: Session, session_id: str, prod: dict, talla: Optional[str] = None):
+    """Suelta la reserva de la sesión para ese producto (y talla, si se indica)."""
+    pid = product_id_de(prod)
+    if not pid:
+        return
+    try:
+        if talla:
+            execute_write(db, sa_text("DELETE FROM reservas_stock WHERE session_id=:sid AND product_id=:pid AND talla=:t"),
+                          {"sid": session_id, "pid": pid, "t": _talla(talla)})
+        else:
+            execute_write(db, sa_text("DELETE FROM reservas_stock WHERE session_id=:sid AND product_id=:pid"),
+                          {"sid": session_id, "pid": pid})
+    except Exception:
+        db.rollback()
+
+
+def mensaje_no_disponible(disp: Disponibilidad, nombre: str, cantidad: int = 1) -> str:
+    """Respuesta al cliente cuando no alcanza, con las tallas que sí quedan."""
+    nombre = nombre or "el producto"
+    if disp.talla and disp.disponible and disp.disponible < max(1, int(cantidad or 1)):
+        falta = f"De «{nombre}» en talla {disp.talla} solo quedan {int(disp.disponible)} unidades."
+    elif disp.talla:
+        falta = f"«{nombre}» en talla {disp.talla} se acaba de agotar."
+    else:
+        falta = f"«{nombre}» se acaba de agotar."
+    otras = [t for t in disp.tallas if t != disp.talla]
+    if otras:
+        return f"{falta} Tengo disponible: {', '.join(otras)}. ¿Quieres alguna de esas?"
+    return f"{falta} ¿Te muestro opciones similares?"
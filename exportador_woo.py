@@ -0,0 +1,359 @@
+# exportador_woo.py
+"""
+Exportación de pedidos confirmados a WooCommerce (orders/batch).
+
+• Opt-in: solo corre con EXPORT_WOO=1 (además de las credenciales de Woo).
+  Sin la variable no se encola nada ni arranca el hilo, así un despliegue
+  que ya carga los pedidos en Woo por otro lado no los duplica.
+• Al confirmar, encolar() deja una fila en exportaciones_woo con la foto
+  del carrito y el total de ese momento, y despierta al exportador. La
+  respuesta al cliente no espera a Woo.
+• La sesión conserva su número al reabrirse: cada confirmación con un
+  carrito distinto es una fila nueva (numero_confirmacion, secuencia) y un
+  pedido Woo aparte (CAS-…, CAS-…-2, …). Repetir la misma confirmación no
+  duplica.
+• Un hilo toma las filas vencidas con un lease (EXPORT_LEASE_S, así otra
+  instancia no las toma a la vez), arma cada pedido con los datos de
+  `pedidos` y la foto del carrito, y los crea en tandas de EXPORT_LOTE con
+  una sola llamada.
+• Si falla, reintenta con backoff exponencial (desde EXPORT_BACKOFF_S hasta
+  1 h) hasta EXPORT_MAX_INTENTOS; después la fila queda en 'error' para
+  revisión. Un reinicio no pierde nada: lo pendiente sigue en la tabla.
+• Idempotencia: el número de confirmación (con su secuencia) viaja en
+  meta_data (_cassany_confirmacion). Si una fila ya se intentó antes (la respuesta
+  pudo perderse con el pedido ya creado), se busca en Woo por teléfono y se
+  compara ese meta antes de volver a crearla.
+"""
+from __future__ import annotations
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text as sa_text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import catalogo_local
+import woocommerce_client as wc
+from carrito import LineaCarrito, cargar_lineas, cart_total
+from database import SessionLocal, execute_write
+from registro import logger
+
+log = logger("exportador_woo")
+
+EXPORT_WOO = os.getenv("EXPORT_WOO", "0") == "1"   # opt-in
+EXPORT_LOTE = max(1, min(100, int(os.getenv("EXPORT_LOTE", "50"))))   # Woo acepta hasta 100 por batch
+EXPORT_INTERVALO_S = float(os.getenv("EXPORT_INTERVALO_S", "30"))
+EXPORT_VENTANA_S = float(os.getenv("EXPORT_VENTANA_S", "2"))          # espera tras despertar para juntar más
+EXPORT_LEASE_S = float(os.getenv("EXPORT_LEASE_S", "120"))
+EXPORT_MAX_INTENTOS = int(os.getenv("EXPORT_MAX_INTENTOS", "8"))
+EXPORT_BACKOFF_S = float(os.getenv("EXPORT_BACKOFF_S", "30"))
+EXPORT_ESTADO_WOO = os.getenv("EXPORT_ESTADO_WOO", "on-hold")        # el pago lo verifica el equipo
+
+META_CONFIRMACION = "_cassany_confirmacion"
+METODOS_PAGO = {
+    "transferencia": "Transferencia bancaria",
+    "payu": "PayU",
+    "pago_en_tienda": "Pago en tienda",
+}
+
+EXPORT_METRICS: Dict[str, int] = {"encolados": 0, "lotes": 0, "exportados": 0, "ya_existian": 0, "fallidos": 0, "descartados": 0}
+
+_despertar = threading.Event()
+_detener = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+def _ahora() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# ======================================================================
+# Cola
+# ======================================================================
+def clave_exportacion(numero: str, secuencia: int) -> str:
+    """Número con el que se crea el pedido en Woo: la 1.ª confirmación va tal cual, las siguientes con -2, -3…"""
+    return numero if int(secuencia or 1) <= 1 else f"{numero}-{int(secuencia)}"
+
+
+def encolar(db: Session, pedido) -> bool:
+    """
+    Agrega el pedido confirmado a la cola con la foto de su carrito. Si la última
+    fila de ese número tiene el mismo carrito es la misma confirmación y no se
+    encola; si cambió (sesión reabierta), entra con la secuencia siguiente.
+    """
+    numero = (getattr(pedido, "numero_confirmacion", None) or "").strip()
+    if not EXPORT_WOO or not numero or not getattr(pedido, "id", None):
+        return False
+    try:
+        row = db.execute(sa_text("SELECT carrito_json, subtotal FROM pedidos WHERE id=:id"), {"id": pedido.id}).fetchone()
+        carrito_json = (row[0] if row else None) or "[]"
+        total = cart_total(cargar_lineas(carrito_json)) or float((row[1] if row else 0) or 0)
+        ultima = db.execute(
+            sa_text("SELECT secuencia, carrito_json FROM exportaciones_woo WHERE numero_confirmacion=:n "
+                    "ORDER BY secuencia DESC LIMIT 1"), {"n": numero}
+        ).fetchone()
+        if ultima and ultima[1] == carrito_json:
+            return False
+        execute_write(
+            db,
+            sa_text("INSERT INTO exportaciones_woo (pedido_id, numero_confirmacion, secuencia, carrito_json, total, "
+                    "estado, intentos, proximo_intento, creado) "
+                    "VALUES (:pid, :n, :sec, :c, :t, 'pendiente', 0, :ahora, :ahora)"),
+            {"pid": pedido.id, "n": numero, "sec": (int(ultima[0]) + 1) if ultima else 1,
+             "c": carrito_json, "t": total, "ahora": _ahora()},
+        )
+    except IntegrityError:
+        db.rollback()   # otro mensaje lo encoló a la vez
+        return False
+    except Exception as e:
+        db.rollback()
+        log.error("woo_export.encolar_fallido", exc=e, numero=numero)
+        return False
+    EXPORT_METRICS["encolados"] += 1
+    _despertar.set()
+    return True
+
+
+def _reclamar(db: Session) -> List[Dict[str, Any]]:
+    """Toma hasta EXPORT_LOTE filas vencidas; cada una se reclama con CAS sobre `intentos`."""
+    ahora = _ahora()
+    filas = db.execute(
+        sa_text("SELECT id, pedido_id, numero_confirmacion, secuencia, carrito_json, total, intentos, creado "
+                "FROM exportaciones_woo WHERE estado IN ('pendiente', 'enviando') AND proximo_intento <= :ahora "
+                "ORDER BY id LIMIT :n"),
+        {"ahora": ahora, "n": EXPORT_LOTE},
+    ).fetchall()
+    tomadas = []
+    for fid, pedido_id, numero, secuencia, carrito_json, total, intentos, creado in filas:
+        n = execute_write(
+            db,
+            sa_text("UPDATE exportaciones_woo SET estado='enviando', intentos=:i + 1, proximo_intento=:lease "
+                    "WHERE id=:id AND intentos=:i AND estado IN ('pendiente', 'enviando')"),
+            {"id": fid, "i": intentos, "lease": ahora + timedelta(seconds=EXPORT_LEASE_S)},
+        )
+        if n:
+            tomadas.append({"id": fid, "pedido_id": pedido_id, "numero": clave_exportacion(numero, secuencia),
+                            "carrito_json": carrito_json, "total": total, "intentos": intentos + 1, "creado": creado})
+    return tomadas
+
+
+def _marcar_exportado(db: Session, fila: Dict[str, Any], woo_id: int):
+    execute_write(
+        db,
+        sa_text("UPDATE exportaciones_woo SET estado='exportado', woo_order_id=:w, ultimo_error=NULL WHERE id=:id"),
+        {"id": fila["id"], "w": int(woo_id)},
+    )
+
+
+def _marcar_fallo(db: Session, fila: Dict[str, Any], error: str, definitivo: bool = False):
+    agotado = definitivo or fila["intentos"] >= EXPORT_MAX_INTENTOS
+    espera = min(EXPORT_BACKOFF_S * 2 ** (fila["intentos"] - 1), 3600.0)
+    execute_write(
+        db,
+        sa_text("UPDATE exportaciones_woo SET estado=:e, ultimo_error=:err, proximo_intento=:p WHERE id=:id"),
+        {"id": fila["id"], "e": "error" if agotado else "pendiente", "err": str(error)[:1000],
+         "p": _ahora() + timedelta(seconds=espera)},
+    )
+    EXPORT_METRICS["descartados" if agotado else "fallidos"] += 1
+    if agotado:
+        log.error("woo_export.descartado", numero=fila["numero"], intentos=fila["intentos"], error=str(error))
+
+
+# ======================================================================
+# Armado del pedido Woo
+# ======================================================================
+def _variacion(pid: int, linea: LineaCarrito, cat) -> Optional[int]:
+    talla = (linea.talla or "").strip().upper()
+    color = (linea.color or "").strip().lower()
+    candidatas = [
+        v for v in cat.variaciones.get(pid, ())
+        if not talla or str(catalogo_local.talla_de_variacion(v) or "").strip().upper() == talla
+    ]
+    if color and len(candidatas) > 1:
+        candidatas = [v for v in candidatas if str(catalogo_local.color_de_variacion(v) or "").lower() == color] or candidatas
+    return int(candidatas[0]["id"]) if candidatas and candidatas[0].get("id") else None
+
+
+def _linea_woo(linea: LineaCarrito, cat) -> Dict[str, Any]:
+    """Línea Woo con el precio que vio el cliente; product/variation_id desde el espejo si se resuelven."""
+    total = f"{linea.subtotal:.2f}"
+    item: Dict[str, Any] = {"name": linea.nombre, "quantity": linea.cantidad, "subtotal": total, "total": total}
+    pid = cat.resolver(linea.sku) if cat is not None else None
+    if pid:
+        item["product_id"] = pid
+        if cat.productos[pid].get("type") == "variable":
+            vid = _variacion(pid, linea, cat)
+            if vid:
+                item["variation_id"] = vid
+    meta = [{"key": k, "value": v} for k, v in (("Talla", linea.talla), ("Color", linea.color)) if v]
+    if meta:
+        item["meta_data"] = meta
+    return item
+
+
+def pedido_woo(pedido, numero: str, carrito_json: Optional[str] = None, total: Optional[float] = None) -> Dict[str, Any]:
+    """Payload de orders/batch (create) para un pedido confirmado (carrito y total: la foto de la cola)."""
+    cat = catalogo_local.get_catalogo()
+    lineas = cargar_lineas(carrito_json or "[]")
+    if not lineas and getattr(pedido, "producto", None):
+        # pedidos viejos de un solo producto (sin carrito)
+        lineas = [LineaCarrito(pedido.producto, pedido.producto, talla=pedido.talla,
+                               cantidad=pedido.cantidad or 1, precio_unitario=pedido.precio_unitario or 0.0)]
+    nombre = (pedido.nombre_cliente or "").split()
+    direccion = {
+        "first_name": nombre[0] if nombre else "",
+        "last_name": " ".join(nombre[1:]),
+        "address_1": pedido.direccion or "",
+        "city": pedido.ciudad or "",
+        "country": "CO",
+    }
+    entrega = (pedido.metodo_entrega or "").replace("_", " ")
+    nota = f"Pedido por WhatsApp {numero}. Entrega: {entrega or 'pendiente'}."
+    if pedido.punto_venta:
+        nota += f" Punto de venta: {pedido.punto_venta}."
+    return {
+        "status": EXPORT_ESTADO_WOO,
+        "set_paid": False,
+        "payment_method": pedido.metodo_pago or "",
+        "payment_method_title": METODOS_PAGO.get(pedido.metodo_pago or "", pedido.metodo_pago or ""),
+        "billing": {**direccion, "phone": pedido.telefono or ""},
+        "shipping": direccion if pedido.metodo_entrega == "domicilio" else {},
+        "customer_note": nota,
+        "line_items": [_linea_woo(it, cat) for it in lineas],
+        "meta_data": [
+            {"key": META_CONFIRMACION, "value": numero},
+            {"key": "_cassany_session", "value": pedido.session_id},
+            {"key": "_cassany_metodo_entrega", "value": pedido.metodo_entrega or ""},
+        ] + ([{"key": "_cassany_total", "value": f"{float(total):.2f}"}] if total is not None else []),
+    }
+
+
+def _ya_creado(pedido, numero: str, creado) -> Optional[int]:
+    """ID Woo de un pedido ya creado con este número (intento previo cuya respuesta se perdió)."""
+    busqueda = (pedido.telefono or pedido.nombre_cliente or "").strip()
+    if not busqueda:
+        return None
+    try:
+        desde = (creado if isinstance(creado, datetime) else datetime.fromisoformat(str(creado)))
+        desde = (desde if desde.tzinfo else desde.replace(tzinfo=timezone.utc)) - timedelta(days=1)
+        after = desde.strftime("%Y-%m-%dT%H:%M:%S")
+    except Exception:
+        after = None
+    data = wc.search_orders(busqueda, after=after)
+    if not isinstance(data, list):
+        raise RuntimeError((data or {}).get("error") or "búsqueda de pedidos falló")
+    for o in data:
+        if any(m.get("key") == META_CONFIRMACION and m.get("value") == numero for m in o.get("meta_data") or []):
+            return int(o["id"])
+    return None
+
+
+# ======================================================================
+# Exportación
+# ======================================================================
+def exportar_pendientes() -> Dict[str, int]:
+    """Una pasada: reclama un lote, descarta lo ya creado y crea el resto con orders/batch."""
+    from models import Pedido
+
+    resumen = {"tomados": 0, "exportados": 0, "fallidos": 0}
+    with SessionLocal() as db:
+        filas = _reclamar(db)
+        resumen["tomados"] = len(filas)
+        if not filas:
+            return resumen
+        ids = [f["pedido_id"] for f in filas]
+        pedidos = {p.id: p for p in db.query(Pedido).filter(Pedido.id.in_(ids))}
+        por_crear, payloads = [], []
+        for fila in filas:
+            pedido = pedidos.get(fila["pedido_id"])
+            if pedido is None:
+                _marcar_fallo(db, fila, "pedido inexistente", definitivo=True)
+                continue
+            try:
+                if fila["intentos"] > 1:
+                    woo_id = _ya_creado(pedido, fila["numero"], fila["creado"])
+                    if woo_id:
+                        _marcar_exportado(db, fila, woo_id)
+                        EXPORT_METRICS["ya_existian"] += 1
+                        resumen["exportados"] += 1
+                        continue
+                payload = pedido_woo(pedido, fila["numero"], fila["carrito_json"], fila["total"])
+            except Exception as e:
+                _marcar_fallo(db, fila, repr(e))
+                resumen["fallidos"] += 1
+                continue
+            if not payload["line_items"]:
+                _marcar_fallo(db, fila, "pedido sin líneas", definitivo=True)
+                resumen["fallidos"] += 1
+                continue
+            por_crear.append(fila)
+            payloads.append(payload)
+
+        if payloads:
+            EXPORT_METRICS["lotes"] += 1
+            res = wc.create_orders_batch(payloads)
+            creados = res.get("create") if isinstance(res, dict) else None
+            if not isinstance(creados, list) or len(creados) != len(por_crear):
+                error = (res or {}).get("error") if isinstance(res, dict) else None
+                for fila in por_crear:
+                    _marcar_fallo(db, fila, error or "respuesta inválida de orders/batch")
+                resumen["fallidos"] += len(por_crear)
+            else:
+                for fila, orden in zip(por_crear, creados):
+                    if isinstance(orden, dict) and orden.get("id") and not orden.get("error"):
+                        _marcar_exportado(db, fila, orden["id"])
+                        EXPORT_METRICS["exportados"] += 1
+                        resumen["exportados"] += 1
+                    else:
+                        _marcar_fallo(db, fila, (orden or {}).get("error") or "sin id")
+                        resumen["fallidos"] += 1
+    return resumen
+
+
+def estado_cola() -> Dict[str, Any]:
+    with SessionLocal() as db:
+        filas = db.execute(sa_text("SELECT estado, COUNT(*) FROM exportaciones_woo GROUP BY estado")).fetchall()
+    return {"cola": {e: n for e, n in filas}, **EXPORT_METRICS}
+
+
+def _loop():
+    while not _detener.is_set():
+        despertado = _despertar.wait(EXPORT_INTERVALO_S)
+        _despertar.clear()
+        if _detener.is_set():
+            break
+        if despertado and EXPORT_VENTANA_S > 0:
+            _detener.wait(EXPORT_VENTANA_S)   # junta los que confirmen en la misma ráfaga
+        try:
+            while exportar_pendientes()["tomados"] >= EXPORT_LOTE and not _detener.is_set():
+                pass
+        except Exception as e:
+            print("❌ Error exportando pedidos a Woo:", repr(e))
+
+
+def iniciar_exportador() -> bool:
+    """Lanza el hilo exportador (y una pasada inmediata por lo que quedó pendiente)."""
+    global _thread
+    if not EXPORT_WOO:
+        return False
+    if not (wc.WC_CONSUMER_KEY and wc.WC_CONSUMER_SECRET):
+        print("⚠️  Exportación a Woo desactivada: faltan credenciales de WooCommerce.")
+        return False
+    if _thread is None or not _thread.is_alive():
+        _detener.clear()
+        _thread = threading.Thread(target=_loop, name="exportador-woo", daemon=True)
+        _thread.start()
+    _despertar.set()
+    return True
+
+
+def detener_exportador():
+    _detener.set()
+    _despertar.set()
+
+
+# Pasada manual: python exportador_woo.py
+if __name__ == "__main__":
+    print(exportar_pendientes())
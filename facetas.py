@@ -0,0 +1,113 @@
+# facetas.py
+"""
+Facetas estructuradas por producto (manga, subtipo, colores básicos, usos y
+tallas disponibles) más su texto ya normalizado.
+
+El catálogo local las calcula una sola vez al cargar o refrescar el snapshot;
+los filtros del bot comparan valores en vez de normalizar cadenas por consulta.
+"""
+from __future__ import annotations
+import re
+import unicodedata
+from typing import Dict, FrozenSet, Iterable, Optional
+
+from filtros import USO_RE
+
+_PALABRA_RE = re.compile(r"[a-z0-9]+")
+
+# Colores canónicos (sin tildes) y variantes que se reducen a ellos
+_COLOR_ALIAS = {
+    "blanca": "blanco", "negra": "negro", "azules": "azul", "roja": "rojo",
+    "rosado": "rosa", "rosada": "rosa", "amarilla": "amarillo", "morada": "morado",
+}
+COLORES = {
+    "negro", "blanco", "azul", "rojo", "verde", "gris", "beige", "marron", "cafe",
+    "amarillo", "naranja", "morado", "lila", "vinotinto", "mostaza", "crema",
+    "turquesa", "celeste", "rosa",
+}
+
+
+def normalizar(txt: str) -> str:
+    """Minúsculas y sin tildes: la única normalización de texto del catálogo."""
+    txt = unicodedata.normalize("NFD", txt or "")
+    txt = "".join(c for c in txt if unicodedata.category(c) != "Mn")
+    return txt.lower()
+
+
+def color_canonico(color: Optional[str]) -> Optional[str]:
+    if not color:
+        return None
+    c = normalizar(str(color)).strip()
+    c = _COLOR_ALIAS.get(c, c)
+    return c if c in COLORES else None
+
+
+def texto_de_producto(p: dict) -> str:
+    """Concatena campos útiles del producto (nombre, categorías, etiquetas, atributos) ya normalizados."""
+    parts = [
+        p.get("name", ""),
+        " ".join([c.get("name", "") for c in p.get("categories", []) or []]),
+        " ".join([t.get("name", "") for t in p.get("tags", []) or []]),
+    ]
+    for a in (p.get("attributes") or []):
+        parts.append(a.get("name", ""))
+        for opt in a.get("options", []) or []:
+            parts.append(str(opt))
+    return normalizar(" ".join(parts))
+
+
+class Facetas:
+    __slots__ = ("texto", "manga", "subtipo", "colores", "usos", "tallas")
+
+    def __init__(self, texto: str, manga: Optional[str], subtipo: Optional[str],
+                 colores: FrozenSet[str], usos: FrozenSet[str], tallas: FrozenSet[str]):
+        self.texto = texto
+        self.manga = manga        # "larga" | "corta" | None (ninguna o ambas)
+        self.subtipo = subtipo    # "guayabera" | None
+        self.colores = colores
+        self.usos = usos
+        self.tallas = tallas      # tallas con variación en stock (vacío si no es variable)
+
+    def items(self) -> Iterable[tuple]:
+        """Pares (faceta, valor) para armar índices inversos."""
+        if self.manga:
+            yield "manga", self.manga
+        if self.subtipo:
+            yield "subtipo", self.subtipo
+        for c in self.colores:
+            yield "color", c
+        for u in self.usos:
+            yield "uso", u
+        for t in self.tallas:
+            yield "talla", t
+
+    def cumple(self, attrs: Dict[str, Optional[str]]) -> bool:
+        """Mismo criterio que el espejo: manga exclusiva; subtipo, color y uso presentes."""
+        if attrs.get("subtipo") and attrs["subtipo"] != self.subtipo:
+            return False
+        if attrs.get("manga") and attrs["manga"] != self.manga:
+            return False
+        if attrs.get("color") and color_canonico(attrs["color"]) not in self.colores:
+            return False
+        if attrs.get("uso") and str(attrs["uso"]).lower() not in self.usos:
+            return False
+        if attrs.get("talla") and self.tallas and str(attrs["talla"]).upper() not in self.tallas:
+            return False
+        return True
+
+
+def calcular_facetas(p: dict, tallas: Iterable[str] = ()) -> Facetas:
+    texto = texto_de_producto(p)
+    larga, corta = "manga larga" in texto, "manga corta" in texto
+    manga = "larga" if larga and not corta else "corta" if corta and not larga else None
+    palabras = set(_PALABRA_RE.findall(texto))
+    colores = frozenset(c for c in (color_canonico(w) for w in palabras) if c)
+    usos = frozenset(m.lower() for m in USO_RE.findall(texto))
+    return Facetas(
+        texto=texto,
+        manga=manga,
+        subtipo="guayabera" if "guayabera" in texto else None,
+        colores=colores,
+        usos=usos,
+        tallas=frozenset(str(t).strip().upper() for t in tallas if t),
+    )
@@ -0,0 +1,70 @@
+# historial_vistos.py
+"""
+Historial acotado de productos ya sugeridos en una sesión.
+
+Guarda IDs de producto de WooCommerce (no permalinks) en orden LRU con tope
+fijo, así la exclusión de repetidos es O(1) y la columna `vistos_json`
+nunca crece más allá de VISTOS_MAX elementos.
+"""
+from __future__ import annotations
+import os
+import json
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional
+
+VISTOS_MAX = int(os.getenv("VISTOS_MAX", "200"))
+
+
+def _as_id(v) -> Optional[int]:
+    try:
+        i = int(v)
+        return i if i > 0 else None
+    except Exception:
+        return None
+
+
+class HistorialVistos:
+    """Conjunto de IDs con expulsión del más antiguo al superar la capacidad."""
+
+    __slots__ = ("_ids", "capacidad")
+
+    def __init__(self, ids: Iterable = (), capacidad: int = VISTOS_MAX):
+        self.capacidad = max(1, int(capacidad))
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+        self.agregar(ids)
+
+    def __contains__(self, pid) -> bool:
+        return pid in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    def agregar(self, ids: Iterable) -> bool:
+        """Marca IDs como vistos (los ya presentes pasan al final). Devuelve True si cambió algo."""
+        cambio = False
+        for v in ids or ():
+            pid = _as_id(v)
+            if pid is None:
+                continue
+            if pid in self._ids:
+                self._ids.move_to_end(pid)
+            else:
+                self._ids[pid] = None
+            cambio = True
+        while len(self._ids) > self.capacidad:
+            self._ids.popitem(last=False)
+        return cambio
+
+    def to_json(self) -> str:
+        return json.dumps(list(self._ids), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, raw: Optional[str], capacidad: int = VISTOS_MAX) -> "HistorialVistos":
+        try:
+            data = json.loads(raw) if raw else []
+        except Exception:
+            data = []
+        return cls(data if isinstance(data, list) else [], capacidad=capacidad)
@@ -2,15 +2,19 @@
 import os
 import re
 import time
-import json
 import hashlib
 import requests
 from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
+from carrito import cargar_lineas
+from registro import logger
+from trazas import medir
 
 load_dotenv()
 
+log = logger("hubspot")
+
 # ========= Config =========
 HUBSPOT_TOKEN = os.getenv("HUBSPOT_ACCESS_TOKEN", "").strip()
 HS_DEFAULT_OWNER_ID = os.getenv("HS_DEFAULT_OWNER_ID", "").strip()
@@ -139,25 +143,17 @@ def _carrito_desde_pedido(pedido) -> List[dict]:
     """
     items: List[dict] = []
     try:
-        raw = getattr(pedido, "carrito_json", "[]") or "[]"
-        data = json.loads(raw) if isinstance(raw, str) else (raw or [])
-        if isinstance(data, list) and data:
-            for it in data:
-                nombre = it.get("nombre") or getattr(pedido, "producto", "") or "Producto"
-                sku = it.get("sku") or it.get("url") or nombre
-                size = it.get("talla")
-                qty  = int(it.get("cantidad", 1) or 1)
-                unit = float(it.get("precio_unitario", 0.0) or 0.0)
-                items.append({
-                    "product_name": nombre,
-                    "sku": sku,
-                    "size": size,
-                    "quantity": qty,
-                    "unit_price": unit,
-                    "subtotal": unit * qty,
-                    "categoria": it.get("categoria"),
-                    "color": it.get("color"),
-                })
+        for it in cargar_lineas(getattr(pedido, "carrito_json", "[]") or "[]"):
+            items.append({
+                "product_name": it.nombre,
+                "sku": it.sku,
+                "size": it.talla,
+                "quantity": it.cantidad,
+                "unit_price": it.precio_unitario,
+                "subtotal": it.subtotal,
+                "categoria": it.categoria,
+                "color": it.color,
+            })
     except Exception:
         items = []
 
@@ -300,6 +296,18 @@ def _build_search_body(email: str, phone_variants: Tuple[str, str]) -> Dict[str,
         "limit": 1,
     }
 
+def _log_error(evento: str, e: Exception):
+    """Error de HubSpot sin el cuerpo de la respuesta (trae datos del contacto): status y categoría."""
+    resp = e.response if isinstance(e, requests.HTTPError) else None
+    if resp is None:
+        log.error(evento, exc=e)
+        return
+    try:
+        data = resp.json() or {}
+    except ValueError:
+        data = {}
+    log.error(evento, status=resp.status_code, categoria=data.get("category"), correlation_id=data.get("correlationId"))
+
 def _search_contact(email: str, phone_variants: Tuple[str, str]) -> Optional[str]:
     try:
         body = _build_search_body(email, phone_variants)
@@ -309,13 +317,7 @@ def _search_contact(email: str, phone_variants: Tuple[str, str]) -> Optional[str
         if results:
             return results[0].get("id")
     except Exception as e:
-        try:
-            if isinstance(e, requests.HTTPError) and e.response is not None:
-                print("❌ HubSpot search contact error:", e, e.response.status_code, e.response.text)
-            else:
-                print("❌ HubSpot search contact error:", repr(e))
-        except Exception:
-            print("❌ HubSpot search contact error:", repr(e))
+        _log_error("hubspot.contacto_busqueda_fallida", e)
     return None
 
 def _build_email_from_phone(session_id: Optional[str], telefono: Optional[str]) -> str:
@@ -357,7 +359,7 @@ def _upsert_contact_and_get_id(pedido) -> Optional[str]:
     Si HS_UPSERT_CONTACTS=0: solo busca y retorna ID si existe; no crea.
     """
     if not HUBSPOT_TOKEN:
-        print("❗ Falta HUBSPOT_ACCESS_TOKEN en .env")
+        log.warning("hubspot.sin_token")
         return None
 
     props = _prepare_contact_properties(pedido)
@@ -375,9 +377,9 @@ def _upsert_contact_and_get_id(pedido) -> Optional[str]:
                 url = f"{BASE_CONTACTS}/{contact_id}"
                 r = _request_with_retry("PATCH", url, json_payload={"properties": props}, timeout=10)
                 r.raise_for_status()
-                print(f"✅ HubSpot UPDATE OK (contact {contact_id})")
+                log.info("hubspot.contacto_actualizado", contacto=contact_id)
             except Exception as e:
-                print("⚠️ No se pudo actualizar contacto existente:", repr(e))
+                _log_error("hubspot.contacto_actualizacion_fallida", e)
         return contact_id
 
     if not HS_UPSERT_CONTACTS:
@@ -389,16 +391,10 @@ def _upsert_contact_and_get_id(pedido) -> Optional[str]:
         r = _request_with_retry("POST", BASE_CONTACTS, json_payload={"properties": props}, timeout=10)
         r.raise_for_status()
         cid = (r.json() or {}).get("id")
-        print(f"✅ HubSpot CREATE OK (contact {cid})")
+        log.info("hubspot.contacto_creado", contacto=cid)
         return cid
     except Exception as e:
-        try:
-            if isinstance(e, requests.HTTPError) and e.response is not None:
-                print("❌ HubSpot create contact error:", e, e.response.status_code, e.response.text)
-            else:
-                print("❌ HubSpot create contact error:", repr(e))
-        except Exception:
-            print("❌ HubSpot create contact error:", repr(e))
+        _log_error("hubspot.contacto_alta_fallida", e)
     return None
 
 # ---------- Associations (para task->contact) ----------
@@ -446,13 +442,7 @@ def _associate_objects(from_obj: str, from_id: str, to_obj: str, to_id: str, *,
         r = _request_with_retry("PUT", url, json_payload=body, timeout=10)
         r.raise_for_status()
     except Exception as e:
-        try:
-            if isinstance(e, requests.HTTPError) and e.response is not None:
-                print("❌ HubSpot association error:", e, e.response.status_code, e.response.text)
-            else:
-                print("❌ HubSpot association error:", repr(e))
-        except Exception:
-            print("❌ HubSpot association error:", repr(e))
+        _log_error("hubspot.asociacion_fallida", e)
 
 # ---------- Tasks (buscar / crear / actualizar) ----------
 def _search_task_by_subject(subject: str) -> Optional[str]:
@@ -475,7 +465,7 @@ def _search_task_by_subject(subject: str) -> Optional[str]:
         if results:
             return results[0].get("id")
     except Exception as e:
-        print("❌ HubSpot search task error:", repr(e))
+        _log_error("hubspot.tarea_busqueda_fallida", e)
     return None
 
 def _now_epoch_ms_plus(hours: int = 0) -> int:
@@ -498,13 +488,7 @@ def _create_task(subject: str, body_text: str) -> Optional[str]:
         r.raise_for_status()
         return (r.json() or {}).get("id")
     except Exception as e:
-        try:
-            if isinstance(e, requests.HTTPError) and e.response is not None:
-                print("❌ HubSpot create task error:", e, e.response.status_code, e.response.text)
-            else:
-                print("❌ HubSpot create task error:", repr(e))
-        except Exception:
-            print("❌ HubSpot create task error:", repr(e))
+        _log_error("hubspot.tarea_alta_fallida", e)
     return None
 
 def _update_task(task_id: str, body_text: str) -> bool:
@@ -514,16 +498,11 @@ def _update_task(task_id: str, body_text: str) -> bool:
         r.raise_for_status()
         return True
     except Exception as e:
-        try:
-            if isinstance(e, requests.HTTPError) and e.response is not None:
-                print("❌ HubSpot update task error:", e, e.response.status_code, e.response.text)
-            else:
-                print("❌ HubSpot update task error:", repr(e))
-        except Exception:
-            print("❌ HubSpot update task error:", repr(e))
+        _log_error("hubspot.tarea_actualizacion_fallida", e)
     return False
 
 # ---------- API principal ----------
+@medir("hubspot.pedido")
 def enviar_pedido_a_hubspot(pedido) -> bool:
     """
     Crea o actualiza UNA Tarea con todo el pedido en el body.
@@ -532,7 +511,7 @@ def enviar_pedido_a_hubspot(pedido) -> bool:
     """
     try:
         if not HUBSPOT_TOKEN:
-            print("❗ Falta HUBSPOT_ACCESS_TOKEN en .env")
+            log.warning("hubspot.sin_token")
             return False
 
         # Construir subject/body
@@ -547,12 +526,12 @@ def enviar_pedido_a_hubspot(pedido) -> bool:
             ok = _update_task(task_id, body_txt)
             if not ok:
                 return False
-            print(f"ℹ️ Task actualizada (id={task_id}) subject='{subject}'")
+            log.info("hubspot.tarea_actualizada", tarea=task_id, pedido=order_id)
         else:
             task_id = _create_task(subject, body_txt)
             if not task_id:
                 return False
-            print(f"✅ Task creada (id={task_id}) subject='{subject}'")
+            log.info("hubspot.tarea_creada", tarea=task_id, pedido=order_id)
 
         # (Opcional) asociación a contacto
         if HS_TASK_ASSOC_CONTACTS:
@@ -575,5 +554,5 @@ def enviar_pedido_a_hubspot(pedido) -> bool:
         return True
 
     except Exception as e:
-        print("❌ Error enviar_pedido_a_hubspot:", repr(e))
+        log.error("hubspot.pedido_fallido", exc=e)
         return False
@@ -0,0 +1,200 @@
+# indice_busqueda.py
+"""
+Índice invertido en memoria sobre el catálogo: nombre, categorías, etiquetas
+y opciones de atributos de cada producto. Se arma una vez por refresco del
+catálogo (catalogo_local) y se consulta sin recorrer productos.
+
+• Insensible a tildes y mayúsculas; plurales simples reducidos (camisas → camisa).
+• Términos sueltos se buscan por prefijo ("camis" → camisa, camiseta…).
+• Frases entre comillas exigen tokens contiguos dentro del mismo campo.
+"""
+from __future__ import annotations
+import re
+import bisect
+from typing import Dict, Iterable, List, Optional, Set
+
+from facetas import normalizar
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_FRASE_RE = re.compile(r'"([^"]+)"')
+
+# Separación de posiciones entre campos: una frase nunca cruza de un campo a otro
+_GAP_CAMPO = 8
+# Prefijos más cortos que esto se buscan exactos (evita que "de" abra medio vocabulario)
+_MIN_PREFIJO = 3
+
+STOPWORDS = {
+    "a", "al", "algo", "alguna", "algunas", "alguno", "algunos", "busco", "como", "con",
+    "de", "del", "el", "en", "es", "esta", "este", "hay", "la", "las", "lo", "los", "me",
+    "mi", "muestrame", "mostrar", "necesito", "o", "para", "por", "puedes", "que", "quiero",
+    "se", "si", "sin", "su", "te", "tienen", "tienes", "un", "una", "unas", "uno", "unos",
+    "ver", "y", "ya",
+}
+
+
+def _raiz(tok: str) -> str:
+    """Reduce plurales simples del español: camisas→camisa, pantalones→pantalon, azules→azul."""
+    if len(tok) <= 3 or tok.isdigit():
+        return tok
+    if tok.endswith("es") and len(tok) > 4 and tok[-3] in "lnrdzj":
+        return tok[:-2]
+    if tok.endswith("s"):
+        return tok[:-1]
+    return tok
+
+
+def tokenizar(txt: str) -> List[str]:
+    return [_raiz(t) for t in _TOKEN_RE.findall(normalizar(txt))]
+
+
+class IndiceTexto:
+    """
+    Índice posicional token → {doc_id: [posiciones]} con vocabulario ordenado para prefijos.
+    copia() comparte las listas de postings con el original y solo duplica las
+    que toca (copy-on-write): los lectores del índice viejo no ven cambios a medias.
+    """
+
+    __slots__ = ("_post", "_docs", "_vocab", "_vocab_sucio", "_propios")
+
+    def __init__(self):
+        self._post: Dict[str, Dict[int, List[int]]] = {}
+        self._docs: Dict[int, Set[str]] = {}
+        self._vocab: List[str] = []
+        self._vocab_sucio = False
+        self._propios: Set[str] = set()   # tokens cuyos postings pertenecen a esta instancia
+
+    def copia(self) -> "IndiceTexto":
+        nuevo = IndiceTexto()
+        nuevo._post = dict(self._post)
+        nuevo._docs = dict(self._docs)
+        nuevo._vocab = self._vocabulario()
+        return nuevo
+
+    def _postings_propios(self, tok: str) -> Optional[Dict[int, List[int]]]:
+        postings = self._post.get(tok)
+        if postings is not None and tok not in self._propios:
+            postings = self._post[tok] = dict(postings)
+            self._propios.add(tok)
+        return postings
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._docs
+
+    # ---------- mantenimiento ----------
+    def agregar(self, doc_id: int, campos: Iterable[str]):
+        """Indexa (o re-indexa) un documento; cada elemento de 'campos' es un campo independiente."""
+        if doc_id in self._docs:
+            self.quitar(doc_id)
+        pos = 0
+        vistos: Set[str] = set()
+        for campo in campos:
+            for tok in tokenizar(campo):
+                postings = self._postings_propios(tok)
+                if postings is None:
+                    postings = self._post[tok] = {}
+                    self._propios.add(tok)
+                    self._vocab_sucio = True
+                postings.setdefault(doc_id, []).append(pos)
+                vistos.add(tok)
+                pos += 1
+            pos += _GAP_CAMPO
+        self._docs[doc_id] = vistos
+
+    def quitar(self, doc_id: int):
+        for tok in self._docs.pop(doc_id, ()):
+            postings = self._postings_propios(tok)
+            if postings is None:
+                continue
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._post[tok]
+                self._propios.discard(tok)
+                self._vocab_sucio = True
+
+    def _vocabulario(self) -> List[str]:
+        if self._vocab_sucio:
+            self._vocab = sorted(self._post)
+            self._vocab_sucio = False
+        return self._vocab
+
+    # ---------- consultas ----------
+    def _expandir(self, tok: str, prefijo: bool) -> List[str]:
+        if not prefijo or len(tok) < _MIN_PREFIJO:
+            return [tok] if tok in self._post else []
+        vocab = self._vocabulario()
+        i = bisect.bisect_left(vocab, tok)
+        out = []
+        while i < len(vocab) and vocab[i].startswith(tok):
+            out.append(vocab[i])
+            i += 1
+        return out
+
+    def termino(self, palabra: str, prefijo: bool = True) -> Set[int]:
+        """Documentos que contienen el término (ya normalizado o no)."""
+        toks = tokenizar(palabra)
+        if not toks:
+            return set()
+        if len(toks) > 1:
+            return self.frase(palabra)
+        out: Set[int] = set()
+        for t in self._expandir(toks[0], prefijo):
+            out.update(self._post[t])
+        return out
+
+    def frase(self, texto: str) -> Set[int]:
+        """Documentos con los tokens de 'texto' contiguos y en orden."""
+        toks = tokenizar(texto)
+        if not toks:
+            return set()
+        listas = [self._post.get(t) for t in toks]
+        if any(p is None for p in listas):
+            return set()
+        candidatos = set(listas[0])
+        for p in listas[1:]:
+            candidatos &= p.keys()
+        if len(toks) == 1:
+            return candidatos
+        out: Set[int] = set()
+        for doc in candidatos:
+            siguientes = set(listas[0][doc])
+            for k, p in enumerate(listas[1:], 1):
+                siguientes = {x + 1 for x in siguientes} & set(p[doc])
+                if not siguientes:
+                    break
+            if siguientes:
+                out.add(doc)
+        return out
+
+    def alguno(self, palabras: Iterable[str]) -> Set[int]:
+        out: Set[int] = set()
+        for w in palabras:
+            out |= self.termino(w)
+        return out
+
+    def buscar(self, consulta: str, flexible: bool = False) -> Set[int]:
+        """
+        AND de frases (entre comillas) y términos por prefijo.
+        flexible=True ignora términos sin coincidencias (útil con texto libre
+        del cliente, donde sobran palabras); sin ningún término útil devuelve vacío.
+        """
+        frases = _FRASE_RE.findall(consulta or "")
+        resto = _FRASE_RE.sub(" ", consulta or "")
+        conjuntos: List[Set[int]] = [self.frase(f) for f in frases]
+        for t in tokenizar(resto):
+            if t in STOPWORDS:
+                continue
+            conjuntos.append(self.termino(t))
+        if flexible:
+            conjuntos = [c for c in conjuntos if c]
+        if not conjuntos:
+            return set()
+        conjuntos.sort(key=len)
+        out = set(conjuntos[0])
+        for c in conjuntos[1:]:
+            out &= c
+            if not out:
+                break
+        return out
@@ -1,14 +1,42 @@
 # main.py
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 from api_core import router as api_router, init_runtime as init_api_runtime
 from webhook import router as webhook_router
-from database import init_db
+from webhook_woo import router as woo_webhook_router
+from routes_agent import router as agent_router
+from arranque import calentar, ESTADO as ARRANQUE
+from database import init_db, pool_metrics, ping_async_db, async_engine, UOW_METRICS, sqlite_writer
+from version_pedido import CAS_METRICS
+from disponibilidad import DISPONIBILIDAD_METRICS
+from exportador_woo import iniciar_exportador, detener_exportador, estado_cola, EXPORT_METRICS
+import trazas
+import registro
 
 APP_BUILD = "build_10_fixed"  # conserva tu número de build
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Inicializaciones (DB, clientes externos, etc.) antes de aceptar tráfico
+    init_db()
+    init_api_runtime()  # crea clientes (OpenAI), carga .env, etc.
+    # Catálogo en segundo plano: /__ready pasa a 200 cuando está caliente
+    tarea = asyncio.create_task(calentar())
+    # Pedidos confirmados → WooCommerce (cola en exportaciones_woo)
+    iniciar_exportador()
+    yield
+    tarea.cancel()
+    detener_exportador()
+    registro.detener()
+    if sqlite_writer is not None:
+        sqlite_writer.stop()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -17,13 +45,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Inicializaciones (DB, clientes externos, etc.)
-init_db()
-init_api_runtime()  # crea clientes (OpenAI), carga .env, etc.
+@app.middleware("http")
+async def correlacion(request: Request, call_next):
+    # Un id por request para correlacionar logs (respeta X-Request-ID del proxy)
+    req = registro.nuevo_request(request.headers.get("x-request-id"))
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = req
+    return response
 
 # Rutas
 app.include_router(api_router)
 app.include_router(webhook_router)
+app.include_router(woo_webhook_router)
+app.include_router(agent_router)
 
 @app.get("/")
 def root():
@@ -32,3 +66,37 @@ def root():
 @app.get("/__version")
 def version():
     return {"build": APP_BUILD}
+
+@app.get("/__ready")
+def ready():
+    # Para el startup/readiness probe: 503 mientras el catálogo se calienta
+    return JSONResponse(ARRANQUE, status_code=200 if ARRANQUE.get("listo") else 503)
+
+@app.get("/__db")
+async def db_status():
+    estado = {"pools": pool_metrics(), "unit_of_work": dict(UOW_METRICS), "cas": dict(CAS_METRICS),
+              "disponibilidad": dict(DISPONIBILIDAD_METRICS)}
+    if sqlite_writer is not None:
+        estado["sqlite_writer"] = dict(sqlite_writer.metrics)
+    try:
+        estado["exportacion_woo"] = await asyncio.to_thread(estado_cola)
+    except Exception as e:
+        estado["exportacion_woo"] = {"error": repr(e)}
+    if async_engine is not None:
+        try:
+            estado["async_ok"] = await ping_async_db()
+        except Exception as e:
+            estado["async_ok"] = False
+            estado["async_error"] = repr(e)
+    estado["etapas"] = trazas.resumen()
+    estado["logs"] = dict(registro.LOG_METRICS)
+    return estado
+
+@app.get("/metrics")
+def metrics():
+    # Formato Prometheus: histogramas por etapa + contadores de cada módulo
+    contadores = {"cas": CAS_METRICS, "disponibilidad": DISPONIBILIDAD_METRICS,
+                  "unit_of_work": UOW_METRICS, "exportacion_woo": EXPORT_METRICS, "logs": registro.LOG_METRICS}
+    if sqlite_writer is not None:
+        contadores["sqlite_writer"] = sqlite_writer.metrics
+    return PlainTextResponse(trazas.metricas_prometheus(contadores), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,168 @@
+# memoria_agente.py
+"""
+Memoria de conversación del agente (/agent/chat), por sesión, en la columna
+`agente_json` de pedidos.
+
+• Se guardan los últimos turnos (cliente / asesor) y un catálogo compacto de
+  los productos ya mostrados (sku → nombre, precio, tallas, url), así el
+  modelo no vuelve a llamar search_products para algo que ya vio.
+• Cuando los turnos pasan de AGENTE_MAX_TURNOS o del presupuesto, los más
+  viejos se pliegan al resumen (extractivo: una línea recortada por turno,
+  sin otra llamada al LLM), que a su vez se acota desde el inicio.
+• construir_contexto arma los mensajes dentro de AGENTE_TOKENS_CONTEXTO.
+  Dentro del loop los resultados de herramientas viajan compactos (una
+  línea por producto) y, si el loop se pasa del presupuesto, los de
+  iteraciones anteriores quedan en una referencia mínima (podar_mensajes).
+
+Los tokens se estiman como caracteres / 4: alcanza para presupuestar sin
+sumar un tokenizer como dependencia.
+"""
+from __future__ import annotations
+import os
+import json
+from typing import Any, Dict, List, Optional
+
+AGENTE_MAX_TURNOS = int(os.getenv("AGENTE_MAX_TURNOS", "12"))
+AGENTE_TOKENS_CONTEXTO = int(os.getenv("AGENTE_TOKENS_CONTEXTO", "2500"))
+AGENTE_TOKENS_RESUMEN = int(os.getenv("AGENTE_TOKENS_RESUMEN", "400"))
+AGENTE_MAX_PRODUCTOS = int(os.getenv("AGENTE_MAX_PRODUCTOS", "15"))
+_LINEA_RESUMEN = 160   # caracteres por turno plegado
+
+
+def estimar_tokens(texto: Any) -> int:
+    if not isinstance(texto, str):
+        texto = json.dumps(texto, ensure_ascii=False, separators=(",", ":"))
+    return len(texto) // 4 + 1
+
+
+def _tokens_mensaje(m: Dict[str, Any]) -> int:
+    return 4 + estimar_tokens(m.get("content") or "") + (estimar_tokens(m["tool_calls"]) if m.get("tool_calls") else 0)
+
+
+def _linea_producto(p: Dict[str, Any]) -> str:
+    tallas = "/".join(str(t) for t in p.get("sizes") or []) or "-"
+    return f"{p.get('sku')} | {p.get('name')} | ${int(float(p.get('price') or 0)):,} | tallas {tallas} | {p.get('url') or ''}"
+
+
+def compactar_resultado(name: str, result: Dict[str, Any]) -> str:
+    """Resultado de herramienta en texto corto: una línea por producto, sin claves JSON repetidas."""
+    if name == "search_products" and isinstance(result.get("items"), list):
+        items = result["items"]
+        return f"{len(items)} productos:\n" + "\n".join(_linea_producto(p) for p in items) if items else "Sin resultados."
+    if name == "get_product" and isinstance(result.get("item"), dict):
+        item = result["item"]
+        return item.get("error") or _linea_producto(item) + (" | agotado" if item.get("in_stock") is False else "")
+    return json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+
+
+def _resumen_de(name: str, result: Dict[str, Any]) -> str:
+    """Versión mínima de un resultado ya usado en una iteración anterior."""
+    if name == "search_products" and isinstance(result.get("items"), list):
+        vistos = ", ".join(f"{p.get('sku')} ({p.get('name')})" for p in result["items"])
+        return f"Ya mostrado: {vistos}." if vistos else "Sin resultados."
+    if name == "get_product" and isinstance(result.get("item"), dict):
+        return f"Detalle ya leído de {result['item'].get('sku')}."
+    return compactar_resultado(name, result)
+
+
+class MemoriaAgente:
+    __slots__ = ("resumen", "turnos", "productos")
+
+    def __init__(self, resumen: str = "", turnos: Optional[List[Dict[str, str]]] = None,
+                 productos: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.resumen = resumen or ""
+        self.turnos: List[Dict[str, str]] = list(turnos or [])
+        self.productos: Dict[str, Dict[str, Any]] = dict(productos or {})
+
+    # ---------- registro ----------
+    def agregar_turno(self, role: str, content: str):
+        if content:
+            self.turnos.append({"role": role, "content": content})
+        self._plegar()
+
+    def recordar_productos(self, name: str, result: Dict[str, Any]):
+        items = result.get("items") if name == "search_products" else [result.get("item")] if name == "get_product" else []
+        for p in items or []:
+            if isinstance(p, dict) and p.get("sku") and not p.get("error"):
+                self.productos.pop(p["sku"], None)
+                self.productos[p["sku"]] = {k: p.get(k) for k in ("sku", "name", "price", "sizes", "url")}
+        while len(self.productos) > AGENTE_MAX_PRODUCTOS:
+            self.productos.pop(next(iter(self.productos)))
+
+    def _plegar(self):
+        """Pliega al resumen los turnos más viejos si sobran en cantidad o en tokens."""
+        presupuesto_turnos = AGENTE_TOKENS_CONTEXTO // 2
+        while self.turnos and (
+            len(self.turnos) > AGENTE_MAX_TURNOS
+            or sum(estimar_tokens(t["content"]) for t in self.turnos) > presupuesto_turnos
+        ):
+            t = self.turnos.pop(0)
+            quien = "Cliente" if t["role"] == "user" else "Asesor"
+            texto = " ".join(t["content"].split())
+            linea = f"{quien}: {texto[:_LINEA_RESUMEN]}{'…' if len(texto) > _LINEA_RESUMEN else ''}"
+            self.resumen = f"{self.resumen}\n{linea}".strip()
+        tope = AGENTE_TOKENS_RESUMEN * 4
+        if len(self.resumen) > tope:
+            recorte = self.resumen[-tope:]
+            self.resumen = recorte[recorte.find("\n") + 1:] if "\n" in recorte else recorte
+
+    # ---------- contexto ----------
+    def construir_contexto(self, system_prompt: str, user_text: str,
+                           presupuesto: int = AGENTE_TOKENS_CONTEXTO) -> List[Dict[str, Any]]:
+        """System + memoria (resumen y productos vistos) + los turnos recientes que quepan + mensaje actual."""
+        mensajes: List[Dict[str, Any]] = [{"role": "system", "content": system_prompt}]
+        partes = []
+        if self.resumen:
+            partes.append("Resumen de la conversación:\n" + self.resumen)
+        if self.productos:
+            partes.append(
+                "Productos ya mostrados (sku | nombre | precio | tallas | url); úsalos sin volver a buscar:\n"
+                + "\n".join(_linea_producto(p) for p in self.productos.values())
+            )
+        if partes:
+            mensajes.append({"role": "system", "content": "\n\n".join(partes)})
+        actual = {"role": "user", "content": user_text}
+        usados = sum(_tokens_mensaje(m) for m in mensajes) + _tokens_mensaje(actual)
+        recientes: List[Dict[str, Any]] = []
+        for t in reversed(self.turnos):
+            costo = _tokens_mensaje(t)
+            if usados + costo > presupuesto:
+                break
+            recientes.append(dict(t))
+            usados += costo
+        return mensajes + recientes[::-1] + [actual]
+
+    # ---------- persistencia ----------
+    def to_json(self) -> str:
+        return json.dumps(
+            {"resumen": self.resumen, "turnos": self.turnos, "productos": self.productos},
+            ensure_ascii=False, separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, raw: Optional[str]) -> "MemoriaAgente":
+        try:
+            data = json.loads(raw) if raw else {}
+        except Exception:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        return cls(data.get("resumen") or "", data.get("turnos") or [], data.get("productos") or {})
+
+
+def podar_mensajes(mensajes: List[Dict[str, Any]], resultados: Dict[str, tuple],
+                   presupuesto: int = AGENTE_TOKENS_CONTEXTO):
+    """
+    Antes de cada nueva iteración, si los mensajes pasan del presupuesto, los
+    resultados de herramientas más viejos quedan en su resumen mínimo
+    ('resultados': tool_call_id -> (name, result), se consume al podar).
+    """
+    total = sum(_tokens_mensaje(m) for m in mensajes)
+    for m in mensajes:
+        if total <= presupuesto:
+            break
+        if m.get("role") == "tool" and m.get("tool_call_id") in resultados:
+            name, result = resultados.pop(m["tool_call_id"])
+            antes = _tokens_mensaje(m)
+            m["content"] = _resumen_de(name, result)
+            total -= antes - _tokens_mensaje(m)
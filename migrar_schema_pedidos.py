@@ -48,6 +48,26 @@ def main():
             "ALTER TABLE pedidos ADD COLUMN sugeridos TEXT",
             "sugeridos"
         )
+        add_column_if_missing(
+            conn, "pedidos",
+            "ALTER TABLE pedidos ADD COLUMN vistos_json TEXT",
+            "vistos_json"
+        )
+        add_column_if_missing(
+            conn, "pedidos",
+            "ALTER TABLE pedidos ADD COLUMN cursor_json TEXT",
+            "cursor_json"
+        )
+        add_column_if_missing(
+            conn, "pedidos",
+            "ALTER TABLE pedidos ADD COLUMN agente_json TEXT",
+            "agente_json"
+        )
+        add_column_if_missing(
+            conn, "pedidos",
+            "ALTER TABLE pedidos ADD COLUMN version INTEGER DEFAULT 0",
+            "version"
+        )
         add_column_if_missing(
             conn, "pedidos",
             "ALTER TABLE pedidos ADD COLUMN punto_venta TEXT",
@@ -98,7 +118,8 @@ def main():
             """
             UPDATE pedidos
             SET datos_personales_advertidos = COALESCE(datos_personales_advertidos, 0),
-                saludo_enviado = COALESCE(saludo_enviado, 0)
+                saludo_enviado = COALESCE(saludo_enviado, 0),
+                version = COALESCE(version, 0)
             """
         ))
         # asegura números no negativos
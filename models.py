@@ -1,7 +1,7 @@
 # models.py
 from sqlalchemy import (
     Column, Integer, String, Float, DateTime, Text, func,
-    CheckConstraint, Index
+    CheckConstraint, Index, UniqueConstraint
 )
 from sqlalchemy.orm import declarative_base  # SQLAlchemy 2.x
 
@@ -39,7 +39,11 @@ class Pedido(Base):
     last_activity  = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
 
     # Auxiliares para conversación / sugerencias
-    sugeridos = Column(Text, nullable=True)  # guarda URLs sugeridas (espacio-separadas)
+    sugeridos = Column(Text, nullable=True)  # legado: URLs sugeridas (espacio-separadas)
+    vistos_json = Column(Text, nullable=True)  # IDs Woo ya sugeridos (LRU acotado, ver historial_vistos.py)
+    cursor_json = Column(Text, nullable=True)  # cursor de "más opciones" (ver cursor_resultados.py)
+    agente_json = Column(Text, nullable=True)  # memoria de /agent/chat (ver memoria_agente.py)
+    version = Column(Integer, nullable=False, default=0, server_default="0")  # CAS de los JSON de sesión (ver version_pedido.py)
     datos_personales_advertidos = Column(Integer, nullable=False, default=0, server_default="0")  # 0/1
     saludo_enviado = Column(Integer, nullable=False, default=0, server_default="0")  # 0/1
     last_msg_id = Column(String(128), nullable=True)  # último wamid procesado
@@ -57,3 +61,116 @@ class Pedido(Base):
 
     def __repr__(self) -> str:
         return f"<Pedido id={self.id} sesion={self.session_id} estado={self.estado}>"
+
+
+
+class ReservaStock(Base):
+    """Reserva blanda de stock al agregar al carrito (ver disponibilidad.py); vence sola."""
+    __tablename__ = "reservas_stock"
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String(128), nullable=False)
+    product_id = Column(Integer, nullable=False)
+    talla = Column(String(32), nullable=False, default="", server_default="")  # "" = producto sin tallas
+    cantidad = Column(Integer, nullable=False, default=1, server_default="1")
+    expira = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_reservas_producto_talla", "product_id", "talla", "expira"),
+        Index("ix_reservas_sesion", "session_id", "product_id", "talla"),
+    )
+
+
+class ExportacionWoo(Base):
+    """Cola durable de pedidos confirmados por crear en WooCommerce (ver exportador_woo.py)."""
+    __tablename__ = "exportaciones_woo"
+
+    id = Column(Integer, primary_key=True)
+    pedido_id = Column(Integer, nullable=False, index=True)
+    numero_confirmacion = Column(String(64), nullable=False)
+    secuencia = Column(Integer, nullable=False, default=1, server_default="1")  # n.º de confirmación de ese número
+    carrito_json = Column(Text, nullable=True)   # foto del carrito al confirmar (lo que se exporta)
+    total = Column(Float, nullable=True)
+    estado = Column(String(16), nullable=False, default="pendiente", server_default="pendiente")  # pendiente/enviando/exportado/error
+    intentos = Column(Integer, nullable=False, default=0, server_default="0")
+    proximo_intento = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    woo_order_id = Column(Integer, nullable=True)
+    ultimo_error = Column(Text, nullable=True)
+    creado = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_exportaciones_estado_proximo", "estado", "proximo_intento"),
+        UniqueConstraint("numero_confirmacion", "secuencia", name="uq_exportaciones_numero_secuencia"),  # idempotencia
+    )
+
+# ======================================================================
+# Espejo local del catálogo WooCommerce (ver catalogo_local.py)
+# Vive en su propia base SQLite por instancia: es un caché reconstruible,
+# independiente de la BD de pedidos.
+# ======================================================================
+CatalogBase = declarative_base()
+
+class ProductoCatalogo(CatalogBase):
+    __tablename__ = "catalogo_productos"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # id Woo
+    nombre = Column(String(255), nullable=False, default="")
+    slug = Column(String(255), nullable=True)
+    permalink = Column(String(512), nullable=True, index=True)
+    sku = Column(String(128), nullable=True, index=True)
+    tipo = Column(String(32), nullable=True)           # simple / variable
+    precio = Column(Float, nullable=False, default=0.0)
+    stock_status = Column(String(32), nullable=True)
+    stock_quantity = Column(Integer, nullable=True)
+    total_sales = Column(Integer, nullable=False, default=0)
+    creado = Column(String(32), nullable=True)          # date_created_gmt (orden por defecto)
+    modificado = Column(String(32), nullable=True)      # date_modified_gmt
+    data = Column(Text, nullable=False, default="{}")   # JSON crudo de Woo
+    sincronizado = Column(DateTime(timezone=True), nullable=False)
+
+class VariacionCatalogo(CatalogBase):
+    __tablename__ = "catalogo_variaciones"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # id Woo
+    product_id = Column(Integer, nullable=False, index=True)
+    sku = Column(String(128), nullable=True, index=True)
+    talla = Column(String(32), nullable=True)
+    color = Column(String(64), nullable=True)
+    precio = Column(Float, nullable=False, default=0.0)
+    stock_status = Column(String(32), nullable=True)
+    stock_quantity = Column(Integer, nullable=True)
+    modificado = Column(String(32), nullable=True)
+    data = Column(Text, nullable=False, default="{}")
+    sincronizado = Column(DateTime(timezone=True), nullable=False)
+
+class CategoriaCatalogo(CatalogBase):
+    __tablename__ = "catalogo_categorias"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    nombre = Column(String(255), nullable=False, default="")
+    slug = Column(String(255), nullable=True, index=True)
+    parent = Column(Integer, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+
+class ProductoCategoria(CatalogBase):
+    __tablename__ = "catalogo_producto_categoria"
+
+    product_id = Column(Integer, primary_key=True)
+    category_id = Column(Integer, primary_key=True)
+
+    __table_args__ = (Index("ix_catalogo_pc_categoria", "category_id"),)
+
+class AtributoCatalogo(CatalogBase):
+    __tablename__ = "catalogo_atributos"
+
+    product_id = Column(Integer, primary_key=True)
+    nombre = Column(String(128), primary_key=True)
+    opcion = Column(String(128), primary_key=True)
+
+    __table_args__ = (Index("ix_catalogo_atributos_opcion", "nombre", "opcion"),)
+
+class MetaCatalogo(CatalogBase):
+    __tablename__ = "catalogo_meta"
+
+    clave = Column(String(64), primary_key=True)
+    valor = Column(Text, nullable=True)
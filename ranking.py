@@ -0,0 +1,169 @@
+# ranking.py
+"""
+Orden de las sugerencias: en vez del orden de WooCommerce, un puntaje por
+candidato que combina popularidad (total_sales), profundidad de stock,
+cercanía al presupuesto que dijo el cliente y sus tallas preferidas
+(preferencias_json). Así lo más adecuado sale en las 3 primeras opciones.
+
+Con el espejo listo se puntúa sobre las columnas precalculadas del snapshot
+(precio/ventas/stock por posición); con productos en vivo se leen del dict.
+"""
+from __future__ import annotations
+import re
+import math
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+PESO_VENTAS = 0.30
+PESO_STOCK = 0.15
+PESO_PRECIO = 0.40
+PESO_TALLA = 0.15
+FUERA_DE_RANGO = 0.20    # a un 20 % por fuera del presupuesto el precio ya no suma
+STOCK_TOPE = 10.0        # más de esto ya no suma
+STOCK_DESCONOCIDO = 5.0  # en stock pero sin gestión de inventario
+
+Presupuesto = Tuple[Optional[float], Optional[float]]   # (mínimo, máximo)
+
+_NUM = r"\$?\s*(\d{1,3}(?:[.,]\d{3})+|\d+(?:[.,]\d+)?)\s*(millones?|mil|k|m\b)?"
+_ENTRE_RE = re.compile(rf"\bentre\s+{_NUM}\s+y\s+{_NUM}", re.I)
+_MAX_RE = re.compile(rf"\b(?:menos\s+de|hasta|m[aá]ximo|no\s+m[aá]s\s+de|por\s+debajo\s+de|tope\s+de)\s+{_NUM}", re.I)
+_MIN_RE = re.compile(rf"\b(?:m[aá]s\s+de|desde|m[ií]nimo|por\s+encima\s+de)\s+{_NUM}", re.I)
+_CERCA_RE = re.compile(rf"\b(?:alrededor\s+de|unos|cerca\s+de|presupuesto\s+de|presupuesto\s+es\s+de|como)\s+{_NUM}", re.I)
+_SUELTO_RE = re.compile(r"(\$\s*\d[\d.,]*|\b\d+(?:[.,]\d+)?\s*(?:mil|k)\b)", re.I)
+
+
+def _monto(numero: str, unidad: Optional[str]) -> Optional[float]:
+    n = numero.strip()
+    if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", n):
+        valor = float(re.sub(r"[.,]", "", n))
+    else:
+        try:
+            valor = float(n.replace(",", "."))
+        except ValueError:
+            return None
+    u = (unidad or "").lower()
+    if u in ("mil", "k"):
+        valor *= 1_000
+    elif u.startswith("millon") or u == "m":
+        valor *= 1_000_000
+    elif valor < 1_000:
+        valor *= 1_000   # "hasta 150" en pesos colombianos es 150 mil
+    return valor
+
+
+def presupuesto_de_texto(texto: str) -> Optional[Presupuesto]:
+    """'entre 100 y 150 mil', 'menos de $200.000', 'unos 120k'… → (mínimo, máximo)."""
+    t = texto or ""
+    m = _ENTRE_RE.search(t)
+    if m:
+        u2 = m.group(4)
+        a, b = _monto(m.group(1), m.group(2) or u2), _monto(m.group(3), u2)
+        if a and b:
+            return (min(a, b), max(a, b))
+    m = _MAX_RE.search(t)
+    if m:
+        return (None, _monto(m.group(1), m.group(2)))
+    m = _MIN_RE.search(t)
+    if m:
+        return (_monto(m.group(1), m.group(2)), None)
+    m = _CERCA_RE.search(t)
+    if m and (m.group(2) or "$" in m.group(0)):
+        v = _monto(m.group(1), m.group(2))
+        return (v * 0.8, v * 1.2) if v else None
+    m = _SUELTO_RE.search(t)
+    if m:
+        partes = re.match(_NUM, m.group(1).strip())
+        v = _monto(partes.group(1), partes.group(2)) if partes else None
+        return (v * 0.8, v * 1.2) if v else None
+    return None
+
+
+class Criterios:
+    __slots__ = ("presupuesto", "tallas")
+
+    def __init__(self, presupuesto: Optional[Presupuesto] = None, tallas: Iterable[str] = ()):
+        self.presupuesto = presupuesto
+        self.tallas = frozenset(str(t).strip().upper() for t in tallas or () if t)
+
+
+def _cercania(precio: float, presupuesto: Presupuesto) -> float:
+    lo, hi = presupuesto
+    if precio <= 0:
+        return 0.0
+    if hi is not None and precio > hi:
+        return max(0.0, 1.0 - (precio - hi) / hi / FUERA_DE_RANGO)
+    if lo is not None and precio < lo:
+        return max(0.0, 1.0 - (lo - precio) / lo / FUERA_DE_RANGO)
+    return 1.0
+
+
+def puntuar(
+    precios: Sequence[float],
+    ventas: Sequence[float],
+    stocks: Sequence[float],
+    tallas: Sequence[frozenset],
+    criterios: Criterios,
+) -> List[float]:
+    """Puntaje por columna: una pasada por criterio sobre listas paralelas."""
+    n = len(precios)
+    tope_ventas = math.log1p(max(ventas, default=0.0)) or 1.0
+    puntaje = [PESO_VENTAS * math.log1p(v) / tope_ventas for v in ventas]
+    for i, s in enumerate(stocks):
+        puntaje[i] += PESO_STOCK * min(s, STOCK_TOPE) / STOCK_TOPE
+    if criterios.presupuesto:
+        for i, p in enumerate(precios):
+            puntaje[i] += PESO_PRECIO * _cercania(p, criterios.presupuesto)
+    if criterios.tallas:
+        pref = criterios.tallas
+        for i in range(n):
+            puntaje[i] += PESO_TALLA * (1.0 if tallas[i] & pref else 0.5 if not tallas[i] else 0.0)
+    return puntaje
+
+
+def ordenar_ids(catalogo, pids: List[int], criterios: Criterios) -> List[int]:
+    """Reordena IDs del snapshot por puntaje (empates: orden de catálogo)."""
+    if len(pids) < 2:
+        return list(pids)
+    pos = [catalogo.pos[p] for p in pids]
+    puntaje = puntuar(
+        [catalogo.col_precio[i] for i in pos],
+        [catalogo.col_ventas[i] for i in pos],
+        [catalogo.col_stock[i] for i in pos],
+        [catalogo.facetas[p].tallas for p in pids] if criterios.tallas else (),
+        criterios,
+    )
+    orden = sorted(range(len(pids)), key=lambda k: (-puntaje[k], pos[k]))
+    return [pids[k] for k in orden]
+
+
+def stock_de(p: dict, variaciones: Optional[List[dict]] = None) -> float:
+    """Unidades disponibles (suma de variaciones en stock si las hay)."""
+    fuentes = variaciones if variaciones is not None else [p]
+    total = 0.0
+    for x in fuentes:
+        if str(x.get("stock_status", "instock")) != "instock":
+            continue
+        q = x.get("stock_quantity")
+        total += float(q) if isinstance(q, (int, float)) and q > 0 else STOCK_DESCONOCIDO
+    return total
+
+
+def ordenar_productos(productos: List[dict], criterios: Criterios, tallas: Optional[Dict[int, frozenset]] = None) -> List[dict]:
+    """Igual que ordenar_ids para productos en vivo (fuera del espejo)."""
+    if len(productos) < 2:
+        return list(productos)
+
+    def _num(v) -> float:
+        try:
+            return float(v or 0)
+        except Exception:
+            return 0.0
+
+    puntaje = puntuar(
+        [_num(p.get("price")) for p in productos],
+        [_num(p.get("total_sales")) for p in productos],
+        [stock_de(p) for p in productos],
+        [(tallas or {}).get(p.get("id"), frozenset()) for p in productos],
+        criterios,
+    )
+    orden = sorted(range(len(productos)), key=lambda k: (-puntaje[k], k))
+    return [productos[k] for k in orden]
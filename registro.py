@@ -0,0 +1,232 @@
+# registro.py
+"""
+Logs estructurados (JSON por línea) sin costo para el event loop.
+
+• log = registro.logger(__name__); log.info("whatsapp.enviado", to=numero).
+  Cada evento es un nombre estable + campos, no un texto armado a mano.
+• No bloquea: el registro va a una cola acotada (LOG_COLA) y un hilo
+  (QueueListener) lo formatea, enmascara y escribe en stdout. Si la cola se
+  llena se descarta el evento y se cuenta (LOG_METRICS["descartados"]).
+• Costo acotado: los campos se recortan (textos a LOG_MAX_TEXTO, listas y
+  dicts a unos pocos elementos, poca profundidad), así un payload grande no
+  cuesta más que uno chico. Nunca se loguea un payload entero.
+• Muestreo para eventos de alto volumen (LOG_MUESTREO="evento=0.1,…", o
+  muestreo= en la llamada); los de warning o más graves no se muestrean.
+  El evento lleva la tasa para poder re-ponderar al agregar.
+• PII: teléfonos (≥7 dígitos seguidos) quedan en ***últimos4, los correos en
+  ***@dominio, y los campos de texto libre del cliente (texto, mensaje,
+  direccion, nombre…) salen solo con su largo.
+• Correlación: cada evento lleva `req` (uno por request HTTP) y `sesion`
+  (hash corto del session_id, que en WhatsApp es el teléfono).
+"""
+from __future__ import annotations
+import os
+import re
+import sys
+import json
+import queue
+import random
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO").upper()
+LOG_JSON = os.getenv("LOG_JSON", "1") == "1"
+LOG_COLA = int(os.getenv("LOG_COLA", "10000"))
+LOG_MAX_TEXTO = int(os.getenv("LOG_MAX_TEXTO", "200"))
+LOG_MUESTREO_DEFECTO = "whatsapp.recibido=0.2,whatsapp.enviado=0.2"
+
+LOG_METRICS: Dict[str, int] = {"emitidos": 0, "muestreados": 0, "descartados": 0}
+
+# Campos cuyo valor es texto libre del cliente: solo se registra el largo
+CAMPOS_TEXTO_LIBRE = {"texto", "mensaje", "body", "direccion", "address_1", "nombre", "nombre_cliente",
+                      "first_name", "last_name", "notas", "customer_note"}
+
+_TELEFONO_RE = re.compile(r"(?<![\w-])\+?\d[\d ]{5,}\d(?![\w-])")
+_EMAIL_RE = re.compile(r"[\w.+-]+@([\w-]+\.[\w.-]+)")
+_MAX_ITEMS = 10
+_MAX_PROFUNDIDAD = 3
+
+_correlacion: ContextVar[Tuple[Optional[str], Optional[str]]] = ContextVar("log_correlacion", default=(None, None))
+
+
+def _parse_muestreo(raw: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for parte in (raw or "").split(","):
+        evento, _, tasa = parte.partition("=")
+        try:
+            out[evento.strip()] = max(0.0, min(1.0, float(tasa)))
+        except ValueError:
+            continue
+    return out
+
+
+_MUESTREO = _parse_muestreo(os.getenv("LOG_MUESTREO", LOG_MUESTREO_DEFECTO))
+
+
+# ======================================================================
+# Correlación
+# ======================================================================
+def id_sesion(session_id: Optional[str]) -> Optional[str]:
+    """Hash corto y estable del session_id (no expone el teléfono)."""
+    if not session_id:
+        return None
+    return hashlib.sha1(str(session_id).encode("utf-8")).hexdigest()[:10]
+
+
+def correlacionar(session_id: Optional[str] = None, req: Optional[str] = None):
+    """Fija sesión y/o request para los eventos de este contexto (y las tareas/hilos que lance)."""
+    sesion_actual, req_actual = _correlacion.get()
+    _correlacion.set((id_sesion(session_id) if session_id else sesion_actual, req or req_actual))
+
+
+def nuevo_request(req: Optional[str] = None) -> str:
+    """Inicia la correlación de un request HTTP (usa X-Request-ID si vino)."""
+    req = (req or "")[:64] or uuid.uuid4().hex[:12]
+    _correlacion.set((None, req))
+    return req
+
+
+# ======================================================================
+# Enmascarado y recorte (corren en el hilo del listener)
+# ======================================================================
+def _enmascarar(s: str) -> str:
+    s = _TELEFONO_RE.sub(lambda m: "***" + re.sub(r"\D", "", m.group(0))[-4:], s)
+    return _EMAIL_RE.sub(lambda m: "***@" + m.group(1), s)
+
+
+def _acotar(v: Any, clave: str = "", profundidad: int = 0) -> Any:
+    if clave in CAMPOS_TEXTO_LIBRE and isinstance(v, str):
+        return f"<{len(v)} caracteres>"
+    if v is None or isinstance(v, (bool, int, float)):
+        return v
+    if isinstance(v, str):
+        return _enmascarar(v if len(v) <= LOG_MAX_TEXTO else v[:LOG_MAX_TEXTO] + f"…(+{len(v) - LOG_MAX_TEXTO})")
+    if profundidad >= _MAX_PROFUNDIDAD:
+        return f"<{type(v).__name__}>"
+    if isinstance(v, dict):
+        out = {str(k): _acotar(x, str(k), profundidad + 1) for k, x in list(v.items())[:_MAX_ITEMS]}
+        if len(v) > _MAX_ITEMS:
+            out["…"] = len(v) - _MAX_ITEMS
+        return out
+    if isinstance(v, (list, tuple, set)):
+        items = list(v)
+        out = [_acotar(x, clave, profundidad + 1) for x in items[:_MAX_ITEMS]]
+        if len(items) > _MAX_ITEMS:
+            out.append(f"…(+{len(items) - _MAX_ITEMS})")
+        return out
+    if isinstance(v, BaseException):
+        return _enmascarar(repr(v)[:LOG_MAX_TEXTO])
+    return _enmascarar(str(v)[:LOG_MAX_TEXTO])
+
+
+class _Formato(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        evento = record.getMessage()
+        campos = {k: _acotar(v, k) for k, v in (getattr(record, "campos", None) or {}).items()}
+        if record.exc_info and record.exc_info[1] is not None:
+            campos["error"] = _acotar(record.exc_info[1])
+        sesion, req = getattr(record, "correlacion", (None, None))
+        if LOG_JSON:
+            doc = {
+                "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                "nivel": record.levelname.lower(),
+                "logger": record.name,
+                "evento": evento,
+            }
+            if req:
+                doc["req"] = req
+            if sesion:
+                doc["sesion"] = sesion
+            doc.update(campos)
+            return json.dumps(doc, ensure_ascii=False, default=str)
+        extra = " ".join(f"{k}={v}" for k, v in campos.items())
+        return f"{record.levelname[0]} {evento} [{req or '-'}/{sesion or '-'}] {extra}".rstrip()
+
+
+# ======================================================================
+# Cola no bloqueante
+# ======================================================================
+class _ColaHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record   # se formatea en el hilo del listener, no en el del request
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            LOG_METRICS["emitidos"] += 1
+        except queue.Full:
+            LOG_METRICS["descartados"] += 1
+
+
+_raiz = logging.getLogger("cassany")
+_raiz.propagate = False
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configurar():
+    """Conecta la cola y arranca el hilo escritor (idempotente)."""
+    global _listener
+    if _listener is not None:
+        return
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(_Formato())
+    cola: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_COLA)
+    _raiz.handlers[:] = [_ColaHandler(cola)]
+    _raiz.setLevel(getattr(logging, LOG_NIVEL, logging.INFO))
+    _listener = logging.handlers.QueueListener(cola, salida)
+    _listener.start()
+    atexit.register(detener)
+
+
+def detener():
+    """Vacía la cola y detiene el hilo escritor."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class Registro:
+    """Logger de eventos: log.info("evento", campo=valor, …)."""
+    __slots__ = ("_log",)
+
+    def __init__(self, nombre: str):
+        self._log = _raiz.getChild(nombre)
+
+    def _emitir(self, nivel: int, evento: str, muestreo: Optional[float], exc: Optional[BaseException],
+                campos: Dict[str, Any]):
+        if not self._log.isEnabledFor(nivel):
+            return
+        if nivel < logging.WARNING:
+            tasa = _MUESTREO.get(evento, 1.0) if muestreo is None else muestreo
+            if tasa < 1.0:
+                if random.random() >= tasa:
+                    LOG_METRICS["muestreados"] += 1
+                    return
+                campos["muestreo"] = tasa
+        if exc is not None:
+            campos["error"] = exc
+        self._log.log(nivel, evento, extra={"campos": campos, "correlacion": _correlacion.get()})
+
+    def debug(self, evento: str, muestreo: Optional[float] = None, **campos):
+        self._emitir(logging.DEBUG, evento, muestreo, None, campos)
+
+    def info(self, evento: str, muestreo: Optional[float] = None, **campos):
+        self._emitir(logging.INFO, evento, muestreo, None, campos)
+
+    def warning(self, evento: str, exc: Optional[BaseException] = None, **campos):
+        self._emitir(logging.WARNING, evento, None, exc, campos)
+
+    def error(self, evento: str, exc: Optional[BaseException] = None, **campos):
+        self._emitir(logging.ERROR, evento, None, exc, campos)
+
+
+def logger(nombre: str) -> Registro:
+    configurar()
+    return Registro(nombre)
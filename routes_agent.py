@@ -1,47 +1,128 @@
-import os, json
-from typing import Any, Dict
+import os, json, asyncio
+from typing import Any, Dict, Optional
 from fastapi import APIRouter, Depends
 from pydantic import BaseModel
+from sqlalchemy import text
 from sqlalchemy.orm import Session
-from openai import OpenAI
-from database import SessionLocal
+from openai import AsyncOpenAI
+from database import request_session, execute_write, AsyncSessionLocal
 from crud import crear_pedido, obtener_pedido_por_sesion
-from agent_tools import TOOLS, SYSTEM_PROMPT, dispatch_tool
+from agent_tools import TOOLS, SYSTEM_PROMPT, dispatch_tools
+from memoria_agente import MemoriaAgente, compactar_resultado, podar_mensajes
+from trazas import medir, span
+from registro import correlacionar
 
 router = APIRouter(prefix="/agent", tags=["agent"])
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+_client: Optional[AsyncOpenAI] = None
+
+def _openai() -> AsyncOpenAI:
+    # Perezoso: sin OPENAI_API_KEY la app arranca igual y solo /agent/chat falla
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
 
 class ChatIn(BaseModel):
     session_id: str
     message: str
 
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
+async def get_db():
+    with request_session() as db:
+        yield db
+
+def _args(raw: str) -> Dict[str, Any]:
+    try:
+        data = json.loads(raw or "{}")
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+def _memoria_load(db: Session, session_id: str) -> MemoriaAgente:
+    try:
+        row = db.execute(text("SELECT agente_json FROM pedidos WHERE session_id=:sid"), {"sid": session_id}).fetchone()
+        return MemoriaAgente.from_json(row[0] if row else None)
+    except Exception:
+        return MemoriaAgente()
+
+def _memoria_save(db: Session, session_id: str, memoria: MemoriaAgente):
+    try:
+        execute_write(db, text("UPDATE pedidos SET agente_json=:j WHERE session_id=:sid"),
+                      {"j": memoria.to_json(), "sid": session_id})
+    except Exception:
+        db.rollback()
+
+def _crear_si_falta(db: Session, sid: str) -> bool:
+    if obtener_pedido_por_sesion(db, sid):
+        return False
+    crear_pedido(db, {"session_id": sid, "estado": "pendiente", "carrito_json": "[]", "preferencias_json": "{}"})
+    return True
+
+def _preparar(db: Session, sid: str) -> MemoriaAgente:
+    _crear_si_falta(db, sid)
+    return _memoria_load(db, sid)
+
+# Perfil async (Postgres con DATABASE_ASYNC_URL / DB_ASYNC=1): la memoria del agente
+# se lee y escribe con AsyncSession, sin ocupar un hilo; si no, hilo + sesión sync.
+async def _preparar_async(db: Session, sid: str) -> MemoriaAgente:
+    try:
+        async with AsyncSessionLocal() as s:
+            row = (await s.execute(text("SELECT agente_json FROM pedidos WHERE session_id=:sid"), {"sid": sid})).fetchone()
+    except Exception:
+        return await asyncio.to_thread(_preparar, db, sid)
+    if row is None:
+        await asyncio.to_thread(_crear_si_falta, db, sid)   # alta con número de confirmación: CRUD sync
+        return MemoriaAgente()
+    return MemoriaAgente.from_json(row[0])
+
+async def _memoria_save_async(db: Session, sid: str, memoria: MemoriaAgente):
+    try:
+        async with AsyncSessionLocal() as s:
+            await s.execute(text("UPDATE pedidos SET agente_json=:j WHERE session_id=:sid"),
+                            {"j": memoria.to_json(), "sid": sid})
+            await s.commit()
+    except Exception:
+        await asyncio.to_thread(_memoria_save, db, sid, memoria)
+
+async def _responder(db: Session, sid: str, memoria: MemoriaAgente, user_text: str, respuesta: str) -> Dict[str, str]:
+    memoria.agregar_turno("user", user_text)
+    memoria.agregar_turno("assistant", respuesta)
+    if AsyncSessionLocal is not None:
+        await _memoria_save_async(db, sid, memoria)
+    else:
+        await asyncio.to_thread(_memoria_save, db, sid, memoria)
+    return {"response": respuesta}
 
 @router.post("/chat")
-def chat(body: ChatIn, db: Session = Depends(get_db)):
+@medir("agente.chat")
+async def chat(body: ChatIn, db: Session = Depends(get_db)):
     sid, user_text = body.session_id, body.message
-    if not obtener_pedido_por_sesion(db, sid):
-        crear_pedido(db, {"session_id": sid, "estado": "pendiente", "carrito_json": "[]", "preferencias_json": "{}"})
-    messages = [{"role":"system","content": SYSTEM_PROMPT},
-                {"role":"user","content": user_text}]
+    correlacionar(sid)
+    # Con perfil async la memoria va por AsyncSession; si no, la DB (y el writer SQLite) va en un hilo
+    if AsyncSessionLocal is not None:
+        memoria = await _preparar_async(db, sid)
+    else:
+        memoria = await asyncio.to_thread(_preparar, db, sid)
+    messages = memoria.construir_contexto(SYSTEM_PROMPT, user_text)
+    usados: Dict[str, tuple] = {}   # tool_call_id -> (name, result) de iteraciones previas
     for _ in range(6):
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages, tools=TOOLS, tool_choice="auto", temperature=0.3
-        )
+        podar_mensajes(messages, usados)
+        with span("openai.chat", modelo="gpt-4o-mini"):
+            resp = await _openai().chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages, tools=TOOLS, tool_choice="auto", temperature=0.3
+            )
         msg = resp.choices[0].message
         if msg.tool_calls:
-            for tc in msg.tool_calls:
-                name = tc.function.name
-                args = json.loads(tc.function.arguments or "{}")
-                result = dispatch_tool(db, sid, name, args)
-                messages.append({"role":"assistant","tool_calls":[{"id": tc.id,"type":"function",
-                                "function":{"name":name,"arguments": json.dumps(args)}}]})
+            calls = [(tc.function.name, _args(tc.function.arguments)) for tc in msg.tool_calls]
+            results = await dispatch_tools(db, sid, calls)
+            messages.append({"role":"assistant","content": msg.content,"tool_calls":[
+                {"id": tc.id,"type":"function","function":{"name":name,"arguments": json.dumps(args)}}
+                for tc, (name, args) in zip(msg.tool_calls, calls)]})
+            for tc, (name, _), result in zip(msg.tool_calls, calls, results):
                 messages.append({"role":"tool","tool_call_id": tc.id,"name": name,
-                                 "content": json.dumps(result, ensure_ascii=False)})
+                                 "content": compactar_resultado(name, result)})
+                memoria.recordar_productos(name, result)
+                usados[tc.id] = (name, result)
             continue
-        return {"response": msg.content or "¿Te muestro algunas opciones?"}
-    return {"response": "No pude completar la acción. ¿Intentamos de nuevo?"}
+        return await _responder(db, sid, memoria, user_text, msg.content or "¿Te muestro algunas opciones?")
+    return await _responder(db, sid, memoria, user_text, "No pude completar la acción. ¿Intentamos de nuevo?")
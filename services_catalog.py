@@ -1,37 +1,92 @@
-import hashlib
-from typing import Any, Dict, List, Optional
-from woocommerce_gpt_utils import sugerir_productos, detectar_categoria
-
-def _sku_from(url: Optional[str], name: str) -> str:
-    base = (url or name or "SKU").encode("utf-8")
-    return "SKU-" + hashlib.sha1(base).hexdigest()[:10].upper()
+from typing import Any, Dict, List, Optional, Tuple
+import catalogo_local
+import woocommerce_client as wc
+from catalogo_local import sku_sintetico as _sku_from, talla_de_variacion
+from woocommerce_gpt_utils import sugerir_productos, detectar_categoria, get_variaciones, _parse_price, _VIVOS
 
 def _normalize(p: Dict[str, Any]) -> Dict[str, Any]:
     name = p.get("nombre") or p.get("name") or "Producto"
     url  = p.get("url")
     price = float(p.get("precio") or p.get("price") or 0.0)
     sizes = p.get("tallas_disponibles") or p.get("sizes") or []
-    return {"sku": _sku_from(url, name), "name": name, "url": url, "price": price, "sizes": sizes}
+    return {"sku": _sku_from(url, name), "id": p.get("id"), "name": name, "url": url, "price": price, "sizes": sizes}
+
+# filtros de la herramienta (agent_tools.TOOLS) -> atributos de sugerir_productos
+_FILTROS_TOOL = {"size": "talla", "color": "color", "sleeve": "manga", "use": "uso"}
+
+def _plan(query: str, filtros: Dict[str, Any]) -> Tuple[Optional[str], Dict[str, str]]:
+    # Categoría y atributos se resuelven una sola vez, antes de tocar catálogo o variaciones
+    cat = detectar_categoria(str(filtros["category"]))[0] if filtros.get("category") else None
+    if not cat:
+        cat, _ = detectar_categoria(query)
+    attrs = {k: str(filtros[f]).strip().lower() for f, k in _FILTROS_TOOL.items() if filtros.get(f)}
+    if attrs.get("talla"):
+        attrs["talla"] = attrs["talla"].upper()
+    return cat, attrs
 
 def search_products(query: str, filtros: Optional[Dict[str, Any]]=None, limite: int=6) -> List[Dict[str, Any]]:
-    filtros = filtros or {}
-    res = sugerir_productos(query, limite=limite) or {}
+    cat, attrs = _plan(query, filtros or {})
+    res = sugerir_productos(query, limite=limite, categoria=cat, atributos=attrs) or {}
     prods = res.get("productos") or []
-    if not prods:
-        cat, _ = detectar_categoria(query)
-        if cat:
-            prods = (sugerir_productos(cat, limite=limite) or {}).get("productos") or []
+    if not prods and cat:
+        # Sin resultados con lo leído del texto: solo categoría + filtros (reusa la consulta en caché)
+        prods = (sugerir_productos(cat, limite=limite, categoria=cat, atributos=attrs) or {}).get("productos") or []
     norm = [_normalize(p) for p in prods]
-    want_size = (filtros.get("size") or "").upper()
-    want_color = (filtros.get("color") or "").lower()
-    out = []
-    for p in norm:
-        if want_size and p["sizes"] and want_size not in [s.upper() for s in p["sizes"]]:
-            continue
-        if want_color and want_color not in p["name"].lower():
-            continue
-        out.append(p)
-    return out[:limite]
+    want_size = attrs.get("talla")
+    if want_size:
+        # Fuera del espejo la talla solo se conoce al leer variaciones (ya leídas para esta página)
+        norm = [p for p in norm if not p["sizes"] or want_size in [s.upper() for s in p["sizes"]]]
+    return norm[:limite]
+
+def _ficha(pid: int, p: Dict[str, Any], variaciones: List[dict]) -> Dict[str, Any]:
+    out = _normalize({
+        "id": pid,
+        "name": p.get("name"),
+        "url": p.get("permalink"),
+        "price": _parse_price(p.get("price")),
+        "sizes": [t for t in dict.fromkeys(talla_de_variacion(v) for v in variaciones) if t],
+    })
+    out["in_stock"] = catalogo_local._en_stock(p)
+    out["variations"] = [
+        {"id": v.get("id"), "sku": v.get("sku") or None, "size": talla_de_variacion(v),
+         "price": _parse_price(v.get("price")), "stock": v.get("stock_quantity")}
+        for v in variaciones
+    ]
+    return out
+
+def _producto_vivo(ref: str) -> Optional[Dict[str, Any]]:
+    # Woo en vivo: ID (producto o variación → su padre), permalink (slug), SKU de Woo,
+    # o SKU sintético de un producto que search_products ya trajo en vivo
+    if ref.isdigit():
+        p = wc.get_product_by_id(int(ref))
+        if isinstance(p, dict) and int(p.get("parent_id") or 0):
+            p = wc.get_product_by_id(int(p["parent_id"]))
+        return p if isinstance(p, dict) and p.get("id") else None
+    if ref.upper().startswith("SKU-"):
+        for _, _, items in list(_VIVOS.values()):
+            for p in items:
+                if _sku_from(p.get("permalink"), p.get("name") or "Producto") == ref.upper():
+                    return p
+        return None
+    if "/" in ref:
+        slug = catalogo_local.clave_url(ref).rsplit("/", 1)[-1]
+        res = wc.get_products_where(slug=slug) if slug else None
+    else:
+        res = wc.get_products_where(sku=ref)
+    return res[0] if isinstance(res, list) and res else None
 
 def get_product(product_ref: str) -> Dict[str, Any]:
-    return {"sku": product_ref, "name": "Producto", "price": 100000.0, "url": None, "sizes": ["S","M","L","XL"]}
+    # SKU (sintético o de Woo), ID o permalink -> producto del snapshot local, sin red
+    ref = str(product_ref).strip()
+    cat = catalogo_local.get_catalogo()
+    pid = cat.resolver(ref) if cat is not None else None
+    if pid is not None:
+        return _ficha(pid, cat.productos[pid], cat.variaciones_en_stock(pid) or [])
+    if catalogo_local.CATALOG_MIRROR and catalogo_local.catalogo_listo():
+        return {"sku": product_ref, "error": "Producto no encontrado; usa search_products para obtener su sku."}
+    # Espejo apagado o aún frío: se resuelve contra Woo en vivo
+    p = _producto_vivo(ref) if ref else None
+    if p is None:
+        return {"sku": product_ref, "error": "Producto no encontrado; usa search_products para obtener su sku."}
+    variaciones = get_variaciones(int(p["id"])) if p.get("type") == "variable" else []
+    return _ficha(int(p["id"]), p, variaciones)
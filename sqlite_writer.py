@@ -0,0 +1,128 @@
+# sqlite_writer.py
+"""
+Escritor único para el perfil SQLite (SQLITE_WRITER=1).
+
+SQLite admite un solo escritor a la vez; con un commit por helper, las
+conversaciones concurrentes hacen fila en el lock y una lenta frena a las
+demás hasta busy_timeout. Aquí todas las escrituras se encolan y un hilo
+dedicado las agrupa en una sola transacción (group commit): lo que llega
+mientras se confirma un lote sale en el siguiente. Las lecturas siguen en
+las sesiones normales (lectores WAL, sin bloqueo).
+
+El hilo es síncrono porque los helpers de la app también lo son; desde
+código async se puede esperar con `await writer.execute_async(...)`.
+"""
+from __future__ import annotations
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+_STOP = object()
+
+
+class _Op:
+    __slots__ = ("stmt", "params", "future")
+
+    def __init__(self, stmt, params: Optional[Dict[str, Any]]):
+        self.stmt = stmt
+        self.params = params or {}
+        self.future: Future = Future()
+
+
+class SQLiteWriter:
+    def __init__(self, engine, window_ms: float = 0.0, max_batch: int = 128):
+        self.engine = engine
+        self.window_s = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._q: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.metrics: Dict[str, int] = {"batches": 0, "ops": 0, "max_batch": 0, "failed_batches": 0, "errors": 0}
+
+    # ---------- ciclo de vida ----------
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            t = self._thread
+            if not t or not t.is_alive():
+                return
+            self._q.put(_STOP)
+        t.join(timeout)
+
+    # ---------- API ----------
+    def submit(self, stmt, params: Optional[Dict[str, Any]] = None) -> Future:
+        """Encola una sentencia; el Future resuelve con su rowcount tras el commit del lote."""
+        if not self._thread or not self._thread.is_alive():
+            self.start()
+        op = _Op(stmt, params)
+        self._q.put(op)
+        return op.future
+
+    def execute(self, stmt, params: Optional[Dict[str, Any]] = None, timeout: Optional[float] = 60.0) -> int:
+        return self.submit(stmt, params).result(timeout)
+
+    async def execute_async(self, stmt, params: Optional[Dict[str, Any]] = None) -> int:
+        return await asyncio.wrap_future(self.submit(stmt, params))
+
+    # ---------- hilo escritor ----------
+    def _collect(self, first: _Op) -> tuple[List[_Op], bool]:
+        batch, stop = [first], False
+        deadline = time.monotonic() + self.window_s
+        while len(batch) < self.max_batch:
+            try:
+                if self.window_s:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    nxt = self._q.get(timeout=remaining)
+                else:
+                    nxt = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is _STOP:
+                stop = True
+                break
+            batch.append(nxt)
+        return batch, stop
+
+    def _run(self):
+        while True:
+            first = self._q.get()
+            if first is _STOP:
+                return
+            batch, stop = self._collect(first)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch: List[_Op]):
+        try:
+            with self.engine.begin() as conn:
+                counts = [conn.execute(op.stmt, op.params).rowcount for op in batch]
+        except Exception:
+            # Un fallo anula el lote entero: se repite cada operación sola para aislar la culpable
+            self.metrics["failed_batches"] += 1
+            for op in batch:
+                try:
+                    with self.engine.begin() as conn:
+                        rc = conn.execute(op.stmt, op.params).rowcount
+                    op.future.set_result(rc)
+                except Exception as exc:
+                    self.metrics["errors"] += 1
+                    op.future.set_exception(exc)
+            return
+        for op, rc in zip(batch, counts):
+            op.future.set_result(rc)
+        self.metrics["batches"] += 1
+        self.metrics["ops"] += len(batch)
+        if len(batch) > self.metrics["max_batch"]:
+            self.metrics["max_batch"] = len(batch)
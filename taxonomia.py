@@ -0,0 +1,220 @@
+# taxonomia.py
+"""
+Taxonomía de categorías de la tienda, armada desde products/categories de
+WooCommerce (jerarquía y conteos) en vez de IDs fijos en el código.
+
+• Fuente: el snapshot del catálogo local si está listo (el sync ya trae y
+  persiste las categorías); si el espejo está apagado, las categorías
+  guardadas en la SQLite del catálogo, refrescadas cada TAXONOMIA_SYNC_MINUTES.
+• Sin ninguna de las dos (primer arranque sin red) se usa la semilla fija
+  (CATEGORY_IDS/SYNONYMS de woocommerce_gpt_utils), igual que antes.
+• De cada categoría salen su clave ("camisas"), el singular y el slug como
+  sinónimos; los sinónimos de la semilla se conservan si su destino existe.
+  Con eso se arma un DetectorCategorias nuevo por cada versión.
+"""
+from __future__ import annotations
+import os
+import time
+import threading
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from sqlalchemy import select
+
+import catalogo_local
+import woocommerce_client as wc
+from detector_categorias import DetectorCategorias
+from facetas import normalizar
+from indice_busqueda import _raiz
+from models import CategoriaCatalogo
+from registro import logger
+
+log = logger("taxonomia")
+
+TAXONOMIA_SYNC_MINUTES = float(os.getenv("TAXONOMIA_SYNC_MINUTES", "60"))
+_IGNORAR_SLUGS = {"uncategorized", "sin-categorizar", "sin-categoria"}
+
+_CATEGORIAS: Dict[int, dict] = {}   # fuente propia (espejo apagado)
+_version = 0
+_cache: Tuple[Optional[tuple], Optional["Taxonomia"]] = (None, None)
+_lock = threading.Lock()
+_thread: Optional[threading.Thread] = None
+
+
+def _clave(nombre: str) -> str:
+    return " ".join(normalizar(nombre or "").replace("-", " ").split())
+
+
+class Taxonomia:
+    __slots__ = ("por_clave", "hijos", "detector", "origen")
+
+    def __init__(self, por_clave: Dict[str, int], hijos: Dict[int, List[int]], sinonimos: Dict[str, str], origen: str):
+        self.por_clave = por_clave    # clave canónica -> category_id
+        self.hijos = hijos            # category_id -> subcategorías
+        self.origen = origen          # "woocommerce" | "semilla"
+        self.detector = DetectorCategorias(por_clave, sinonimos)
+
+    def detectar(self, texto: str) -> Tuple[Optional[str], float]:
+        return self.detector.detectar(texto)
+
+    def id(self, clave: Optional[str]) -> Optional[int]:
+        return self.por_clave.get(clave) if clave else None
+
+    def ids(self, clave: Optional[str]) -> List[int]:
+        """La categoría y todas sus descendientes (p. ej. camisas → camisas + guayaberas)."""
+        raiz = self.id(clave)
+        if raiz is None:
+            return []
+        out, pila = [], [raiz]
+        while pila:
+            cid = pila.pop()
+            if cid in out:
+                continue
+            out.append(cid)
+            pila.extend(self.hijos.get(cid, ()))
+        return out
+
+
+def _desde_semilla(semilla_ids: Mapping[str, int], semilla_sinonimos: Mapping[str, str]) -> Taxonomia:
+    return Taxonomia(dict(semilla_ids), {}, dict(semilla_sinonimos), "semilla")
+
+
+def construir(
+    categorias: Mapping[int, dict],
+    semilla_ids: Mapping[str, int],
+    semilla_sinonimos: Mapping[str, str],
+) -> Taxonomia:
+    hijos: Dict[int, List[int]] = {}
+    for cid, c in categorias.items():
+        padre = int(c.get("parent") or 0)
+        if padre:
+            hijos.setdefault(padre, []).append(cid)
+
+    def _total(cid: int, vistos=()) -> int:
+        if cid in vistos:
+            return 0
+        return int(categorias[cid].get("count") or 0) + sum(
+            _total(h, (*vistos, cid)) for h in hijos.get(cid, ()) if h in categorias
+        )
+
+    # clave canónica por categoría con productos (ante nombres repetidos gana la de más productos)
+    por_clave: Dict[str, int] = {}
+    for cid, c in sorted(categorias.items(), key=lambda kv: _total(kv[0])):
+        if str(c.get("slug") or "") in _IGNORAR_SLUGS or not _total(cid):
+            continue
+        clave = _clave(c.get("name") or c.get("slug") or "")
+        if clave:
+            por_clave[clave] = cid
+    if not por_clave:
+        return _desde_semilla(semilla_ids, semilla_sinonimos)
+    clave_de_id = {cid: k for k, cid in por_clave.items()}
+
+    # sinónimos: singular y slug de cada categoría, luego la semilla si su destino sigue vivo
+    sinonimos: Dict[str, str] = {}
+    for clave, cid in por_clave.items():
+        singulares = (" ".join(_raiz(t) for t in clave.split()), clave[:-1] if clave.endswith("s") else "")
+        slug = _clave(categorias[cid].get("slug") or "")
+        for s in (*singulares, slug):
+            if s and s not in por_clave:
+                sinonimos.setdefault(s, clave)
+
+    def _destino(clave_semilla: str) -> Optional[str]:
+        k = _clave(clave_semilla)
+        if k in por_clave:
+            return k
+        return clave_de_id.get(semilla_ids.get(clave_semilla, -1))
+
+    for nombre in semilla_ids:
+        k, destino = _clave(nombre), _destino(nombre)
+        if destino and k not in por_clave:
+            sinonimos.setdefault(k, destino)
+    for s, nombre in semilla_sinonimos.items():
+        k, destino = _clave(s), _destino(nombre)
+        if destino and k not in por_clave:
+            sinonimos.setdefault(k, destino)
+
+    return Taxonomia(por_clave, hijos, sinonimos, "woocommerce")
+
+
+def actual(semilla_ids: Mapping[str, int], semilla_sinonimos: Mapping[str, str]) -> Taxonomia:
+    """
+    Taxonomía vigente; se reconstruye solo cuando cambian las categorías de su
+    fuente (los parches y syncs de productos no la tocan, ni al memo del detector).
+    """
+    global _cache
+    cat = catalogo_local.get_catalogo()
+    if cat is not None and cat.categorias:
+        clave, fuente = ("catalogo", cat.version_categorias), cat.categorias
+    elif _CATEGORIAS:
+        clave, fuente = ("propia", _version), _CATEGORIAS
+    else:
+        clave, fuente = ("semilla",), None
+    hecha, tax = _cache
+    if hecha == clave and tax is not None:
+        return tax
+    with _lock:
+        if _cache[0] != clave or _cache[1] is None:
+            tax = (
+                construir(fuente, semilla_ids, semilla_sinonimos) if fuente
+                else _desde_semilla(semilla_ids, semilla_sinonimos)
+            )
+            _cache = (clave, tax)
+        return _cache[1]
+
+
+# ======================================================================
+# Fuente propia (espejo de catálogo apagado)
+# ======================================================================
+def _cargar_guardadas() -> Dict[int, dict]:
+    catalogo_local.init_catalogo_db()
+    with catalogo_local.SessionCatalogo() as s:
+        return {
+            c.id: {"id": c.id, "name": c.nombre, "slug": c.slug, "parent": c.parent, "count": c.count}
+            for c in s.execute(select(CategoriaCatalogo)).scalars()
+        }
+
+
+def sincronizar() -> Dict[str, Any]:
+    """Trae products/categories, las persiste en la SQLite del catálogo y publica la nueva versión."""
+    global _CATEGORIAS, _version
+    categorias = wc.get_categories()
+    if not isinstance(categorias, list) or not categorias:
+        return {"error": (categorias or {}).get("error") if isinstance(categorias, dict) else "sin categorías"}
+    catalogo_local.init_catalogo_db()
+    with catalogo_local.SessionCatalogo() as s:
+        catalogo_local._guardar_categorias(s, categorias)
+        s.commit()
+    nuevas = _cargar_guardadas()
+    if nuevas != _CATEGORIAS:   # sin cambios no se invalida la taxonomía
+        _CATEGORIAS = nuevas
+        _version += 1
+    return {"categorias": len(_CATEGORIAS)}
+
+
+def _loop_sync():
+    while True:
+        try:
+            sincronizar()
+        except Exception as e:
+            log.error("taxonomia.sync_fallido", exc=e)
+        time.sleep(max(60.0, TAXONOMIA_SYNC_MINUTES * 60))
+
+
+def iniciar() -> bool:
+    """
+    Con el espejo activo no hace nada (su sync ya refresca las categorías).
+    Si no, carga las categorías guardadas y lanza el refresco periódico.
+    """
+    global _CATEGORIAS, _version, _thread
+    if catalogo_local.CATALOG_MIRROR and catalogo_local._credenciales_ok():
+        return False
+    try:
+        _CATEGORIAS = _cargar_guardadas()
+        _version += 1
+    except Exception as e:
+        log.warning("taxonomia.carga_fallida", exc=e)
+    if not catalogo_local._credenciales_ok():
+        return False
+    if _thread is None or not _thread.is_alive():
+        _thread = threading.Thread(target=_loop_sync, name="taxonomia-sync", daemon=True)
+        _thread.start()
+    return True
@@ -0,0 +1,258 @@
+# trazas.py
+"""
+Latencia por etapa del pipeline (WhatsApp → catálogo → LLM → HubSpot → Graph API).
+
+• span("etapa") es un context manager (sirve también en código async) que
+  mide con perf_counter y suma la duración al histograma de esa etapa.
+  @medir("etapa") hace lo mismo con una función entera, sync o async.
+• Los histogramas salen por /metrics en formato Prometheus
+  (cassany_etapa_segundos); metricas_prometheus() los arma.
+• Si la etapa raíz (la primera abierta en el request) pasa de TRAZAS_LENTO_S,
+  se registra (traza.lenta) el desglose de sus etapas: dónde se fue el tiempo.
+• Exportadores: registrar_exportador(fn) recibe cada Span al cerrarse.
+  Con TRAZAS_OTEL=1 y opentelemetry instalado, cada span abre además un
+  span OpenTelemetry (con su padre), para enviarlo a cualquier colector.
+• TRAZAS=0 lo apaga: span() devuelve un context manager vacío compartido y
+  @medir deja la función tal cual (costo ~0).
+"""
+from __future__ import annotations
+import os
+import time
+import inspect
+import threading
+import functools
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from registro import logger
+
+TRAZAS = os.getenv("TRAZAS", "1") == "1"
+TRAZAS_LENTO_S = float(os.getenv("TRAZAS_LENTO_S", "5"))
+TRAZAS_OTEL = os.getenv("TRAZAS_OTEL", "0") == "1"
+
+# Límites superiores (segundos) de los buckets de los histogramas
+BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_tracer = None
+if TRAZAS and TRAZAS_OTEL:
+    try:
+        from opentelemetry import context as _otel_context, trace as _otel_trace
+        _tracer = _otel_trace.get_tracer("cassany")
+    except ImportError:
+        print("⚠️  TRAZAS_OTEL=1 pero opentelemetry no está instalado; sigo solo con /metrics.")
+
+
+class Span:
+    __slots__ = ("nombre", "atributos", "inicio", "duracion", "error", "_padre", "_etapas", "_otel", "_token")
+
+    def __init__(self, nombre: str, atributos: Dict[str, Any]):
+        self.nombre = nombre
+        self.atributos = atributos
+        self.inicio = 0.0
+        self.duracion = 0.0
+        self.error: Optional[str] = None
+
+    def set(self, clave: str, valor: Any):
+        self.atributos[clave] = valor
+
+    def marcar_error(self, exc: BaseException):
+        """Para etapas que atrapan su excepción: cuenta igual como error."""
+        self.error = type(exc).__name__
+
+    def __enter__(self) -> "Span":
+        self._padre = _actual.get()
+        # Las etapas se acumulan en la lista de la raíz (compartida con hilos de to_thread)
+        self._etapas = self._padre._etapas if self._padre is not None else []
+        self._token = _actual.set(self)
+        self._otel = None
+        if _tracer is not None:
+            otel = _tracer.start_span(self.nombre, attributes=_atributos_otel(self.atributos))
+            self._otel = (otel, _otel_context.attach(_otel_trace.set_span_in_context(otel)))
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, exc, tb):
+        self.duracion = time.perf_counter() - self.inicio
+        if tipo is not None:
+            self.error = tipo.__name__
+        try:
+            _actual.reset(self._token)
+        except ValueError:
+            _actual.set(self._padre)   # se cerró en otro contexto (p. ej. otro hilo)
+        _registrar(self)
+        return False
+
+
+_actual: ContextVar[Optional[Span]] = ContextVar("traza_span_actual", default=None)
+
+
+class _SinTraza:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, clave: str, valor: Any):
+        pass
+
+    def marcar_error(self, exc: BaseException):
+        pass
+
+
+_SIN_TRAZA = _SinTraza()
+
+
+# ======================================================================
+# Histogramas
+# ======================================================================
+class _Histograma:
+    __slots__ = ("cuentas", "suma", "total", "errores")
+
+    def __init__(self):
+        self.cuentas = [0] * (len(BUCKETS) + 1)   # el último es +Inf
+        self.suma = 0.0
+        self.total = 0
+        self.errores = 0
+
+    def observar(self, segundos: float, error: bool):
+        i = 0
+        while i < len(BUCKETS) and segundos > BUCKETS[i]:
+            i += 1
+        self.cuentas[i] += 1
+        self.suma += segundos
+        self.total += 1
+        if error:
+            self.errores += 1
+
+
+_histogramas: Dict[str, _Histograma] = {}
+_log = logger("trazas")
+_lock = threading.Lock()
+_exportadores: List[Callable[[Span], None]] = []
+
+
+def _atributos_otel(atributos: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v if isinstance(v, (str, bool, int, float)) else str(v) for k, v in atributos.items()}
+
+
+def _registrar(s: Span):
+    with _lock:
+        h = _histogramas.get(s.nombre)
+        if h is None:
+            h = _histogramas[s.nombre] = _Histograma()
+        h.observar(s.duracion, s.error is not None)
+    s._etapas.append((s.nombre, s.duracion))
+    if s._otel is not None:
+        otel, token = s._otel
+        if s.error:
+            otel.set_attribute("error.type", s.error)
+        _otel_context.detach(token)
+        otel.end()
+    for fn in _exportadores:
+        try:
+            fn(s)
+        except Exception as e:
+            _log.warning("traza.exportador_fallido", exc=e)
+    if s._padre is None and s.duracion >= TRAZAS_LENTO_S:
+        _log.warning("traza.lenta", etapa=s.nombre, segundos=round(s.duracion, 3), desglose=desglose(s._etapas[:-1]))
+
+
+def desglose(etapas: List[Tuple[str, float]]) -> str:
+    """'openai.chat 9.10s, woo.api 2.01s ×3, …' (suma por etapa, de mayor a menor)."""
+    por_etapa: Dict[str, List[float]] = {}
+    for nombre, dur in etapas:
+        por_etapa.setdefault(nombre, []).append(dur)
+    partes = sorted(((sum(d), n, len(d)) for n, d in por_etapa.items()), reverse=True)
+    return ", ".join(f"{n} {t:.2f}s" + (f" ×{k}" if k > 1 else "") for t, n, k in partes) or "sin etapas medidas"
+
+
+# ======================================================================
+# API
+# ======================================================================
+def span(nombre: str, **atributos):
+    """with span("woo.api", path=...): … → mide la etapa (no hace nada con TRAZAS=0)."""
+    if not TRAZAS:
+        return _SIN_TRAZA
+    return Span(nombre, atributos)
+
+
+def medir(nombre: str):
+    """Decorador: mide la función entera como la etapa `nombre` (sync o async)."""
+    def deco(fn):
+        if not TRAZAS:
+            return fn
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def _async(*args, **kwargs):
+                with Span(nombre, {}):
+                    return await fn(*args, **kwargs)
+            return _async
+
+        @functools.wraps(fn)
+        def _sync(*args, **kwargs):
+            with Span(nombre, {}):
+                return fn(*args, **kwargs)
+        return _sync
+    return deco
+
+
+def registrar_exportador(fn: Callable[[Span], None]):
+    """fn(span) se llama al cerrar cada span (nombre, atributos, inicio, duracion, error)."""
+    _exportadores.append(fn)
+
+
+def resumen() -> Dict[str, Dict[str, float]]:
+    """{etapa: {n, errores, total_s, prom_ms}} para /__db."""
+    with _lock:
+        return {
+            n: {"n": h.total, "errores": h.errores, "total_s": round(h.suma, 3),
+                "prom_ms": round(1000 * h.suma / h.total, 1) if h.total else 0.0}
+            for n, h in _histogramas.items()
+        }
+
+
+# ======================================================================
+# Formato Prometheus
+# ======================================================================
+def _etiqueta(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _nombre_metrica(v: str) -> str:
+    return "".join(ch if ch.isalnum() or ch == "_" else "_" for ch in str(v)).lower()
+
+
+def metricas_prometheus(contadores: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+    """
+    Texto de exposición Prometheus: histograma por etapa y, si se pasan,
+    los contadores de cada módulo ({grupo: {clave: número}}) como gauges.
+    """
+    with _lock:
+        copia = [(n, list(h.cuentas), h.suma, h.total, h.errores) for n, h in sorted(_histogramas.items())]
+    lineas = [
+        "# HELP cassany_etapa_segundos Duración de cada etapa del pipeline.",
+        "# TYPE cassany_etapa_segundos histogram",
+    ]
+    for nombre, cuentas, suma, total, _ in copia:
+        e = _etiqueta(nombre)
+        acumulado = 0
+        for limite, c in zip(BUCKETS, cuentas):
+            acumulado += c
+            lineas.append(f'cassany_etapa_segundos_bucket{{etapa="{e}",le="{limite}"}} {acumulado}')
+        lineas.append(f'cassany_etapa_segundos_bucket{{etapa="{e}",le="+Inf"}} {total}')
+        lineas.append(f'cassany_etapa_segundos_sum{{etapa="{e}"}} {suma:.6f}')
+        lineas.append(f'cassany_etapa_segundos_count{{etapa="{e}"}} {total}')
+    lineas += ["# HELP cassany_etapa_errores_total Etapas que terminaron con excepción.",
+               "# TYPE cassany_etapa_errores_total counter"]
+    for nombre, _, _, _, errores in copia:
+        lineas.append(f'cassany_etapa_errores_total{{etapa="{_etiqueta(nombre)}"}} {errores}')
+    for grupo, valores in (contadores or {}).items():
+        for clave, v in (valores or {}).items():
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                continue
+            m = f"cassany_{_nombre_metrica(grupo)}_{_nombre_metrica(clave)}"
+            lineas += [f"# TYPE {m} gauge", f"{m} {v}"]
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,137 @@
+# version_pedido.py
+"""
+Control de concurrencia optimista sobre `pedidos` (columna `version`).
+
+Los JSON de la sesión (carrito_json, ctx_json, preferencias_json…) se leen,
+se modifican en memoria y se reescriben enteros. Si dos mensajes del mismo
+cliente llegan casi juntos, el segundo UPDATE pisaría al primero.
+
+• mutar_pedido lee las columnas junto con la versión, aplica la mutación
+  en memoria y escribe con `WHERE version = :leida`, subiendo la versión.
+  Si otro escritor se adelantó (0 filas, o SQLite avisa que la foto de
+  lectura quedó vieja), vuelve a leer y reaplica la mutación sobre los datos
+  frescos, hasta CAS_REINTENTOS veces.
+• escribir_pedido es para escrituras ciegas (reemplazan el valor sin leerlo):
+  también suben la versión, así las mutaciones en curso se enteran.
+
+La mutación puede correr más de una vez: debe ser pura (sin efectos fuera
+de los valores que recibe).
+
+Es código bloqueante (DB, writer SQLite y la espera entre reintentos): se
+llama desde un hilo de trabajo (asyncio.to_thread), como hacen el turno de
+WhatsApp y las tools del agente. Si por error corre en el event loop
+principal, reintenta sin dormir en vez de frenar a todas las requests.
+"""
+from __future__ import annotations
+import os
+import time
+import random
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Optional, Sequence
+
+from sqlalchemy import text as sa_text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from database import execute_write
+from registro import logger, id_sesion
+
+log = logger("version_pedido")
+
+CAS_REINTENTOS = int(os.getenv("CAS_REINTENTOS", "8"))
+CAS_ESPERA_MS = float(os.getenv("CAS_ESPERA_MS", "5"))   # espera base entre reintentos (exponencial, con jitter)
+
+CAS_METRICS: Dict[str, int] = {"escrituras": 0, "conflictos": 0, "agotados": 0, "en_loop": 0}
+
+Mutacion = Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+
+
+def _sets(cambios: Dict[str, Any]) -> str:
+    return ", ".join(f"{col}=:c_{col}" for col in cambios)
+
+
+def _params(cambios: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+    params = {f"c_{col}": v for col, v in cambios.items()}
+    params["sid"] = session_id
+    return params
+
+
+def _en_loop_principal() -> bool:
+    """True si se está corriendo dentro del event loop del servidor (hilo principal)."""
+    if threading.current_thread() is not threading.main_thread():
+        return False
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _esperar(intento: int):
+    if _en_loop_principal():
+        if not CAS_METRICS["en_loop"]:
+            log.warning("cas.en_loop")   # reintenta sin espera; llamarla desde un hilo de trabajo
+        CAS_METRICS["en_loop"] += 1
+        return
+    time.sleep(min(CAS_ESPERA_MS * 2 ** intento, 200.0) * random.uniform(0.5, 1.5) / 1000)
+
+
+def mutar_pedido(
+    db: Session,
+    session_id: str,
+    columnas: Sequence[str],
+    mutar: Mutacion,
+    reintentos: Optional[int] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Read-modify-write con compare-and-swap sobre la fila de la sesión.
+    `mutar(valores)` recibe {columna: valor crudo} y devuelve {columna: nuevo valor}
+    (puede incluir columnas que no leyó) o None/{} si no hay nada que escribir.
+    Devuelve los cambios escritos; None si no hay pedido o se agotaron los reintentos.
+    Bloquea: llamarla desde un hilo de trabajo, no desde el event loop.
+    """
+    cols = "".join(f", {c}" for c in columnas)
+    intentos = max(1, reintentos or CAS_REINTENTOS)
+    for intento in range(intentos):
+        try:
+            row = db.execute(
+                sa_text(f"SELECT COALESCE(version, 0){cols} FROM pedidos WHERE session_id=:sid"),
+                {"sid": session_id},
+            ).fetchone()
+            if row is None:
+                return None
+            version = int(row[0])
+            cambios = mutar(dict(zip(columnas, row[1:])))
+            if not cambios:
+                return {}
+            params = _params(cambios, session_id)
+            params["v"] = version
+            n = execute_write(
+                db,
+                sa_text(f"UPDATE pedidos SET {_sets(cambios)}, version=:v + 1 "
+                        "WHERE session_id=:sid AND COALESCE(version, 0)=:v"),
+                params,
+            )
+        except OperationalError:
+            # SQLite en WAL: la lectura quedó en una foto vieja y no puede pasar a escritura
+            n = 0
+        if n:
+            CAS_METRICS["escrituras"] += 1
+            return cambios
+        CAS_METRICS["conflictos"] += 1
+        db.rollback()   # la próxima lectura ve lo que confirmó el otro escritor
+        if intento + 1 < intentos:
+            _esperar(intento)
+    CAS_METRICS["agotados"] += 1
+    log.warning("cas.agotado", sesion=id_sesion(session_id), columnas=list(columnas))
+    return None
+
+
+def escribir_pedido(db: Session, session_id: str, cambios: Dict[str, Any]) -> int:
+    """UPDATE ciego (sin leer antes) que igual sube la versión."""
+    return execute_write(
+        db,
+        sa_text(f"UPDATE pedidos SET {_sets(cambios)}, version=COALESCE(version, 0) + 1 WHERE session_id=:sid"),
+        _params(cambios, session_id),
+    )
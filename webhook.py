@@ -2,11 +2,13 @@
 import os, json, hmac, hashlib
 from typing import Optional
 from fastapi import APIRouter, Request, HTTPException, Header
-from sqlalchemy.orm import Session
-
-from database import SessionLocal
+from starlette.concurrency import run_in_threadpool
+from database import request_session
 from api_core import enviar_mensaje_whatsapp   # reusa envío saliente
 from api_core import mensaje_whatsapp, UserMessage  # handler conversacional
+from registro import logger, correlacionar
+
+log = logger("webhook")
 
 router = APIRouter()
 
@@ -49,7 +51,12 @@ async def receive_whatsapp_message(
         data = json.loads(raw.decode("utf-8"))
     except Exception:
         data = {}
-    print("📥 MENSAJE RECIBIDO DE WHATSAPP:\n", data)
+    # Solo un resumen del payload (tipos e ids), nunca el payload entero
+    values = [(ch.get("value") or {}) for e in data.get("entry", []) for ch in e.get("changes", [])]
+    log.info("whatsapp.recibido",
+             tipos=[m.get("type") for v in values for m in v.get("messages", [])],
+             ids=[m.get("id") for v in values for m in v.get("messages", [])],
+             estados=sum(len(v.get("statuses") or []) for v in values))
 
     for entry in data.get("entry", []):
         for change in entry.get("changes", []):
@@ -71,11 +78,10 @@ async def receive_whatsapp_message(
                     continue
 
                 session_id = f"cliente_{num}"
-                db: Session = SessionLocal()
-                try:
-                    print(f"🧪 Texto recibido: {txt}")
-                    res = await mensaje_whatsapp(UserMessage(message=txt), session_id=session_id, db=db)
+                correlacionar(session_id)
+                with request_session() as db:
+                    log.debug("whatsapp.texto", tipo=msg_type, texto=txt, wamid=msg_id)
+                    # El turno es síncrono: va al threadpool, el loop sigue atendiendo
+                    res = await run_in_threadpool(mensaje_whatsapp, UserMessage(message=txt), session_id=session_id, db=db)
                     await enviar_mensaje_whatsapp(num, res.get("response", ""))
-                finally:
-                    db.close()
     return {"status": "received"}
@@ -0,0 +1,124 @@
+# webhook_woo.py
+"""
+Webhooks de WooCommerce → espejo local del catálogo.
+
+Woo firma cada entrega con X-WC-Webhook-Signature = base64(HMAC-SHA256(body, secret)).
+Se responde de inmediato y el parche corre en segundo plano:
+  • product.created / updated / restored → se guarda ese producto (y, si es
+    variable, se releen solo sus variaciones).
+  • Variación (payload type=variation) → se reemplaza dentro de su padre.
+  • product.deleted → sale del espejo; si el id es de una variación, se
+    quita de la lista de su padre.
+  • order.created / updated → se releen los productos de sus líneas (stock).
+
+Sin WC_WEBHOOK_SECRET el endpoint responde 503: no se aceptan parches sin
+firmar. Solo para desarrollo local, WC_WEBHOOK_SIN_FIRMA=1 lo deja abierto.
+"""
+import os, json, hmac, base64, hashlib
+from typing import Any, Dict, List
+
+from fastapi import APIRouter, BackgroundTasks, Header, HTTPException, Request
+
+import catalogo_local
+from registro import logger
+
+log = logger("webhook_woo")
+
+router = APIRouter()
+
+WC_WEBHOOK_SECRET = os.getenv("WC_WEBHOOK_SECRET", "")
+WC_WEBHOOK_SIN_FIRMA = os.getenv("WC_WEBHOOK_SIN_FIRMA", "0") == "1"
+
+METRICAS: Dict[str, int] = {"recibidos": 0, "aplicados": 0, "ignorados": 0, "errores": 0}
+
+
+def _verify_wc_signature(raw_body: bytes, signature: str) -> bool:
+    if not WC_WEBHOOK_SECRET:
+        return WC_WEBHOOK_SIN_FIRMA
+    if not signature:
+        return False
+    try:
+        mac = hmac.new(WC_WEBHOOK_SECRET.encode("utf-8"), msg=raw_body, digestmod=hashlib.sha256)
+        expected = base64.b64encode(mac.digest()).decode("ascii")
+        return hmac.compare_digest(expected, signature)
+    except Exception:
+        return False
+
+
+def _productos_de_pedido(order: Dict[str, Any]) -> List[int]:
+    pids = []
+    for li in order.get("line_items") or []:
+        try:
+            pid = int(li.get("product_id") or 0)
+        except Exception:
+            continue
+        if pid:
+            pids.append(pid)
+    return pids
+
+
+def _procesar(topic: str, data: Dict[str, Any]):
+    try:
+        recurso, _, evento = (topic or "").partition(".")
+        if recurso == "product":
+            if evento == "deleted":
+                pid = int(data["id"])
+                cat = catalogo_local.get_catalogo()
+                if int(data.get("parent_id") or 0) or cat is None or pid not in cat.productos:
+                    res = catalogo_local.quitar_variacion(pid, int(data.get("parent_id") or 0) or None)
+                    if res.get("ignorado"):
+                        res = catalogo_local.aplicar_cambios(productos={pid: None})
+                else:
+                    res = catalogo_local.aplicar_cambios(productos={pid: None})
+            elif data.get("type") == "variation" or int(data.get("parent_id") or 0):
+                res = catalogo_local.aplicar_variacion(data)
+            elif data.get("type") == "variable":
+                pid = int(data["id"])
+                res = catalogo_local.aplicar_cambios(
+                    productos={pid: data},
+                    variaciones=catalogo_local._fetch_variaciones([pid]),
+                )
+            else:
+                res = catalogo_local.aplicar_cambios(productos={int(data["id"]): data})
+        elif recurso == "order" and evento in ("created", "updated"):
+            res = catalogo_local.refrescar_productos(_productos_de_pedido(data))
+        else:
+            res = {"ignorado": topic}
+        METRICAS["ignorados" if res.get("ignorado") else "aplicados"] += 1
+        log.info("woo_webhook.aplicado", topic=topic, resultado=res)
+    except Exception as e:
+        METRICAS["errores"] += 1
+        log.error("woo_webhook.fallido", exc=e, topic=topic)
+
+
+@router.post("/webhook/woocommerce")
+async def receive_woocommerce_webhook(
+    request: Request,
+    background: BackgroundTasks,
+    x_wc_webhook_signature: str = Header(default=None),
+    x_wc_webhook_topic: str = Header(default=None),
+):
+    if not WC_WEBHOOK_SECRET and not WC_WEBHOOK_SIN_FIRMA:
+        raise HTTPException(503, "WC_WEBHOOK_SECRET no configurado")
+    raw = await request.body()
+    if not _verify_wc_signature(raw, x_wc_webhook_signature or ""):
+        raise HTTPException(403, "Firma inválida")
+    METRICAS["recibidos"] += 1
+
+    # Al crear el webhook Woo manda un ping form-encoded (webhook_id=...) sin topic
+    try:
+        data = json.loads(raw.decode("utf-8"))
+    except Exception:
+        return {"status": "ok", "ping": True}
+    if not isinstance(data, dict) or not x_wc_webhook_topic or not data.get("id"):
+        METRICAS["ignorados"] += 1
+        return {"status": "ignored"}
+
+    background.add_task(_procesar, x_wc_webhook_topic, data)
+    return {"status": "accepted"}
+
+
+@router.get("/webhook/woocommerce/status")
+def woocommerce_webhook_status():
+    cat = catalogo_local.get_catalogo()
+    return {"metricas": dict(METRICAS), "catalogo_version": cat.version if cat else None}
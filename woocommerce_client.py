@@ -1,4 +1,4 @@
-# woocommerce_client.py — v2.2
+# woocommerce_client.py — v2.4
 import os
 from typing import Any, Dict, List, Optional, Union
 
@@ -6,6 +6,8 @@ import requests
 from dotenv import load_dotenv
 from urllib.parse import urlencode
 
+from trazas import span
+
 load_dotenv()
 
 WC_API_URL: str = os.getenv("WOOCOMMERCE_API_URL", "").rstrip("/") + "/"
@@ -36,28 +38,48 @@ def _endpoint(path: str) -> str:
     return WC_API_URL + path.lstrip("/")
 
 
-def _request(method: str, path: str, params: Optional[Dict[str, Any]] = None, timeout: Union[int, float] = 10) -> Union[List[Any], Dict[str, Any]]:
-    """Invoca la API de WooCommerce y devuelve JSON o {'error': ...}."""
+def _request(
+    method: str,
+    path: str,
+    params: Optional[Dict[str, Any]] = None,
+    timeout: Union[int, float] = 10,
+    json_body: Optional[Any] = None,
+) -> Union[List[Any], Dict[str, Any]]:
+    """Invoca la API de WooCommerce (con cuerpo JSON si se indica) y devuelve JSON o {'error': ...}."""
     if not WC_CONSUMER_KEY or not WC_CONSUMER_SECRET or not WC_API_URL:
         return {"error": "WooCommerce credentials or base URL missing."}
 
     url = _endpoint(path)
-    try:
-        resp = requests.request(method.upper(), url, params=_auth_params(**(params or {})), timeout=timeout)
-        resp.raise_for_status()
-        return resp.json()
-    except Exception as e:
-        return {"error": str(e)}
-
-
-def get_all_products(per_page: int = 20, stock_only: bool = False, max_pages: int = 1) -> Union[List[Dict[str, Any]], Dict[str, str]]:
+    with span("woo.api", metodo=method.upper(), path=path) as sp:
+        try:
+            resp = requests.request(method.upper(), url, params=_auth_params(**(params or {})),
+                                    json=json_body, timeout=timeout)
+            resp.raise_for_status()
+            return resp.json()
+        except Exception as e:
+            sp.marcar_error(e)
+            return {"error": str(e)}
+
+
+def get_all_products(
+    per_page: int = 20,
+    stock_only: bool = False,
+    max_pages: int = 1,
+    modified_after: Optional[str] = None,
+    status: str = "publish",
+) -> Union[List[Dict[str, Any]], Dict[str, str]]:
     """
     Lista productos. Usa paginación si max_pages > 1 (Woo máx per_page=100).
     stock_only: si True, filtra a mano por 'instock'.
+    modified_after: ISO-8601 en UTC; solo productos modificados después (sync incremental).
+    status: 'publish' por defecto; 'any' para ver también los despublicados.
     """
+    params: Dict[str, Any] = {"per_page": per_page, "status": status}
+    if modified_after:
+        params.update({"modified_after": modified_after, "dates_are_gmt": "true"})
     results: List[Dict[str, Any]] = []
     for page in range(1, max_pages + 1):
-        data = _request("GET", "products", {"per_page": per_page, "page": page, "status": "publish"})
+        data = _request("GET", "products", {**params, "page": page})
         if isinstance(data, dict) and data.get("error"):
             return data
         batch = data or []
@@ -92,6 +114,11 @@ def get_product_by_id(product_id: int) -> Union[Dict[str, Any], Dict[str, str]]:
     return _request("GET", f"products/{product_id}")
 
 
+def get_products_where(**filtros: Any) -> Union[List[Dict[str, Any]], Dict[str, str]]:
+    """Productos que casan con un filtro exacto de la API (sku=..., slug=...), cualquier tipo."""
+    return _request("GET", "products", {**filtros, "status": "publish"})
+
+
 def get_variations(product_id: int, per_page: int = 50, stock_only: bool = False, max_pages: int = 1) -> Union[List[Dict[str, Any]], Dict[str, str]]:
     """
     Lista variaciones de un producto. Filtra stock si se indica.
@@ -110,6 +137,37 @@ def get_variations(product_id: int, per_page: int = 50, stock_only: bool = False
     return results
 
 
+def get_categories(per_page: int = 100, max_pages: int = 10) -> Union[List[Dict[str, Any]], Dict[str, str]]:
+    """Lista categorías de producto (id, name, slug, parent, count)."""
+    results: List[Dict[str, Any]] = []
+    for page in range(1, max_pages + 1):
+        data = _request("GET", "products/categories", {"per_page": per_page, "page": page})
+        if isinstance(data, dict) and data.get("error"):
+            return data
+        batch = data or []
+        results.extend(batch)
+        if len(batch) < per_page:
+            break
+    return results
+
+
+
+def create_orders_batch(orders: List[Dict[str, Any]], timeout: Union[int, float] = 30) -> Dict[str, Any]:
+    """
+    Crea varios pedidos en una llamada (orders/batch; Woo acepta hasta 100).
+    Devuelve {'create': [...]} en el mismo orden (cada uno con 'id' o con 'error') o {'error': ...}.
+    """
+    data = _request("POST", "orders/batch", json_body={"create": orders}, timeout=timeout)
+    return data if isinstance(data, dict) else {"error": "Respuesta inesperada de orders/batch"}
+
+
+def search_orders(search: str, after: Optional[str] = None, per_page: int = 20) -> Union[List[Dict[str, Any]], Dict[str, str]]:
+    """Busca pedidos (Woo busca en nombre, email, teléfono y dirección); after: ISO-8601 UTC."""
+    params: Dict[str, Any] = {"search": search, "per_page": per_page, "status": "any"}
+    if after:
+        params.update({"after": after, "dates_are_gmt": "true"})
+    return _request("GET", "orders", params)
+
 # Prueba rápida manual
 if __name__ == "__main__":
     prods = get_all_products(per_page=20, stock_only=True, max_pages=1)
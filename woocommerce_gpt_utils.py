@@ -1,19 +1,26 @@
-"""woocommerce_gpt_utils.py  –  v2.4
+"""woocommerce_gpt_utils.py  –  v2.5
 Funciones auxiliares para:
 • Detectar la intención de compra en lenguaje natural
 • Consultar WooCommerce y devolver productos realmente disponibles
 • Mostrar tallas disponibles por producto (variaciones)
 • Filtrar por atributos declarados por el usuario (manga larga/corta, guayabera, color básico, lociones)
+• Búsqueda de texto en el índice del catálogo local (prefijos, frases, entre categorías)
 """
 from __future__ import annotations
 import os
 import re
-import unicodedata
-from typing import Dict, List, Tuple, Union, Optional
+import time
+from typing import Container, Dict, Iterable, List, Tuple, Union, Optional
 
 import requests
 from dotenv import load_dotenv
-from rapidfuzz import process, fuzz
+
+import catalogo_local
+import ranking
+import taxonomia
+from facetas import calcular_facetas, color_canonico, normalizar
+from filtros import USO_RE
+from trazas import medir
 
 #  Configuración
 load_dotenv()
@@ -22,7 +29,8 @@ WC_API_URL       = os.getenv("WOOCOMMERCE_API_URL")
 WC_CONSUMER_KEY  = os.getenv("WOOCOMMERCE_CONSUMER_KEY")
 WC_CONSUMER_SEC  = os.getenv("WOOCOMMERCE_CONSUMER_SECRET")
 
-# Mapa categoría → id (actualizado con todas las categorías que me diste)
+# Semilla: mapa categoría → id y sinónimos usados mientras no haya taxonomía de
+# WooCommerce (ver taxonomia.py); luego solo aportan sinónimos extra.
 CATEGORY_IDS: Dict[str, int] = {
     "accesorios": 238,
     "bermudas":   228,
@@ -78,11 +86,6 @@ SYNONYMS: Dict[str, str] = {
     "fragancias": "accesorios",
 }
 
-def _normalize(txt: str) -> str:
-    txt = unicodedata.normalize("NFD", txt)
-    txt = "".join(c for c in txt if unicodedata.category(c) != "Mn")
-    return txt.lower()
-
 def _tokenize(txt: str) -> List[str]:
     return re.findall(r"[a-záéíóúñü]+", txt.lower())
 
@@ -118,15 +121,13 @@ def _filtrar_stock(items: list) -> list:
     ]
 
 # ---------- NUEVO: detección de atributos en texto ----------
-_COLORES_BASICOS = {
-    "negro", "blanco", "azul", "rojo", "verde", "gris", "beige",
-    "marron", "marrón", "café", "cafe", "amarillo", "naranja", "morado", "lila"
-}
+# S/M/L sueltas son ambiguas en texto libre; solo cuentan precedidas de "talla"
+_TALLA_PEDIDA_RE = re.compile(r"\btalla\s+(XXL|XL|XS|S|M|L|2[89]|3\d|4[0-4])\b|\b(XXL|XL|XS)\b", re.I)
 
 def detectar_atributos(texto_usuario: str) -> Dict[str, Optional[str]]:
     """Extrae atributos clave del texto del usuario."""
-    t = _normalize(texto_usuario)
-    attrs: Dict[str, Optional[str]] = {"manga": None, "subtipo": None, "color": None}
+    t = normalizar(texto_usuario)
+    attrs: Dict[str, Optional[str]] = {"manga": None, "subtipo": None, "color": None, "talla": None, "uso": None}
 
     # manga
     if "manga larga" in t:
@@ -138,73 +139,50 @@ def detectar_atributos(texto_usuario: str) -> Dict[str, Optional[str]]:
     if "guayabera" in t or "guayaberas" in t:
         attrs["subtipo"] = "guayabera"
 
-    # color (básico)
-    for c in _COLORES_BASICOS:
-        if re.search(rf"\b{re.escape(c)}\b", t):
+    # color (básico, forma canónica: "negra" → "negro", "marrón" → "marron")
+    for w in re.findall(r"[a-z]+", t):
+        c = color_canonico(w)
+        if c:
             attrs["color"] = c
             break
 
-    return attrs
+    # talla: "talla M" / "talla 32", o tallas compuestas sueltas (XS, XL, XXL)
+    m = _TALLA_PEDIDA_RE.search(texto_usuario)
+    if m:
+        attrs["talla"] = (m.group(1) or m.group(2)).upper()
 
-def _texto_de_producto(p: dict) -> str:
-    """Concatena campos útiles del producto para hacer filtros por texto."""
-    parts = [
-        p.get("name", ""),
-        " ".join([c.get("name","") for c in p.get("categories", []) or []]),
-        " ".join([t.get("name","") for t in p.get("tags", []) or []]),
-    ]
-    for a in (p.get("attributes") or []):
-        parts.append(a.get("name", ""))
-        for opt in a.get("options", []) or []:
-            parts.append(str(opt))
-    return _normalize(" ".join(parts))
-
-def _match_subtipo(texto: str, subtipo: Optional[str]) -> bool:
-    if not subtipo:
-        return True
-    if subtipo == "guayabera":
-        return ("guayabera" in texto)
-    return True
+    # uso
+    m = USO_RE.search(t)
+    if m:
+        attrs["uso"] = m.group(1).lower()
 
-def _match_manga(texto: str, manga: Optional[str]) -> bool:
-    if not manga:
-        return True
-    if manga == "larga":
-        return ("manga larga" in texto) and ("manga corta" not in texto)
-    if manga == "corta":
-        return ("manga corta" in texto) and ("manga larga" not in texto)
-    return True
-
-def _match_color(texto: str, color: Optional[str]) -> bool:
-    if not color:
-        return True
-    return color in texto
-
-def detectar_categoria(texto_usuario: str) -> Tuple[str | None, float]:
-    tokens = [_normalize(t) for t in _tokenize(texto_usuario)]
-
-    for t in tokens:
-        if t in SYNONYMS:
-            return SYNONYMS[t], 1.0
-        if t in CATEGORY_IDS:
-            return t, 1.0
+    return attrs
 
-    universe = list(CATEGORY_IDS.keys()) + list(SYNONYMS.keys())
-    joined   = " ".join(tokens)
+def _taxonomia() -> taxonomia.Taxonomia:
+    return taxonomia.actual(CATEGORY_IDS, SYNONYMS)
 
-    best, score, _ = process.extractOne(
-        joined, universe, scorer=fuzz.token_sort_ratio
-    ) or (None, 0, None)
+def detectar_categoria(texto_usuario: str) -> Tuple[str | None, float]:
+    return _taxonomia().detectar(texto_usuario)
 
-    if score >= 80:
-        return SYNONYMS.get(best, best), score / 100.0
+def detectar_categorias(textos: List[str]) -> List[Tuple[str | None, float]]:
+    return _taxonomia().detector.detectar_lote(textos)
 
-    return None, 0.0
+def _catalogo_para(category_ids: Optional[List[int]] = None):
+    """Snapshot local si está listo y cubre esas categorías (tras un arranque en frío puede ser parcial)."""
+    catalogo = catalogo_local.get_catalogo() if catalogo_local.catalogo_listo() else None
+    if catalogo is not None and category_ids and not catalogo.cubre(category_ids):
+        return None
+    return catalogo
 
 def get_products(category: str, max_items: int = 10) -> List[dict]:
-    cat_id = CATEGORY_IDS.get(category)
+    tax = _taxonomia()
+    cat_id = tax.id(category)
     if not cat_id:
         return []
+    # Espejo local: categoría completa (con subcategorías), sin red. Si aún no está listo, API en vivo.
+    catalogo = _catalogo_para(tax.ids(category))
+    if catalogo is not None:
+        return list(catalogo.consultar(category_ids=tax.ids(category)))
     items = _woo_get("products", {
         "category": cat_id,
         "per_page": max(50, max_items),
@@ -213,6 +191,9 @@ def get_products(category: str, max_items: int = 10) -> List[dict]:
 
 def get_variaciones(product_id: int) -> List[dict]:
     """Devuelve variaciones activas (por ejemplo, tallas disponibles) de un producto."""
+    locales = catalogo_local.variaciones_en_stock(product_id)
+    if locales is not None:
+        return locales
     try:
         variaciones = _woo_get(f"products/{product_id}/variations", {"per_page": 20})
         return [
@@ -223,28 +204,70 @@ def get_variaciones(product_id: int) -> List[dict]:
     except Exception:
         return []
 
+# Productos traídos en vivo (espejo aún no listo): los reintentos del mismo turno
+# (relajar filtros, fallback a la categoría) reusan la misma respuesta de Woo.
+PRODUCTOS_VIVO_TTL_S = float(os.getenv("PRODUCTOS_VIVO_TTL_S", "60"))
+_VIVOS: Dict[str, Tuple[float, int, List[dict]]] = {}
+
+def _productos_vivo_cache(cat: str, max_items: int) -> List[dict]:
+    hit = _VIVOS.get(cat)
+    ahora = time.monotonic()
+    if hit and ahora - hit[0] < PRODUCTOS_VIVO_TTL_S and hit[1] >= max_items:
+        return hit[2]
+    items = get_products(cat, max_items=max_items) or []
+    _VIVOS[cat] = (ahora, max_items, items)
+    return items
+
+@medir("catalogo.sugerir")
 def sugerir_productos(
     texto_usuario: str,
     limite: int = 3,
     excluir_urls: Optional[List[str]] = None,
+    excluir_ids: Optional[Container[int]] = None,
     incluye_palabras: Optional[set] = None,
-    excluye_palabras: Optional[set] = None
+    excluye_palabras: Optional[set] = None,
+    presupuesto: Optional[ranking.Presupuesto] = None,
+    tallas_preferidas: Optional[Iterable[str]] = None,
+    offset: int = 0,
+    categoria: Optional[str] = None,
+    atributos: Optional[Dict[str, Optional[str]]] = None,
 ) -> Dict:
     """
     Devuelve hasta 'limite' productos de la categoría detectada,
-    filtrados por atributos mencionados (manga/subtipo/color) y por
+    filtrados por atributos mencionados (manga/subtipo/color/talla/uso) y por
     palabras clave inclusivas/exclusivas opcionales.
-    'excluir_urls' permite no repetir sugerencias anteriores.
+    'excluir_ids' (p. ej. un HistorialVistos) permite no repetir sugerencias
+    anteriores; 'excluir_urls' se mantiene por compatibilidad.
+    Los candidatos se ordenan con ranking.py (ventas, stock, presupuesto
+    —explícito o leído del texto— y tallas preferidas) antes de cortar la
+    página [offset, offset+limite). 'ids_ordenados' trae la lista completa
+    ya ordenada para que el llamador pagine sin recalcular (cursor_resultados.py).
+    'categoria' y 'atributos' permiten pasar lo ya resuelto por el llamador
+    (p. ej. los filtros de la herramienta del agente): se omite la detección
+    de categoría y esos atributos pisan a los leídos del texto.
     """
-    categoria, conf = detectar_categoria(texto_usuario)
-    if not categoria:
+    tax = _taxonomia()
+    if not (categoria and tax.id(categoria)):
+        categoria = (categoria and tax.detectar(categoria)[0]) or tax.detectar(texto_usuario)[0]
+    catalogo = _catalogo_para(tax.ids(categoria) if categoria else None)
+
+    # Sin categoría clara: búsqueda de texto libre sobre todo el catálogo local
+    ids_texto = None
+    if not categoria and catalogo is not None:
+        ids_texto = catalogo.indice.buscar(texto_usuario, flexible=True)
+    if not categoria and not ids_texto:
         return {"mensaje": "No detecté ninguna categoría concreta."}
 
     attrs = detectar_atributos(texto_usuario)
+    attrs.update({k: v for k, v in (atributos or {}).items() if v})
+    criterios = ranking.Criterios(
+        presupuesto or ranking.presupuesto_de_texto(texto_usuario),
+        tallas_preferidas or (),
+    )
 
     # normaliza sets de include/exclude
-    incluye = {_normalize(x) for x in (incluye_palabras or set())}
-    excluye = {_normalize(x) for x in (excluye_palabras or set())}
+    incluye = {normalizar(x) for x in (incluye_palabras or set())}
+    excluye = {normalizar(x) for x in (excluye_palabras or set())}
 
     def _pasa_sets(texto_norm: str) -> bool:
         if any(k in texto_norm for k in excluye):
@@ -253,36 +276,63 @@ def sugerir_productos(
             return False
         return True
 
-    def _filtra_lista(items: List[dict], urls_fuera: set) -> List[dict]:
+    urls_fuera = set(excluir_urls or [])
+    ids_fuera = excluir_ids if excluir_ids is not None else ()
+
+    def _filtra_lista(items: Iterable[dict], filtros: Dict[str, Optional[str]], en_espejo: bool) -> List[dict]:
         out = []
         for p in items:
-            if p.get("permalink") in urls_fuera:
+            if p.get("id") in ids_fuera:
                 continue
-            txt = _texto_de_producto(p)  # ya normalizado
-            if not _match_subtipo(txt, attrs.get("subtipo")):
-                continue
-            if not _match_manga(txt, attrs.get("manga")):
-                continue
-            if not _match_color(txt, attrs.get("color")):
-                continue
-            if not _pasa_sets(txt):
+            if urls_fuera and p.get("permalink") in urls_fuera:
                 continue
+            if not en_espejo:
+                # Fallback en vivo: facetas calculadas al vuelo para este producto
+                f = calcular_facetas(p)
+                if not f.cumple(filtros) or not _pasa_sets(f.texto):
+                    continue
             out.append(p)
         return out
 
-    urls_fuera = set(excluir_urls or [])
+    def _productos_vivo(cat: str) -> List[dict]:
+        return _productos_vivo_cache(cat, max(offset + limite, 20))
+
+    def _candidatos(cat: Optional[str], filtros: Dict[str, Optional[str]]) -> List[dict]:
+        # Espejo listo: categoría, stock, facetas y palabras clave son AND de bitsets, sin red
+        if catalogo is not None and (not cat or catalogo.cubre(tax.ids(cat))):
+            lista = _filtra_lista(catalogo.consultar(
+                category_ids=tax.ids(cat) if cat else None,
+                ids=None if cat else ids_texto,
+                attrs=filtros,
+                incluye=incluye,
+                excluye=excluye,
+            ), filtros, en_espejo=True)
+            orden = ranking.ordenar_ids(catalogo, [p["id"] for p in lista], criterios)
+            return [catalogo.productos[pid] for pid in orden]
+        lista = _filtra_lista(_productos_vivo(cat), filtros, en_espejo=False)
+        return ranking.ordenar_productos(lista, criterios)
+
+    def _candidatos_con_uso_opcional(cat: Optional[str]) -> List[dict]:
+        # El uso (oficina, casual…) rara vez figura en la ficha: si deja la lista vacía, se ignora
+        out = _candidatos(cat, attrs)
+        if not out and attrs.get("uso"):
+            out = _candidatos(cat, {**attrs, "uso": None})
+        return out
 
-    # 1) Trae por categoría detectada
-    base = get_products(categoria, max_items=max(limite, 20))
-    if not base:
-        return {"mensaje": f"No hay stock en la categoría «{categoria}» ahora mismo."}
+    # 1) Stock en la categoría detectada (o en lo hallado por texto libre)
+    if categoria:
+        hay_stock = (
+            catalogo.hay_stock(tax.ids(categoria)) if catalogo is not None
+            else bool(_productos_vivo(categoria))
+        )
+        if not hay_stock:
+            return {"mensaje": f"No hay stock en la categoría «{categoria}» ahora mismo."}
 
-    candidatos = _filtra_lista(base, urls_fuera)
+    candidatos = _candidatos_con_uso_opcional(categoria)
 
     # 2) Fallback especial: si pidieron guayabera y no hay, intenta en camisas manteniendo filtros
-    if not candidatos and attrs.get("subtipo") == "guayabera" and categoria != "camisas":
-        base2 = get_products("camisas", max_items=20)
-        candidatos = _filtra_lista(base2 or [], urls_fuera)
+    if not candidatos and attrs.get("subtipo") == "guayabera" and categoria not in (None, "camisas") and tax.id("camisas"):
+        candidatos = _candidatos_con_uso_opcional("camisas")
 
     if not candidatos:
         # arma mensaje humano con los atributos pedidos
@@ -293,28 +343,60 @@ def sugerir_productos(
             human_attrs.append(f"manga {attrs['manga']}")
         if attrs.get("color"):
             human_attrs.append(attrs["color"])
-        detalle = " ".join(human_attrs) if human_attrs else categoria
+        if attrs.get("talla"):
+            human_attrs.append(f"talla {attrs['talla']}")
+        detalle = " ".join(human_attrs) if human_attrs else (categoria or texto_usuario)
         return {"mensaje": f"No hay stock para «{detalle}» en este momento."}
 
-    # 3) Armar respuesta con variaciones/tallas
-    productos_detalle = []
-    for p in candidatos[:limite]:
-        variaciones = get_variaciones(p["id"])
-        tallas = []
-        for v in variaciones:
-            if v.get("attributes"):
-                opt = v["attributes"][0].get("option")
-                if opt:
-                    tallas.append(opt)
-        productos_detalle.append({
-            "nombre": p.get("name", ""),
-            "precio": _parse_price(p.get("price", 0)),
-            "url": p.get("permalink", ""),
-            "tallas_disponibles": tallas
-        })
+    # 3) Armar respuesta con variaciones/tallas (solo la página pedida)
+    pagina = candidatos[max(0, offset):max(0, offset) + limite]
+    if not pagina:
+        return {"mensaje": "Ya no quedan más opciones para esta búsqueda."}
 
     return {
         "categoria_detectada": categoria,
         "atributos_detectados": attrs,
-        "productos": productos_detalle
+        "presupuesto_detectado": criterios.presupuesto,
+        "productos": [_detalle_producto(p) for p in pagina],
+        "ids_ordenados": [p["id"] for p in candidatos if p.get("id")],
+        "total": len(candidatos),
+    }
+
+
+def _detalle_producto(p: dict) -> Dict:
+    tallas = []
+    for v in get_variaciones(p["id"]):
+        if v.get("attributes"):
+            opt = v["attributes"][0].get("option")
+            if opt:
+                tallas.append(opt)
+    return {
+        "id": p.get("id"),
+        "nombre": p.get("name", ""),
+        "precio": _parse_price(p.get("price", 0)),
+        "url": p.get("permalink", ""),
+        "tallas_disponibles": tallas
     }
+
+
+def productos_por_ids(pids: Iterable[int], limite: int) -> Tuple[List[Dict], int]:
+    """
+    Hasta 'limite' productos (mismo formato que sugerir_productos) tomados en
+    orden de 'pids' desde el snapshot local, saltando los que ya no existen o
+    se agotaron. Devuelve también cuántos IDs se consumieron. Sin espejo
+    listo devuelve ([], 0) y el llamador vuelve a sugerir_productos.
+    """
+    catalogo = _catalogo_para()
+    if catalogo is None:
+        return [], 0
+    out: List[Dict] = []
+    usados = 0
+    for pid in pids:
+        if len(out) >= limite:
+            break
+        usados += 1
+        i = catalogo.pos.get(pid)
+        if i is None or not (catalogo.bits_stock >> i) & 1:
+            continue
+        out.append(_detalle_producto(catalogo.productos[pid]))
+    return out, usados